@@ -48,3 +48,173 @@ async def update_action_insert(*, conn, settings, **kwargs):
     Run the sql section "action-insert" which creates or updates the action_insert() function
     """
     await run_sql_section('action-insert', settings.sql_path.read_text(), conn)
+
+
+@patch
+async def add_conv_counts(*, conn, settings, logger, **kwargs):
+    """
+    Add msg_count and prt_count to conversations, populate them, then update the triggers which maintain them
+    """
+    await conn.execute(
+        """
+        alter table conversations
+          add column if not exists msg_count int not null default 0,
+          add column if not exists prt_count int not null default 0
+        """
+    )
+    v = await conn.execute(
+        """
+        update conversations c set prt_count=t.count
+        from (select conv, count(*) from participants group by conv) t
+        where c.id=t.conv
+        """
+    )
+    logger.info('prt_count set on conversations: %s', v)
+    v = await conn.execute(
+        """
+        update conversations c set msg_count=t.count
+        from (
+          select conv, count(*) filter (where act='message:add') - count(*) filter (where act='message:delete') count
+          from actions where act='message:add' or act='message:delete'
+          group by conv
+        ) t
+        where c.id=t.conv
+        """
+    )
+    logger.info('msg_count set on conversations: %s', v)
+    sql = settings.sql_path.read_text()
+    await run_sql_section('participant-count', sql, conn)
+    await run_sql_section('action-insert', sql, conn)
+
+
+@patch
+async def create_user_flag_counts(*, conn, **kwargs):
+    """
+    Create the user_flag_counts table, rows are created as counts are required
+    """
+    await conn.execute(
+        """
+        create table if not exists user_flag_counts (
+          user_id bigint primary key references users on delete cascade,
+          inbox int not null default 0,
+          unseen int not null default 0,
+          draft int not null default 0,
+          sent int not null default 0,
+          archive int not null default 0,
+          "all" int not null default 0,
+          spam int not null default 0,
+          deleted int not null default 0
+        )
+        """
+    )
+
+
+@patch
+async def add_label_conv_count(*, conn, settings, logger, **kwargs):
+    """
+    Add conv_count to labels, populate it and create the triggers which maintain it
+    """
+    await conn.execute('alter table labels add column if not exists conv_count int not null default 0')
+    v = await conn.execute(
+        """
+        update labels l set conv_count=t.count
+        from (select unnest(label_ids) label_id, count(*) from participants group by label_id) t
+        where l.id=t.label_id
+        """
+    )
+    logger.info('conv_count set on labels: %s', v)
+    await run_sql_section('participant-labels', settings.sql_path.read_text(), conn)
+
+
+@patch
+async def create_search_members(*, conn, settings, logger, **kwargs):
+    """
+    Move search.user_ids to the search_members table
+    """
+    await conn.execute(
+        """
+        create table if not exists search_members (
+          search_id bigint not null references search on delete cascade,
+          user_id bigint not null references users on delete restrict,
+          ts timestamptz,
+          unique (search_id, user_id)
+        );
+        create index if not exists idx_search_members_user_ts on search_members using btree (user_id, ts);
+        """
+    )
+    v = await conn.execute(
+        """
+        insert into search_members (search_id, user_id, ts)
+        select id, unnest(user_ids), ts from search
+        on conflict (search_id, user_id) do nothing
+        """
+    )
+    logger.info('search members created: %s', v)
+    await conn.execute('alter table search drop column user_ids')
+    await run_sql_section('search-members-ts', settings.sql_path.read_text(), conn)
+
+
+@patch
+async def search_ts_not_null(*, conn, logger, **kwargs):
+    """
+    Set search.ts on all entries so search results can be paginated on ts
+    """
+    v = await conn.execute(
+        """
+        update search s set ts=c.updated_ts
+        from conversations c
+        where s.conv=c.id and s.ts is null
+        """
+    )
+    logger.info('search ts set: %s', v)
+    # search_members.ts is updated by the search_members_ts trigger
+    await conn.execute(
+        """
+        alter table search alter column ts set default current_timestamp;
+        alter table search alter column ts set not null;
+        alter table search_members alter column ts set not null;
+        drop index if exists idx_search_members_user_ts;
+        create index idx_search_members_user_ts on search_members using btree (user_id, ts, search_id);
+        """
+    )
+
+
+@patch
+async def create_search_suggestions(*, conn, logger, **kwargs):
+    """
+    Create the search_suggestions table used by search suggest, run "python -m em2.reindex" afterwards to populate it
+    """
+    await conn.execute(
+        """
+        create type SuggestionTypes as enum ('subject', 'participant', 'file');
+        create table search_suggestions (
+          search_id bigint not null references search on delete cascade,
+          suggestion_type SuggestionTypes not null,
+          value varchar(255) not null,
+          unique (search_id, suggestion_type, value)
+        );
+        """
+    )
+    logger.info('search_suggestions created, suggestions will be populated as conversations are updated or reindexed')
+
+
+@patch
+async def add_search_suggestions_value_index(*, conn, logger, **kwargs):
+    """
+    Add the index on search_suggestions.value used by prefix matches in search suggest
+    """
+    await conn.execute(
+        'create index if not exists idx_search_suggestions_value '
+        'on search_suggestions using btree (lower(value) text_pattern_ops)'
+    )
+    logger.info('idx_search_suggestions_value created')
+
+
+@patch
+async def add_search_snippet_text(*, conn, settings, logger, **kwargs):
+    """
+    Add search.snippet_text used for search result snippets, run "python -m em2.reindex" afterwards to populate it
+    """
+    await conn.execute('alter table search add column if not exists snippet_text text')
+    await run_sql_section('trim-snippet', settings.sql_path.read_text(), conn)
+    logger.info('search.snippet_text added, snippets will be populated as conversations are updated or reindexed')
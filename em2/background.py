@@ -1,7 +1,11 @@
 import asyncio
 import logging
+import re
 from asyncio import CancelledError
-from typing import Any, Dict, List, Optional, Tuple
+from collections import Counter, deque
+from time import time
+from typing import Any, Deque, Dict, Iterable, List, Optional, Set, Tuple
+from uuid import uuid4
 
 import ujson
 from aiohttp.abc import Application
@@ -9,41 +13,199 @@ from aiohttp.web_ws import WebSocketResponse
 from arq.connections import ArqRedis
 
 from em2.contacts import add_contacts
-from em2.core import Action, Connections, ConvSummary, apply_actions, get_flag_counts
+from em2.core import (
+    Action,
+    ActionsJsonCache,
+    Connections,
+    ConvSummary,
+    Recipients,
+    UserTypes,
+    apply_actions,
+    get_many_flag_counts,
+    get_users_v,
+    recipients_cache,
+    reconcile_flag_counts,
+    user_v_dirty_key,
+    user_v_key,
+)
 from em2.settings import Settings
 from em2.utils.storage import S3, file_upload_cache_key
 
 logger = logging.getLogger('em2.ui.background')
+# websocket close code used when a client can't keep up with messages
+slow_close_code = 4429
+
+
+class WsQueue:
+    """
+    Bounded queue of messages for one websocket, sent by its own task so a slow client only delays itself.
+
+    When the queue is full a new message is merged with a queued message for the same conversation, if there
+    isn't one or a send takes longer than settings.ws_send_timeout the websocket is closed.
+    """
+
+    def __init__(self, background: 'Background', user_id: int, ws: WebSocketResponse):
+        self.background = background
+        self.user_id = user_id
+        self.ws = ws
+        # conversation key and message
+        self.messages: Deque[Tuple[str, str]] = deque()
+        self.ready = asyncio.Event()
+        self.closing = False
+        self.task = background.loop.create_task(self._writer())
+
+    def put(self, conv: str, msg: str):
+        if self.closing:
+            return
+        if len(self.messages) < self.background.settings.ws_queue_size:
+            self.messages.append((conv, msg))
+            self.ready.set()
+            return
+
+        for i, (queued_conv, queued_msg) in enumerate(self.messages):
+            if queued_conv == conv:
+                # moved to the end so later messages for other conversations never have an older user_v
+                del self.messages[i]
+                self.messages.append((conv, merge_messages(queued_msg, msg)))
+                self.background.stats['merged'] += 1
+                return
+
+        self.background.stats['overflow'] += 1
+        logger.warning('websocket queue full (user id %d), closing', self.user_id)
+        self.closing = True
+        self.task.cancel()
+        self.background.loop.create_task(self._close())
+
+    async def _writer(self):
+        send_timeout = self.background.settings.ws_send_timeout
+        try:
+            while True:
+                await self.ready.wait()
+                while self.messages:
+                    _, msg = self.messages.popleft()
+                    await asyncio.wait_for(self.ws.send_str(msg), timeout=send_timeout)
+                self.ready.clear()
+        except asyncio.TimeoutError:
+            self.background.stats['timeout'] += 1
+            logger.warning('websocket send timed out (user id %d), closing', self.user_id)
+            await self._close()
+        except (RuntimeError, AttributeError):
+            logger.info('websocket "%s" closed (user id %d), removing', self.ws, self.user_id)
+            await self.background.remove_ws(self.user_id, self.ws)
+
+    async def _close(self):
+        self.closing = True
+        await self.background.remove_ws(self.user_id, self.ws)
+        try:
+            await asyncio.wait_for(
+                self.ws.close(code=slow_close_code), timeout=self.background.settings.ws_send_timeout
+            )
+        except (asyncio.TimeoutError, RuntimeError, AttributeError):
+            pass
+
+
+def merge_messages(old: str, new: str) -> str:
+    """
+    Merge two messages for the same conversation, actions are combined and everything else is from the newer message.
+    """
+    old_data, new_data = ujson.loads(old), ujson.loads(new)
+    new_data['actions'] = old_data['actions'] + new_data['actions']
+    return ujson.dumps(new_data)
 
 
 class Background:
+    """
+    Sends actions to the websockets connected to this process. Each process has its own channel and records which
+    users it has websockets for in redis so actions are only published to processes with recipients connected.
+    """
+
     def __init__(self, app: Application):
         self.app = app
         self.settings: Settings = app['settings']
         self.connections: Dict[int, List[WebSocketResponse]] = {}
+        # live messages held for websockets while missed events are replayed, see replay()
+        self.replaying: Dict[WebSocketResponse, List[Tuple[str, Optional[str], str]]] = {}
+        self.queues: Dict[WebSocketResponse, WsQueue] = {}
+        # keys are "merged", "overflow" and "timeout", see metrics()
+        self.stats = Counter()
+        self.node_id = uuid4().hex
         self.loop = asyncio.get_event_loop()
         self.loop.create_task(self._run())
+        self.loop.create_task(self._heartbeat())
         self.conns = Connections(self.app['pg'], self.app['redis'], self.settings)
 
-    def add_ws(self, user_id: int, ws: WebSocketResponse):
+    async def add_ws(self, user_id: int, ws: WebSocketResponse, *, replay: bool = False):
+        """
+        Add a websocket to send actions to, with replay messages are held until replay() is called.
+
+        Presence is recorded after the websocket is added so no actions published to this node are missed.
+        """
+        if replay:
+            self.replaying[ws] = []
+        self.queues[ws] = WsQueue(self, user_id, ws)
         if user_id in self.connections:
             self.connections[user_id].append(ws)
         else:
             self.connections[user_id] = [ws]
-
-    def remove_ws(self, user_id: int, ws: WebSocketResponse):
-        wss = self.connections[user_id]
+            await set_presence(self.conns.redis, self.node_id, [user_id], self.settings.ws_replay_ttl)
+
+    async def remove_ws(self, user_id: int, ws: WebSocketResponse):
+        self.replaying.pop(ws, None)
+        queue = self.queues.pop(ws, None)
+        if queue and queue.task is not asyncio.current_task():
+            queue.task.cancel()
+        wss = self.connections.get(user_id)
+        if wss is None or ws not in wss:
+            return
         wss.remove(ws)
         if not wss:
             self.connections.pop(user_id)
+            await remove_presence(self.conns.redis, self.node_id, user_id, self.settings.ws_replay_ttl)
+            if user_id in self.connections:
+                # the user reconnected while presence was being removed, the set and remove may have run in
+                # either order
+                await set_presence(self.conns.redis, self.node_id, [user_id], self.settings.ws_replay_ttl)
+
+    async def replay(self, user_id: int, ws: WebSocketResponse, last_event_id: str):
+        """
+        Queue the user's events after last_event_id, or "resync" if they're no longer available, then live
+        messages held while replaying. Messages go through the websocket's WsQueue so a slow client is merged or
+        closed as with live messages.
+        """
+        last_sent = last_event_id
+        try:
+            queue = self.queues.get(ws)
+            if queue is None:
+                # the websocket has already been removed
+                return
+            events = await get_user_events(self.conns.redis, user_id, last_event_id)
+            if events is None:
+                queue.put('', ujson.dumps({'resync': True}))
+                last_sent = None
+            elif events:
+                flags = (await get_many_flag_counts(self.conns, [user_id]))[user_id]
+                for event_id, fields in events:
+                    participant = ujson.loads(fields['participant'])
+                    participant.update(event_id=event_id, flags=flags)
+                    conv = ujson.loads(fields['event'])['conversation']
+                    queue.put(conv, fields['event'][:-1] + ',' + ujson.dumps(participant)[1:])
+                    last_sent = event_id
+
+            held = self.replaying.get(ws, [])
+            while held:
+                conv, event_id, msg = held.pop(0)
+                if last_sent is None or event_id is None or _event_id_key(event_id) > _event_id_key(last_sent):
+                    queue.put(conv, msg)
+        finally:
+            self.replaying.pop(ws, None)
 
     async def _run(self):
-        logger.info('starting background task')
+        logger.info('starting background task, node %s', self.node_id)
         try:
             with await self.app['redis'] as self.redis:
-                channel, *_ = await self.redis.psubscribe(channel_name(self.redis))
+                channel, *_ = await self.redis.subscribe(channel_name(self.redis, self.node_id))
                 while await channel.wait_message():
-                    _, msg = await channel.get()
+                    msg = await channel.get()
                     await self.process_action(msg)
         except CancelledError:
             # happens, not a problem
@@ -55,127 +217,292 @@ class Background:
     async def process_action(self, msg: bytes):
         if self.connections:
             data = ujson.loads(msg)
-            coros = []
-            participants = data.pop('participants')
+            participants = [p for p in data.pop('participants') if p['user_id'] in self.connections]
+            if not participants:
+                return
             # hack to avoid building json for every user, remove the ending "}" so extra json can be appended
             msg_json_chunk = ujson.dumps(data)[:-1]
+            flags = await get_many_flag_counts(self.conns, [p['user_id'] for p in participants])
             for p in participants:
                 user_id = p['user_id']
                 wss = self.connections.get(user_id)
                 if wss is not None:
-                    coros.append(self.send(user_id, p, wss, msg_json_chunk))
-
-            await asyncio.gather(*coros)
+                    p['flags'] = flags[user_id]
+                    self.send(data['conversation'], p, wss, msg_json_chunk)
 
-    async def send(self, user_id: int, participant: dict, wss: List[WebSocketResponse], msg_json_chunk: str):
-        participant['flags'] = await get_flag_counts(self.conns, user_id)
+    def send(self, conv: str, participant: dict, wss: List[WebSocketResponse], msg_json_chunk: str):
         msg = msg_json_chunk + ',' + ujson.dumps(participant)[1:]
         for ws in wss:
-            try:
-                await ws.send_str(msg)
-            except (RuntimeError, AttributeError):
-                logger.info('websocket "%s" closed (user id %d), removing', ws, user_id)
-                self.remove_ws(user_id, ws)
+            held = self.replaying.get(ws)
+            if held is not None:
+                held.append((conv, participant.get('event_id'), msg))
+            else:
+                self.queues[ws].put(conv, msg)
+
+    def metrics(self) -> Dict[str, int]:
+        """
+        Websocket queue depths and counts of merged messages and websockets closed for being too slow.
+        """
+        depths = [len(q.messages) for q in self.queues.values()]
+        return {
+            'websockets': len(depths),
+            'queued': sum(depths),
+            'max_queue_depth': max(depths, default=0),
+            **self.stats,
+        }
+
+    async def _heartbeat(self):
+        """
+        Refresh presence for all connected users so entries of nodes which have stopped are ignored.
+        """
+        try:
+            while True:
+                await asyncio.sleep(presence_interval)
+                if self.connections:
+                    await set_presence(
+                        self.conns.redis, self.node_id, list(self.connections), self.settings.ws_replay_ttl
+                    )
+        except CancelledError:
+            # happens, not a problem
+            pass
+        except Exception as exc:
+            logger.exception('exception in presence heartbeat, %s: %s', exc.__class__.__name__, exc)
+            raise
+
+
+def _user_events_key(user_id: int) -> str:
+    return f'ws-events-{user_id}'
+
+
+re_event_id = re.compile(r'\d+-\d+')
 
 
-def channel_name(redis: ArqRedis):
-    return f'actions-{redis.db}'
+def _event_id_key(event_id: str) -> Tuple[int, int]:
+    ms, seq = event_id.split('-')
+    return int(ms), int(seq)
+
+
+def _user_recent_key(user_id: int) -> str:
+    return f'ws-recent-{user_id}'
+
+
+# KEYS are each user's recent key followed by their events key, ARGV[1] is the max. stream length, ARGV[2] the
+# event and ARGV[3...] each user's participant. Streams expire with the recent key so a client can't replay
+# across a gap when events weren't recorded, get_user_events() finds last_event_id is missing and they resync.
+_add_user_events_lua = """
+local event_ids = {}
+for i = 1, #KEYS, 2 do
+  local ttl = redis.call('pttl', KEYS[i])
+  if ttl > 0 then
+    local participant = ARGV[2 + (i + 1) / 2]
+    event_ids[#event_ids + 1] = redis.call(
+      'xadd', KEYS[i + 1], 'maxlen', ARGV[1], '*', 'event', ARGV[2], 'participant', participant
+    )
+    redis.call('pexpire', KEYS[i + 1], ttl)
+  else
+    event_ids[#event_ids + 1] = false
+  end
+end
+return event_ids
+"""
+
+
+async def add_user_events(conns: Connections, event: str, participants: List[Dict[str, Any]]):
+    """
+    Add the event to the stream of recent events of each participant who's had a websocket within
+    settings.ws_replay_ttl, see set_presence(), and set "event_id" on those participants.
+    """
+    keys = []
+    for p in participants:
+        keys += _user_recent_key(p['user_id']), _user_events_key(p['user_id'])
+    args = [conns.settings.ws_replay_events, event, *(ujson.dumps(p) for p in participants)]
+    event_ids = await conns.redis.eval(_add_user_events_lua, keys=keys, args=args)
+    for p, event_id in zip(participants, event_ids):
+        if event_id:
+            p['event_id'] = event_id
+
+
+async def get_user_events(redis: ArqRedis, user_id: int, last_event_id: str) -> Optional[List[Tuple[str, dict]]]:
+    """
+    Get the user's events after last_event_id, None if last_event_id has been trimmed from the stream
+    so events may have been missed.
+    """
+    if not re_event_id.fullmatch(last_event_id):
+        return None
+    events = await redis.xrange(_user_events_key(user_id), start=last_event_id)
+    if not events or events[0][0] != last_event_id:
+        return None
+    return events[1:]
+
+
+def channel_name(redis: ArqRedis, node_id: str):
+    return f'actions-{redis.db}-{node_id}'
+
+
+# presence of each user is a sorted set of node ids scored by when the node last confirmed it has websockets
+# for the user, entries not refreshed within presence_ttl are ignored
+presence_interval = 30
+presence_ttl = presence_interval * 3
+
+
+def _presence_key(user_id: int) -> str:
+    return f'ws-presence-{user_id}'
+
+
+async def set_presence(redis: ArqRedis, node_id: str, user_ids: Iterable[int], replay_ttl: int):
+    """
+    Record that the node has websockets for the users, also marks them as recently connected for replay_ttl so
+    add_user_events() records their events.
+    """
+    now = time()
+    tr = redis.pipeline()
+    for user_id in user_ids:
+        key = _presence_key(user_id)
+        tr.zadd(key, now, node_id)
+        tr.zremrangebyscore(key, max=now - presence_ttl)
+        tr.expire(key, presence_ttl)
+        tr.setex(_user_recent_key(user_id), replay_ttl, 1)
+    await tr.execute()
+
+
+async def remove_presence(redis: ArqRedis, node_id: str, user_id: int, replay_ttl: int):
+    """
+    Remove the node from the user's presence, events are recorded for another replay_ttl so the user can replay
+    them when they reconnect.
+    """
+    tr = redis.pipeline()
+    tr.zrem(_presence_key(user_id), node_id)
+    tr.setex(_user_recent_key(user_id), replay_ttl, 1)
+    await tr.execute()
+
+
+async def get_presence_nodes(redis: ArqRedis, user_ids: List[int]) -> Set[str]:
+    """
+    Find the nodes with websockets for any of the users.
+    """
+    if not user_ids:
+        return set()
+    tr = redis.pipeline()
+    min_score = time() - presence_ttl
+    user_nodes = [tr.zrangebyscore(_presence_key(user_id), min=min_score) for user_id in user_ids]
+    await tr.execute()
+    return {node_id for nodes in user_nodes for node_id in await nodes}
 
 
 local_users_sql = """
 select json_build_object(
-  'participants', participants,
-  'conv_details', conv_details
+  'participants', (
+    select array_to_json(array_agg(json_strip_nulls(row_to_json(t))))
+    from (
+      select user_id, spam, label_ids as labels from participants where conv=$1 and user_id=any($2) order by id
+    ) t
+  ),
+  'conv_details', (select details from conversations where id=$1)
 )
-from (
-  select array_to_json(array_agg(json_strip_nulls(row_to_json(t)))) as participants
-  from (
-    select p.user_id, p.spam, p.label_ids as labels, u.v user_v, u.email user_email
-    from participants as p
-    join conversations as c on p.conv = c.id
-    join users as u on p.user_id = u.id
-    where conv=$1
-      and (c.publish_ts is not null or p.user_id=c.creator)
-      and (u.user_type = 'new' or u.user_type = 'local')
-  ) as t
-) as participants,
-(
-  select details as conv_details from conversations where id=$1
-) as conv_details
 """
+local_user_types = {UserTypes.new, UserTypes.local}
 
 
-async def _push_local(conns: Connections, conv_id: int, actions_data: str, interaction_id: Optional[str]):
-    extra = await conns.main.fetchval(local_users_sql, conv_id)
+async def _push_local(
+    conns: Connections, conv_id: int, recipients: Recipients, actions_data: str, interaction_id: Optional[str]
+):
+    local_users = {user_id: email for user_id, email, user_type in recipients.users if user_type in local_user_types}
+    extra = ujson.loads(await conns.main.fetchval(local_users_sql, conv_id, list(local_users)))
+    if extra['participants']:
+        users_v = await get_users_v(conns, [p['user_id'] for p in extra['participants']])
+        for p in extra['participants']:
+            p['user_email'] = local_users[p['user_id']]
+            if users_v[p['user_id']] is not None:
+                p['user_v'] = users_v[p['user_id']]
     extra_json = f',"interaction": "{interaction_id}",' if interaction_id else ','
+    user_ids = [p['user_id'] for p in extra['participants'] or []]
+    if user_ids:
+        # events are recorded so clients can replay events missed while reconnecting
+        event = actions_data[:-1] + extra_json + ujson.dumps({'conv_details': extra['conv_details']})[1:]
+        await add_user_events(conns, event, extra['participants'])
+    extra = ujson.dumps(extra)
     actions_data_extra = actions_data[:-1] + extra_json + extra[1:]
-    await conns.redis.publish(channel_name(conns.redis), actions_data_extra)
+    # only publish to nodes with websockets for participants
+    nodes = await get_presence_nodes(conns.redis, user_ids)
+    if nodes:
+        tr = conns.redis.pipeline()
+        for node_id in nodes:
+            tr.publish(channel_name(conns.redis, node_id), actions_data_extra)
+        await tr.execute()
     await conns.redis.enqueue_job('web_push', actions_data_extra)
 
 
-remote_users_sql = """
-select u.email, u.user_type
-from participants as p
-join conversations as c on p.conv = c.id
-join users as u on p.user_id = u.id
-where conv=$1 and c.publish_ts is not null and u.user_type != 'local'
-"""
-
-
-async def _push_remote(conns: Connections, conv_id: int, actions_data: str, **extra: Any):
-    remote_users = [tuple(r) for r in await conns.main.fetch(remote_users_sql, conv_id)]
-    if remote_users:
-        await conns.redis.enqueue_job('push_actions', actions_data, remote_users, **extra)
+async def _push_remote(conns: Connections, recipients: Recipients, actions_data: str, **extra: Any):
+    if recipients.published:
+        remote_users = [(email, user_type) for _, email, user_type in recipients.users if user_type != UserTypes.local]
+        if remote_users:
+            await conns.redis.enqueue_job('push_actions', actions_data, remote_users, **extra)
+
+
+push_actions_cache = ActionsJsonCache(
+    'push',
+    """
+    select t.id, json_strip_nulls(row_to_json(t))::text
+    from (
+      select a.id, a.act, actor_user.email actor,
+      -- use this exact formatting so actions_to_body always creates the exact same thing
+      to_char(a.ts at time zone 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"') ts,
+      left(a.body, 1024) body,
+      case when a.body is null then null else length(a.body) > 1024 end extra_body,
+      a.msg_format, a.warnings,
+      prt_user.email participant, follows_action.id follows, parent_action.id parent,
+      (select array_agg(row_to_json(f))
+        from (
+          select content_disp, hash, content_id, name, content_type, size
+          from files
+          where files.action = a.pk
+          order by content_id  -- TODO only used in tests I think, could be removed
+        ) f
+      ) as files
+      from actions as a
+
+      join users as actor_user on a.actor = actor_user.id
+
+      left join users as prt_user on a.participant_user = prt_user.id
+      left join actions as follows_action on a.follows = follows_action.pk
+      left join actions as parent_action on a.parent = parent_action.pk
+      where a.conv=$1 and a.id=any($2)
+    ) as t
+    """,
+)
 
 
-push_sql_template = """
-select json_build_object(
-  'actions', actions,
-  'conversation', conversation
-)
-from (
-  select array_to_json(array_agg(json_strip_nulls(row_to_json(t)))) as actions
-  from (
-    select a.id, a.act, actor_user.email actor,
-    -- use this exact formatting so actions_to_body always creates the exact same thing
-    to_char(a.ts at time zone 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"Z"') ts,
-    left(a.body, 1024) body,
-    case when a.body is null then null else length(a.body) > 1024 end extra_body,
-    a.msg_format, a.warnings,
-    prt_user.email participant, follows_action.id follows, parent_action.id parent,
-    (select array_agg(row_to_json(f))
-      from (
-        select content_disp, hash, content_id, name, content_type, size
-        from files
-        where files.action = a.pk
-        order by content_id  -- TODO only used in tests I think, could be removed
-      ) f
-    ) as files
-    from actions as a
-
-    join users as actor_user on a.actor = actor_user.id
-    join conversations as c on a.conv = c.id
-
-    left join users as prt_user on a.participant_user = prt_user.id
-    left join actions as follows_action on a.follows = follows_action.pk
-    left join actions as parent_action on a.parent = parent_action.pk
-    {}
-  ) as t
-) actions, (
-  select key conversation from conversations where id=$1
-) conversation
-"""
+async def get_actions_data(conns: Connections, conv_id: int, action_ids: List[int] = None) -> str:
+    """
+    Build the JSON object of actions and conversation key which is pushed, the actions are joined from
+    push_actions_cache. em2.protocol.push relies on this exact format to avoid parsing it.
 
-push_sql_all = push_sql_template.format('where a.conv=$1 order by a.id')
-push_sql_multiple = push_sql_template.format('where a.conv=$1 and a.id=any($2)')
+    :param conns: connections
+    :param conv_id: conversation id
+    :param action_ids: ids of actions to include, by default all actions
+    """
+    if action_ids is not None:
+        conv_key = await conns.main.fetchval('select key from conversations where id=$1', conv_id)
+        action_ids = sorted(action_ids)
+    else:
+        conv_key, action_ids = await conns.main.fetchrow(
+            """
+            select key, (select array_agg(id order by id) from actions where conv=$1)
+            from conversations where id=$1
+            """,
+            conv_id,
+        )
+    actions_json = ','.join(await push_actions_cache.get(conns, conv_id, action_ids))
+    return '{"actions":[' + actions_json + '],"conversation":' + ujson.dumps(conv_key) + '}'
 
 
 async def push_all(conns: Connections, conv_id: int, *, transmit=True, **extra: Any):
     # FIXME: rename these to notify*?
-    actions_data = await conns.main.fetchval(push_sql_all, conv_id)
-    await _push_local(conns, conv_id, actions_data, None)
+    actions_data = await get_actions_data(conns, conv_id)
+    recipients = await recipients_cache.get(conns, conv_id)
+    await _push_local(conns, conv_id, recipients, actions_data, None)
     if transmit:
-        await _push_remote(conns, conv_id, actions_data, **extra)
+        await _push_remote(conns, recipients, actions_data, **extra)
 
 
 async def push_multiple(
@@ -187,12 +514,13 @@ async def push_multiple(
     interaction_id: str = None,
     **extra: Any,
 ):
-    actions_data = await conns.main.fetchval(push_sql_multiple, conv_id, action_ids)
-    await _push_local(conns, conv_id, actions_data, interaction_id)
+    actions_data = await get_actions_data(conns, conv_id, action_ids)
+    recipients = await recipients_cache.get(conns, conv_id)
+    await _push_local(conns, conv_id, recipients, actions_data, interaction_id)
     if transmit:
         if interaction_id:
             extra['interaction_id'] = interaction_id
-        await _push_remote(conns, conv_id, actions_data, **extra)
+        await _push_remote(conns, recipients, actions_data, **extra)
 
 
 async def user_actions_with_files(
@@ -217,8 +545,56 @@ async def user_actions(conns: Connections, conv: ConvSummary, actions: List[Acti
         await conns.redis.enqueue_job('follower_push_actions', conv.key, conv.leader, interaction_id, actions)
         await add_contacts(conns, conv.id, actions[0].actor_id)
     else:
-        action_ids = await apply_actions(conns, conv.id, actions)
+        action_ids = await apply_actions(conns, conv.id, actions, batch=True)
 
         if action_ids:
             await push_multiple(conns, conv.id, action_ids, interaction_id=interaction_id)
             await add_contacts(conns, conv.id, actions[0].actor_id)
+
+
+async def flush_user_versions(ctx):
+    """
+    Write user versions from redis to users.v for users whose version has changed since the last flush,
+    see update_conv_users() for what's lost if redis loses versions before they're flushed.
+    """
+    redis: ArqRedis = ctx['redis']
+    tr = redis.multi_exec()
+    user_ids = tr.smembers(user_v_dirty_key)
+    tr.delete(user_v_dirty_key)
+    await tr.execute()
+    user_ids = [int(u_id) for u_id in await user_ids]
+    if not user_ids:
+        return 0
+
+    vs = [int(v) for v in await redis.hmget(user_v_key, *user_ids)]
+    await ctx['pg'].execute(
+        """
+        update users u set v=greatest(u.v, t.v)
+        from (select unnest($1::bigint[]) id, unnest($2::bigint[]) v) t
+        where u.id = t.id
+        """,
+        user_ids,
+        vs,
+    )
+    return len(user_ids)
+
+
+async def reconcile_all_flag_counts(ctx):
+    """
+    Recount user_flag_counts for every user with counts to correct any drift.
+    """
+    pg = ctx['pg']
+    user_id, drifted = 0, 0
+    while True:
+        user_ids = await pg.fetch(
+            'select user_id from user_flag_counts where user_id > $1 order by user_id limit 100', user_id
+        )
+        if not user_ids:
+            break
+        async with pg.acquire() as conn:
+            conns = Connections(conn, ctx['redis'], ctx['settings'])
+            for (user_id,) in user_ids:
+                drifted += await reconcile_flag_counts(conns, user_id)
+    if drifted:
+        logger.warning('%d users with drifted flag counts', drifted)
+    return drifted
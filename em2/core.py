@@ -1,14 +1,15 @@
-import asyncio
 import hashlib
 import json
 import secrets
+from collections import Counter, OrderedDict
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum, unique
-from typing import AbstractSet, Any, Dict, Iterable, List, Optional, Set, Tuple, Union
+from itertools import chain
+from typing import AbstractSet, Any, AsyncIterator, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple, Union
 
 from atoolbox import JsonErrors
-from buildpg import MultipleValues, V, Values
+from buildpg import Func, MultipleValues, V, Values
 
 from .search import search_create_conv, search_update
 from .utils.core import MsgFormat, message_preview
@@ -116,58 +117,314 @@ class ConvSummary:
     last_action: Optional[int]
 
 
+class ConvRefCache:
+    """
+    Two level cache (in-process LRU then redis) of (user_id, conversation key prefix) to the row used to build
+    ConvSummary.
+
+    Entries are stored against a per-user generation number held in redis, clear() increments the generation which
+    invalidates every entry for those users. Local entries are also keyed by redis db so separate nodes can
+    share a process in tests. Since the generation is read before querying the database, a value from
+    a query which raced with an invalidation is stored against the old generation and never used.
+    """
+
+    def __init__(self, max_size: int = 4096, ttl: int = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._local: 'OrderedDict[Tuple[int, int, str], Tuple[int, tuple]]' = OrderedDict()
+        # hits and misses, keys are "local_hit", "redis_hit" and "miss"
+        self.stats = Counter()
+
+    @staticmethod
+    def _gen_key(user_id: int) -> str:
+        return f'conv-ref-gen-{user_id}'
+
+    async def get(self, redis, user_id: int, conv_ref: str) -> Tuple[int, Optional[tuple]]:
+        """
+        :return: generation, which should be passed to set(), and the cached row or None
+        """
+        gen = int(await redis.get(self._gen_key(user_id)) or 0)
+        local_key = redis.db, user_id, conv_ref
+        local = self._local.get(local_key)
+        if local and local[0] == gen:
+            self._local.move_to_end(local_key)
+            self.stats['local_hit'] += 1
+            return gen, local[1]
+
+        row_json = await redis.get(f'conv-ref-{user_id}-{gen}-{conv_ref}')
+        if row_json:
+            self.stats['redis_hit'] += 1
+            conv_id, conv_key, publish_ts, leader, creator, last_action = json.loads(row_json)
+            row = conv_id, conv_key, publish_ts and datetime.fromisoformat(publish_ts), leader, creator, last_action
+            self._set_local(local_key, gen, row)
+            return gen, row
+
+        self.stats['miss'] += 1
+        return gen, None
+
+    async def set(self, redis, user_id: int, conv_ref: str, gen: int, row: tuple):
+        conv_id, conv_key, publish_ts, leader, creator, last_action = row
+        row_json = json.dumps([conv_id, conv_key, publish_ts and publish_ts.isoformat(), leader, creator, last_action])
+        await redis.setex(f'conv-ref-{user_id}-{gen}-{conv_ref}', self.ttl, row_json)
+        self._set_local((redis.db, user_id, conv_ref), gen, row)
+
+    def _set_local(self, local_key: Tuple[int, int, str], gen: int, row: tuple):
+        self._local[local_key] = gen, row
+        self._local.move_to_end(local_key)
+        if len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    async def clear(self, redis, user_ids: Iterable[int]):
+        """
+        Invalidate cached references for users, must be called whenever a user is added to or removed from
+        a conversation or a conversation's key or publish_ts changes.
+        """
+        tr = redis.multi_exec()
+        for user_id in user_ids:
+            tr.incr(self._gen_key(user_id))
+        await tr.execute()
+
+    def reset(self):
+        """
+        Clear the in-process cache and stats, redis should be flushed at the same time.
+        """
+        self._local.clear()
+        self.stats.clear()
+
+
+conv_ref_cache = ConvRefCache()
+
+
+class Recipients(NamedTuple):
+    published: bool
+    # user id, email and user type of participants who can see the conversation
+    users: List[Tuple[int, str, str]]
+
+
+recipients_sql = """
+select c.publish_ts is not null, array_agg(array[u.id::text, u.email, u.user_type::text] order by p.id)
+from participants p
+join conversations c on p.conv = c.id
+join users u on p.user_id = u.id
+where p.conv = $1 and (c.publish_ts is not null or p.user_id = c.creator)
+group by c.publish_ts
+"""
+
+
+class RecipientsCache:
+    """
+    Redis cache of who actions on a conversation are pushed to.
+
+    Each conversation has a hash holding a generation and the recipients, clear() increments the generation and
+    deletes the recipients, set only succeeds if the generation hasn't changed since get so a value from a query
+    which raced with an invalidation is never stored.
+    """
+
+    _set_lua = """
+    if (redis.call('hget', KEYS[1], 'gen') or '0') == ARGV[1] then
+      redis.call('hset', KEYS[1], 'recipients', ARGV[2])
+      redis.call('expire', KEYS[1], ARGV[3])
+    end
+    """
+
+    def __init__(self, ttl: int = 86400):
+        self.ttl = ttl
+        # keys are "hit" and "miss"
+        self.stats = Counter()
+
+    @staticmethod
+    def _key(conv_id: int) -> str:
+        return f'conv-recipients-{conv_id}'
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.stats['hit'] + self.stats['miss']
+        return self.stats['hit'] / total if total else None
+
+    async def get(self, conns: Connections, conv_id: int) -> Recipients:
+        key = self._key(conv_id)
+        gen, recipients_json = await conns.redis.hmget(key, 'gen', 'recipients')
+        if recipients_json:
+            self.stats['hit'] += 1
+            published, users = json.loads(recipients_json)
+            return Recipients(published, [tuple(u) for u in users])
+
+        self.stats['miss'] += 1
+        r = await conns.main.fetchrow(recipients_sql, conv_id)
+        recipients = Recipients(r[0], [(int(u[0]), u[1], u[2]) for u in r[1]]) if r else Recipients(False, [])
+        await conns.redis.eval(self._set_lua, keys=[key], args=[gen or '0', json.dumps(recipients), self.ttl])
+        return recipients
+
+    async def clear(self, redis, conv_ids: Iterable[int]):
+        """
+        Invalidate recipients of conversations, must be called whenever a user is added to or removed from
+        a conversation, a conversation is published or a participant's user_type changes.
+        """
+        tr = redis.multi_exec()
+        for conv_id in conv_ids:
+            key = self._key(conv_id)
+            tr.hincrby(key, 'gen', 1)
+            tr.hdel(key, 'recipients')
+            tr.expire(key, self.ttl)
+        await tr.execute()
+
+    async def clear_user(self, conn, redis, email: str):
+        """
+        Invalidate recipients of all the user's conversations, used when the user's type changes.
+        """
+        conv_ids = await conn.fetchval(
+            'select array_agg(p.conv) from participants p join users u on p.user_id = u.id where u.email=$1', email
+        )
+        if conv_ids:
+            await self.clear(redis, conv_ids)
+
+    def reset(self):
+        """
+        Clear stats, redis should be flushed at the same time.
+        """
+        self.stats.clear()
+
+
+recipients_cache = RecipientsCache()
+
+
 async def get_conv_for_user(conns: Connections, user_id: int, conv_ref: StrInt) -> ConvSummary:
     """
     :param conns: connections
     :param user_id: ID of the user
-    :param conv_ref: conversation id or key prefix
+    :param conv_ref: conversation id or key prefix, key prefixes are cached in conv_ref_cache, ids are not
+        since they're used when acting on conversations where the result must be current
     :return: ConvSummary
     """
     if isinstance(conv_ref, int):
-        query = conns.main.fetchrow(
-            """
-            select c.id, c.key, c.publish_ts, c.leader_node, c.creator, p.removal_action_id from conversations as c
-            join participants p on c.id=p.conv
-            where c.live is true and p.user_id = $1 and c.id = $2
-            order by c.created_ts desc
-            """,
-            user_id,
-            conv_ref,
+        row = await or404(
+            conns.main.fetchrow(
+                """
+                select c.id, c.key, c.publish_ts, c.leader_node, c.creator, p.removal_action_id
+                from conversations as c
+                join participants p on c.id=p.conv
+                where c.live is true and p.user_id = $1 and c.id = $2
+                order by c.created_ts desc
+                """,
+                user_id,
+                conv_ref,
+            ),
+            msg='Conversation not found',
         )
     else:
-        query = conns.main.fetchrow(
-            """
-            select c.id, c.key, c.publish_ts, c.leader_node, c.creator, p.removal_action_id from conversations c
-            join participants p on c.id=p.conv
-            where c.live is true and p.user_id=$1 and c.key like $2
-            order by c.created_ts desc
-            limit 1
-            """,
-            user_id,
-            conv_ref + '%',
-        )
-
-    # TODO we should use a custom error here, not just 404: Conversation not found
-    conv_id, conv_key, publish_ts, leader, creator, last_action = await or404(query, msg='Conversation not found')
+        gen, row = await conv_ref_cache.get(conns.redis, user_id, conv_ref)
+        if row is None:
+            # TODO we should use a custom error here, not just 404: Conversation not found
+            row = await or404(
+                conns.main.fetchrow(
+                    """
+                    select c.id, c.key, c.publish_ts, c.leader_node, c.creator, p.removal_action_id
+                    from conversations c
+                    join participants p on c.id=p.conv
+                    where c.live is true and p.user_id=$1 and c.key like $2
+                    order by c.created_ts desc
+                    limit 1
+                    """,
+                    user_id,
+                    conv_ref + '%',
+                ),
+                msg='Conversation not found',
+            )
+            row = tuple(row)
+            await conv_ref_cache.set(conns.redis, user_id, conv_ref, gen, row)
 
+    conv_id, conv_key, publish_ts, leader, creator, last_action = row
     if not publish_ts and user_id != creator:
         raise JsonErrors.HTTPForbidden('conversation is unpublished and you are not the creator')
     return ConvSummary(conv_id, conv_key, publish_ts, leader, last_action)
 
 
+user_v_key = 'user-v'
+user_v_dirty_key = 'user-v-dirty'
+
+
+async def clear_conv_caches(conns: Connections, conv_id: int):
+    """
+    Invalidate conv_ref_cache and recipients_cache after participants of a conversation have changed.
+
+    Must be called once the change has committed, otherwise other connections can cache the old participants
+    against the new generation, see apply_actions(clear_caches=False).
+    """
+    user_ids = await conns.main.fetchval(
+        """
+        select array_agg(u.id) from participants p
+        join users u on p.user_id = u.id
+        where p.conv = $1 and u.user_type = 'local'
+        """,
+        conv_id,
+    )
+    if user_ids:
+        await conv_ref_cache.clear(conns.redis, user_ids)
+    await recipients_cache.clear(conns.redis, [conv_id])
+
+
 async def update_conv_users(conns: Connections, conv_id: int) -> List[int]:
     """
-    Update v on users participating in a conversation
+    Increment v on local users participating in a conversation.
+
+    Versions are incremented in a redis hash and written to users.v in batches by flush_user_versions,
+    this avoids updating the same users rows on every action.
+
+    The hash has no expiry but if redis loses it (a flush or failover without persistence) increments made since
+    the last flush, at most 10 seconds of them, are lost: users are re-seeded from users.v so v can go back by that
+    many increments and clients which saw the higher v won't see a change until v passes it again.
     """
-    v = await conns.main.fetch(
+    users = await conns.main.fetch(
         """
-        update users set v=v + 1 from participants
-        where participants.user_id = users.id and participants.conv = $1 and users.user_type = 'local'
-        returning participants.user_id
+        select u.id, u.v from participants p
+        join users u on p.user_id = u.id
+        where p.conv = $1 and u.user_type = 'local'
         """,
         conv_id,
     )
-    return [r[0] for r in v]
+    user_ids = [r[0] for r in users]
+    if user_ids:
+        tr = conns.redis.multi_exec()
+        for user_id, v in users:
+            # users.v is never ahead of redis, so it's only used if the user isn't in the hash yet
+            tr.hsetnx(user_v_key, user_id, v)
+            tr.hincrby(user_v_key, user_id, 1)
+        tr.sadd(user_v_dirty_key, *user_ids)
+        await tr.execute()
+    return user_ids
+
+
+# ARGV holds user id, v pairs, each user's v in KEYS[1] is set to the greater of v and the current value which is
+# returned, so a seed from users.v never moves v backwards if update_conv_users() incremented it concurrently
+_seed_users_v_lua = """
+local vs = {}
+for i = 1, #ARGV, 2 do
+  local v = tonumber(redis.call('hget', KEYS[1], ARGV[i]) or '0')
+  if tonumber(ARGV[i + 1]) > v then
+    v = tonumber(ARGV[i + 1])
+    redis.call('hset', KEYS[1], ARGV[i], v)
+  end
+  vs[#vs + 1] = v
+end
+return vs
+"""
+
+
+async def get_users_v(conns: Connections, user_ids: List[int]) -> Dict[int, Optional[int]]:
+    """
+    Get v for users from redis, users missing from redis are seeded with users.v, see update_conv_users().
+    """
+    if not user_ids:
+        return {}
+    vs = dict(zip(user_ids, await conns.redis.hmget(user_v_key, *user_ids)))
+    missing = [u_id for u_id, v in vs.items() if v is None]
+    if missing:
+        rows = await conns.main.fetch('select id, v from users where id=any($1) and v is not null', missing)
+        if rows:
+            args = [a for r in rows for a in r]
+            seeded = await conns.redis.eval(_seed_users_v_lua, keys=[user_v_key], args=args)
+            vs.update(zip([r[0] for r in rows], seeded))
+    return {u_id: v and int(v) for u_id, v in vs.items()}
 
 
 participant_action_types = {a for a in ActionTypes if a.value.startswith('participant:')}
@@ -188,6 +445,11 @@ _meta_action_types = {
 }
 max_participants = 64
 with_body_actions = {ActionTypes.msg_add, ActionTypes.msg_modify, ActionTypes.subject_modify}
+# actions which only need lookups on existing actions, these can be checked and inserted together by _Act.run_batch
+_batch_action_types = _msg_action_types | _subject_action_types
+_subject_follow_types = _subject_action_types | {ActionTypes.conv_create, ActionTypes.conv_publish}
+_preview_action_types = {ActionTypes.msg_add, ActionTypes.msg_modify}
+_allocate_pks_sql = "select nextval('actions_pk_seq') from generate_series(1, $1)"
 
 
 @dataclass
@@ -218,12 +480,25 @@ class Action:
     files: List[File] = None
 
 
+@dataclass
+class _ActionRef:
+    """
+    An action which may be followed or used as a parent by actions in a batch, see _Act.run_batch.
+    """
+
+    pk: int
+    act: ActionTypes
+    actor: int
+    age: int
+    followed: bool
+
+
 class _Act:
     """
     See act() below for details.
     """
 
-    __slots__ = 'conns', 'conv_id', 'spam', 'warnings', 'new_user_ids'
+    __slots__ = 'conns', 'conv_id', 'spam', 'warnings', 'new_user_ids', 'last_action_id'
 
     def __init__(self, conns: Connections, conv_id: int, spam: bool, warnings: Dict[str, str]):
         self.conns = conns
@@ -232,14 +507,15 @@ class _Act:
         self.warnings = json.dumps(warnings) if warnings else None  # FIXME moved to action
         # ugly way of doing this, but less ugly than other approaches
         self.new_user_ids: Set[int] = set()
+        self.last_action_id: Optional[int] = None
 
     async def prepare(self, actor_id: int) -> Tuple[int, int, int]:
         c = await get_conv_for_user(self.conns, actor_id, self.conv_id)
 
         # we must be in a transaction
         # this is a hard check that conversations can only have one act applied at a time
-        creator = await self.conns.main.fetchval(
-            'select creator from conversations where id=$1 for no key update', self.conv_id
+        creator, self.last_action_id = await self.conns.main.fetchrow(
+            'select creator, last_action_id from conversations where id=$1 for no key update', self.conv_id
         )
         return c.last_action, self.conv_id, creator
 
@@ -269,32 +545,204 @@ class _Act:
 
         return action_id, changed_user_id
 
+    async def run_many(
+        self, actions: List[Action], last_action: Optional[int], allow_multiple_actors: bool
+    ) -> List[Tuple[int, Optional[int], Action]]:
+        """
+        Apply actions one at a time using run(), the actor's state is looked up again whenever the actor changes.
+        """
+        actor_id = actions[0].actor_id
+        actions_with_ids: List[Tuple[int, Optional[int], Action]] = []
+        for action in actions:
+            if action.actor_id != actor_id:
+                actor_id = action.actor_id
+                last_action = await self.new_actor(action.actor_id)
+                if not allow_multiple_actors:
+                    raise ValueError('allow_multiple_actors is False, but multiple actors found')
+            action_id, changed_user_id = await self.run(action, last_action)
+            if action_id:
+                actions_with_ids.append((action_id, changed_user_id, action))
+        return actions_with_ids
+
+    async def run_batch(
+        self, actions: List[Action], last_action: Optional[int], allow_multiple_actors: bool
+    ) -> List[Tuple[int, Optional[int], Action]]:
+        """
+        Apply actions with the same checks and in the same order as run(), but with actors, "follows" and "parent"
+        actions looked up in one query each, consecutive message and subject actions are then inserted together.
+
+        Other actions (seen and participant changes) are applied one at a time using run(), actors are looked up
+        again after participant changes.
+        """
+        actor_id = actions[0].actor_id
+        actor_ids = {a.actor_id for a in actions}
+        # looked up when the actor changes
+        actors: Optional[Dict[int, Tuple[Optional[int], bool]]] = None
+        batch_actions = [a for a in actions if a.act in _batch_action_types]
+        refs = await self._get_refs(batch_actions)
+        # pks are allocated up front so actions in the batch can follow or be children of each other
+        pks = iter(await self.conns.main.fetch(_allocate_pks_sql, len(batch_actions)))
+
+        actions_with_ids: List[Tuple[int, Optional[int], Action]] = []
+        pending: List[Tuple[int, int, Values, Action]] = []
+        for action in actions:
+            if action.actor_id != actor_id:
+                actor_id = action.actor_id
+                if actors is None:
+                    actors = await self._get_actors(actor_ids)
+                if actor_id not in actors:
+                    raise JsonErrors.HTTPNotFound('Conversation not found')
+                last_action, can_see = actors[actor_id]
+                if not can_see:
+                    raise JsonErrors.HTTPForbidden('conversation is unpublished and you are not the creator')
+                if not allow_multiple_actors:
+                    raise ValueError('allow_multiple_actors is False, but multiple actors found')
+
+            if action.act in _batch_action_types:
+                pk = next(pks)[0]
+                pending.append(self._prepare_batch_action(action, last_action, pk, refs))
+            else:
+                actions_with_ids += await self._insert_batch(pending)
+                pending = []
+                action_id, changed_user_id = await self.run(action, last_action)
+                if action.act in participant_action_types:
+                    actors = None
+                if action_id:
+                    self.last_action_id = action_id
+                    refs[action_id] = _ActionRef(None, action.act, action.actor_id, 0, False)
+                    actions_with_ids.append((action_id, changed_user_id, action))
+
+        actions_with_ids += await self._insert_batch(pending)
+        return actions_with_ids
+
+    async def _get_actors(self, actor_ids: Set[int]) -> Dict[int, Tuple[Optional[int], bool]]:
+        """
+        Equivalent of get_conv_for_user for many actors, returns a lookup of actor id to
+        (removal_action_id, whether the actor can see the conversation).
+        """
+        if not actor_ids:
+            return {}
+        v = await self.conns.main.fetch(
+            """
+            select p.user_id, p.removal_action_id, c.publish_ts is not null or p.user_id = c.creator
+            from conversations c
+            join participants p on c.id=p.conv
+            where c.live is true and c.id=$1 and p.user_id=any($2)
+            """,
+            self.conv_id,
+            actor_ids,
+        )
+        return {r[0]: (r[1], r[2]) for r in v}
+
+    async def _get_refs(self, actions: List[Action]) -> Dict[int, '_ActionRef']:
+        """
+        Get all existing actions which the actions given follow or are children of.
+        """
+        ref_ids = {a.follows for a in actions if a.follows} | {a.parent for a in actions if a.parent}
+        if not ref_ids:
+            return {}
+        v = await self.conns.main.fetch(
+            """
+            select a.id, a.pk, a.act, a.actor, extract(epoch from current_timestamp - a.ts)::int,
+              exists (select 1 from actions f where f.conv=a.conv and f.follows=a.pk)
+            from actions a where a.conv=$1 and a.id=any($2)
+            """,
+            self.conv_id,
+            ref_ids,
+        )
+        return {r[0]: _ActionRef(*r[1:]) for r in v}
+
+    def _prepare_batch_action(
+        self, action: Action, last_action: Optional[int], pk: int, refs: Dict[int, '_ActionRef']
+    ) -> Tuple[int, int, Values, Action]:
+        """
+        Check an action as run() would and build the values to insert it, refs is updated to include the action.
+        """
+        if last_action:
+            raise JsonErrors.HTTPBadRequest(message="You can't act on conversations you've been removed from")
+
+        follows_pk, parent_pk = None, None
+        if action.act == ActionTypes.msg_add:
+            if action.parent:
+                parent = refs.get(action.parent)
+                if not parent or parent.act != ActionTypes.msg_add:
+                    raise JsonErrors.HTTPNotFound('parent action not found')
+                parent_pk = parent.pk
+        elif action.act in _msg_action_types:
+            follows = self._check_follows_ref(action, refs.get(action.follows), _msg_action_types)
+            self._check_msg_follows(action, follows.act, follows.actor, follows.age)
+            follows.followed = True
+            follows_pk = follows.pk
+        else:
+            follows = self._check_follows_ref(action, refs.get(action.follows), _subject_follow_types)
+            self._check_subject_follows(action, follows.act, follows.actor, follows.age)
+            follows.followed = True
+            follows_pk = follows.pk
+
+        action_id = action.id or self.last_action_id + 1
+        self.last_action_id = action_id
+        age = 0 if action.ts is None else int((utcnow() - action.ts).total_seconds())
+        refs[action_id] = _ActionRef(pk, action.act, action.actor_id, age, False)
+
+        is_add = action.act == ActionTypes.msg_add
+        values = Values(
+            pk=pk,
+            id=action_id,
+            ts=Func('or_now', action.ts),
+            conv=self.conv_id,
+            act=action.act,
+            actor=action.actor_id,
+            body=action.body,
+            preview=message_preview(action.body, action.msg_format) if action.act in _preview_action_types else None,
+            follows=follows_pk,
+            parent=parent_pk,
+            msg_format=action.msg_format if is_add else None,
+            warnings=self.warnings if is_add else None,
+        )
+        return action_id, pk, values, action
+
+    async def _insert_batch(self, pending: List[Tuple[int, int, Values, Action]]) -> List[Tuple[int, None, Action]]:
+        if not pending:
+            return []
+
+        await self.conns.main.execute_b(
+            'insert into actions (:values__names) values :values', values=MultipleValues(*(p[2] for p in pending))
+        )
+        for _, pk, _, action in pending:
+            if action.files:
+                await create_files(self.conns, action.files, self.conv_id, pk)
+        return [(action_id, None, action) for action_id, _, _, action in pending]
+
+    @staticmethod
+    def _check_follows_ref(action: Action, follows: Optional['_ActionRef'], permitted_acts: Set[ActionTypes]):
+        """
+        Same checks as _get_follows but on a looked up action.
+        """
+        if follows is None:
+            raise JsonErrors.HTTPBadRequest('"follows" action not found')
+        if follows.act not in permitted_acts:
+            raise JsonErrors.HTTPBadRequest('"follows" action has the wrong type')
+        if follows.followed:
+            raise JsonErrors.HTTPConflict(f'other actions already follow action {action.follows}')
+        return follows
+
     async def _seen(self, action: Action) -> Optional[int]:
         # could use "parent" to identify what was seen
-        last_seen = await self.conns.main.fetchval(
+        already_seen = await self.conns.main.fetchval(
             """
-            select a.id from actions as a
-            where a.conv=$1 and act='seen' and actor=$2
-            order by id desc
+            select 1 from actions
+            where conv=$1 and act='seen' and actor=$2 and id > (
+              select max(id) from actions where conv=$1 and not (act = any($3::ActionTypes[]))
+            )
             limit 1
             """,
             self.conv_id,
             action.actor_id,
+            _meta_action_types,
         )
-        if last_seen:
-            last_real_action = await self.conns.main.fetchval(
-                """
-                select id from actions
-                where conv = $1 and not (act = any($2::ActionTypes[]))
-                order by id desc
-                limit 1
-                """,
-                self.conv_id,
-                _meta_action_types,
-            )
-            if last_real_action and last_seen > last_real_action:
-                # conversation already seen by this user since it last changed
-                return
+        if already_seen:
+            # conversation already seen by this user since it last changed
+            return
 
         return await self.conns.main.fetchval(
             """
@@ -423,25 +871,7 @@ class _Act:
             )
 
         follows_pk, follows_act, follows_actor, follows_age = await self._get_follows(action, _msg_action_types)
-
-        if action.act == ActionTypes.msg_recover:
-            if follows_act != ActionTypes.msg_delete:
-                raise JsonErrors.HTTPBadRequest('message:recover can only occur on a deleted message')
-        elif action.act in {ActionTypes.msg_modify, ActionTypes.msg_release}:
-            if follows_act != ActionTypes.msg_lock or follows_actor != action.actor_id:
-                # TODO lock maybe shouldn't be required when conversation is draft
-                raise JsonErrors.HTTPBadRequest(f'{action.act} must follow message:lock by the same user')
-        else:
-            # just lock and delete here
-            if follows_act == ActionTypes.msg_delete:
-                raise JsonErrors.HTTPBadRequest('only message:recover can occur on a deleted message')
-            elif (
-                follows_act == ActionTypes.msg_lock
-                and follows_actor != action.actor_id
-                and follows_age <= self.conns.settings.message_lock_duration
-            ):
-                details = {'loc_duration': self.conns.settings.message_lock_duration}
-                raise JsonErrors.HTTPConflict('message locked, action not possible', details=details)
+        self._check_msg_follows(action, follows_act, follows_actor, follows_age)
 
         return await self.conns.main.fetchrow(
             """
@@ -460,21 +890,8 @@ class _Act:
         )
 
     async def _act_on_subject(self, action: Action) -> int:
-        follow_types = _subject_action_types | {ActionTypes.conv_create, ActionTypes.conv_publish}
-        follows_pk, follows_act, follows_actor, follows_age = await self._get_follows(action, follow_types)
-
-        if action.act == ActionTypes.subject_lock:
-            if (
-                follows_act == ActionTypes.subject_lock
-                and follows_actor != action.actor_id
-                and follows_age <= self.conns.settings.message_lock_duration
-            ):
-                details = {'loc_duration': self.conns.settings.message_lock_duration}
-                raise JsonErrors.HTTPConflict('subject not locked by you, action not possible', details=details)
-        else:
-            # modify and release
-            if follows_act != ActionTypes.subject_lock or follows_actor != action.actor_id:
-                raise JsonErrors.HTTPBadRequest(f'{action.act} must follow subject:lock by the same user')
+        follows_pk, follows_act, follows_actor, follows_age = await self._get_follows(action, _subject_follow_types)
+        self._check_subject_follows(action, follows_act, follows_actor, follows_age)
 
         return await self.conns.main.fetchval(
             """
@@ -516,6 +933,40 @@ class _Act:
             raise JsonErrors.HTTPConflict(f'other actions already follow action {action.follows}')
         return follows_pk, follows_act, follows_actor, follows_age
 
+    def _check_msg_follows(self, action: Action, follows_act: str, follows_actor: int, follows_age: int):
+        if action.act == ActionTypes.msg_recover:
+            if follows_act != ActionTypes.msg_delete:
+                raise JsonErrors.HTTPBadRequest('message:recover can only occur on a deleted message')
+        elif action.act in {ActionTypes.msg_modify, ActionTypes.msg_release}:
+            if follows_act != ActionTypes.msg_lock or follows_actor != action.actor_id:
+                # TODO lock maybe shouldn't be required when conversation is draft
+                raise JsonErrors.HTTPBadRequest(f'{action.act} must follow message:lock by the same user')
+        else:
+            # just lock and delete here
+            if follows_act == ActionTypes.msg_delete:
+                raise JsonErrors.HTTPBadRequest('only message:recover can occur on a deleted message')
+            elif (
+                follows_act == ActionTypes.msg_lock
+                and follows_actor != action.actor_id
+                and follows_age <= self.conns.settings.message_lock_duration
+            ):
+                details = {'loc_duration': self.conns.settings.message_lock_duration}
+                raise JsonErrors.HTTPConflict('message locked, action not possible', details=details)
+
+    def _check_subject_follows(self, action: Action, follows_act: str, follows_actor: int, follows_age: int):
+        if action.act == ActionTypes.subject_lock:
+            if (
+                follows_act == ActionTypes.subject_lock
+                and follows_actor != action.actor_id
+                and follows_age <= self.conns.settings.message_lock_duration
+            ):
+                details = {'loc_duration': self.conns.settings.message_lock_duration}
+                raise JsonErrors.HTTPConflict('subject not locked by you, action not possible', details=details)
+        else:
+            # modify and release
+            if follows_act != ActionTypes.subject_lock or follows_actor != action.actor_id:
+                raise JsonErrors.HTTPBadRequest(f'{action.act} must follow subject:lock by the same user')
+
 
 class ConvFlags(str, Enum):
     inbox = 'inbox'
@@ -536,54 +987,86 @@ async def apply_actions(
     spam: bool = False,
     warnings: Dict[str, str] = None,
     allow_multiple_actors: bool = False,
+    batch: bool = False,
+    clear_caches: bool = True,
 ) -> List[int]:
     """
     Apply actions and return their ids.
 
     Should be used for both remote platforms adding events and local users adding actions.
+
+    With batch=True message and subject actions are checked with one query and inserted together to reduce the
+    time the conversation is locked, validation and action ids are the same as when applied one at a time.
+
+    When called inside another transaction, clear_caches=False should be used and clear_conv_caches() called
+    once that transaction has committed if participants changed.
     """
     actions_with_ids: List[Tuple[int, Optional[int], Action]] = []
     act_cls = _Act(conns, conv_id, spam, warnings)
-    decrement_seen_id = None
-    from_deleted, from_archive, already_inbox = [], [], []
+    flag_totals = {}
     async with conns.main.transaction():
         # IMPORTANT must not do anything that could be slow (eg. networking) inside this transaction,
         # as the conv is locked for update from prepare() onwards
-        actor_id = actions[0].actor_id
-        last_action, conv_id, creator_id = await act_cls.prepare(actor_id)
+        last_action, conv_id, creator_id = await act_cls.prepare(actions[0].actor_id)
 
-        for action in actions:
-            if action.actor_id != actor_id:
-                actor_id = action.actor_id
-                last_action = await act_cls.new_actor(action.actor_id)
-                if not allow_multiple_actors:
-                    raise ValueError('allow_multiple_actors is False, but multiple actors found')
-            action_id, changed_user_id = await act_cls.run(action, last_action)
-            if action_id:
-                actions_with_ids.append((action_id, changed_user_id, action))
+        # the last actor is treated as having seen the conversation
+        actor_id = actions[-1].actor_id
+        if batch:
+            actions_with_ids = await act_cls.run_batch(actions, last_action, allow_multiple_actors)
+        else:
+            actions_with_ids = await act_cls.run_many(actions, last_action, allow_multiple_actors)
 
-    if actions_with_ids:
-        # FIXME is this correct if there are multiple actors?
-        # the actor is assumed to have seen the conversation as they've acted upon it
-        v = await conns.main.execute(
-            'update participants set seen=true where conv=$1 and user_id=$2 and seen is not true', conv_id, actor_id
-        )
-        if v == 'UPDATE 1':
-            # decrement unseen for the actor if we did mark the conversation as seen and it's in the inbox
-            decrement_seen_id = await conns.main.fetchval(
+        if actions_with_ids:
+            # FIXME is this correct if there are multiple actors?
+            # the actor is assumed to have seen the conversation as they've acted upon it
+            unseen_in_inbox = await conns.main.fetchval(
                 """
-                select user_id from participants
-                where conv=$1 and user_id=$2 and inbox is true and deleted is not true and spam is not true
+                update participants set seen=true
+                where conv=$1 and user_id=$2 and seen is not true
+                returning inbox is true and deleted is not true and spam is not true
                 """,
                 conv_id,
                 actor_id,
             )
-        # everyone else hasn't seen this action if it's "worth seeing"
-        if any(a.act not in _meta_action_types for a in actions):
-            from_deleted, from_archive, already_inbox = await user_flag_moves(conns, conv_id, actor_id)
-        await update_conv_users(conns, conv_id)
+            from_deleted, from_archive, already_inbox = [], [], []
+            # everyone else hasn't seen this action if it's "worth seeing"
+            if any(a.act not in _meta_action_types for a in actions):
+                from_deleted, from_archive, already_inbox = await user_flag_moves(conns, conv_id, actor_id)
+            updates = _flag_updates(creator_id, from_deleted, from_archive, already_inbox)
+            if spam:
+                updates += [
+                    UpdateFlag(u_id, [(ConvFlags.spam, 1), (ConvFlags.all, 1)]) for u_id in act_cls.new_user_ids
+                ]
+            else:
+                updates += [
+                    UpdateFlag(u_id, [(ConvFlags.unseen, 1), (ConvFlags.inbox, 1), (ConvFlags.all, 1)])
+                    for u_id in act_cls.new_user_ids
+                ]
+            if unseen_in_inbox:
+                # decrement unseen for the actor since we've marked the conversation as seen and it's in the inbox
+                updates.append(UpdateFlag(actor_id, [(ConvFlags.unseen, -1)]))
+
+            # flag counts are updated in the same transaction as participants so reconcile_flag_counts
+            # can't count a change and then have it added again
+            flag_totals = await update_conv_flags(conns, *updates)
+
+    if actions_with_ids:
+        user_ids = await update_conv_users(conns, conv_id)
+        if clear_caches and any(a.act in participant_action_types for a in actions):
+            await conv_ref_cache.clear(conns.redis, user_ids)
+            await recipients_cache.clear(conns.redis, [conv_id])
+    await update_cached_flags(conns.redis, flag_totals)
+    await search_update(conns, conv_id, actions_with_ids)
+    return [a[0] for a in actions_with_ids]
+
 
-    updates = [
+def _flag_updates(
+    creator_id: int, from_deleted: List[int], from_archive: List[int], already_inbox: List[int]
+) -> List['UpdateFlag']:
+    """
+    Flag changes for the participants returned by user_flag_moves.
+    """
+    return [
         *(
             UpdateFlag(
                 u_id,
@@ -611,21 +1094,6 @@ async def apply_actions(
         ),
         *(UpdateFlag(u_id, [(ConvFlags.unseen, 1)]) for u_id in already_inbox if u_id),
     ]
-    if spam:
-        updates += [UpdateFlag(u_id, [(ConvFlags.spam, 1), (ConvFlags.all, 1)]) for u_id in act_cls.new_user_ids]
-    else:
-        updates += [
-            UpdateFlag(u_id, [(ConvFlags.unseen, 1), (ConvFlags.inbox, 1), (ConvFlags.all, 1)])
-            for u_id in act_cls.new_user_ids
-        ]
-
-    if decrement_seen_id:
-        updates.append(UpdateFlag(decrement_seen_id, [(ConvFlags.unseen, -1)]))
-
-    if updates:
-        await update_conv_flags(conns, *updates)
-    await search_update(conns, conv_id, actions_with_ids)
-    return [a[0] for a in actions_with_ids]
 
 
 async def user_flag_moves(conns: Connections, conv_id: int, actor_id: int) -> Tuple[List[int], List[int], List[int]]:
@@ -670,75 +1138,295 @@ async def user_flag_moves(conns: Connections, conv_id: int, actor_id: int) -> Tu
     )
 
 
+_conv_actions_select = """
+select a.id, a.act, a.ts, actor_user.email actor,
+a.body, a.msg_format, a.warnings,
+prt_user.email participant, follows_action.id follows, parent_action.id parent,
+(select array_agg(row_to_json(f))
+  from (
+    select storage, storage_expires, content_disp, hash, content_id, name, content_type, size
+    from files
+    where files.action = a.pk
+    order by content_id  -- TODO only used in tests I think, could be removed
+  ) f
+) as files
+from actions as a
+
+join users as actor_user on a.actor = actor_user.id
+join conversations as c on a.conv = c.id
+
+left join users as prt_user on a.participant_user = prt_user.id
+left join actions as follows_action on a.follows = follows_action.pk
+left join actions as parent_action on a.parent = parent_action.pk
+"""
+_conv_actions_sql = f"""
+{_conv_actions_select}
+where :where
+order by :order
+limit :limit
+"""
+_conv_action_ids_sql = """
+select array_agg(t.id order by t.id)
+from (select a.id from actions as a where :where order by :order limit :limit) t
+"""
+_conv_actions_rows_sql = f"""
+select json_strip_nulls(row_to_json(t))::text
+from ({_conv_actions_sql}) t
+order by t.id
+"""
+
+
 async def conv_actions_json(
-    conns: Connections, user_id: int, conv_ref: StrInt, *, since_id: int = None, inc_seen: bool = False
+    conns: Connections,
+    user_id: int,
+    conv_ref: StrInt,
+    *,
+    since_id: int = None,
+    before_id: int = None,
+    limit: int = None,
+    inc_seen: bool = False,
 ):
+    """
+    Get actions for a conversation as a JSON array. since_id and before_id are exclusive bounds on action ids,
+    with limit and before_id the newest actions before before_id are returned.
+    """
+    c = await get_conv_for_user(conns, user_id, conv_ref)
+    await _check_since_id(conns, c, since_id)
+
+    json_str = await _conv_actions_json(
+        conns, c, since_id=since_id, before_id=before_id, limit=limit, inc_seen=inc_seen
+    )
+    if json_str is None:
+        if before_id or limit:
+            # an empty page is not an error when paginating
+            return '[]'
+        raise JsonErrors.HTTPNotFound('unable to find value')
+    return json_str
+
+
+async def conv_actions_stream(
+    conns: Connections,
+    user_id: int,
+    conv_ref: StrInt,
+    *,
+    since_id: int = None,
+    before_id: int = None,
+    limit: int = None,
+    inc_seen: bool = False,
+) -> AsyncIterator[str]:
+    """
+    Like conv_actions_json but returns an iterator of JSON strings, one per action, read from a cursor.
+
+    Checks are performed before returning so errors can be raised before a response is started.
+    """
     c = await get_conv_for_user(conns, user_id, conv_ref)
+    await _check_since_id(conns, c, since_id)
+    where, order = _conv_actions_where(c, since_id, before_id, inc_seen)
+    return _conv_actions_cursor(conns, where, order, limit)
+
+
+async def _check_since_id(conns: Connections, c: ConvSummary, since_id: Optional[int]):
+    if since_id:
+        await or404(conns.main.fetchval('select 1 from actions where conv=$1 and id=$2', c.id, since_id))
+
+
+def _conv_actions_where(c: ConvSummary, since_id: Optional[int], before_id: Optional[int], inc_seen: bool):
     where_logic = V('a.conv') == c.id
     if c.last_action:
         where_logic &= V('a.id') <= c.last_action
 
     if since_id:
-        await or404(conns.main.fetchval('select 1 from actions where conv=$1 and id=$2', c.id, since_id))
         where_logic &= V('a.id') > since_id
 
     if not inc_seen:
         where_logic &= V('a.act') != ActionTypes.seen
 
-    return await or404(
-        conns.main.fetchval_b(
-            """
-            select array_to_json(array_agg(json_strip_nulls(row_to_json(t))), true)
-            from (
-              select a.id, a.act, a.ts, actor_user.email actor,
-              a.body, a.msg_format, a.warnings,
-              prt_user.email participant, follows_action.id follows, parent_action.id parent,
-              (select array_agg(row_to_json(f))
-                from (
-                  select storage, storage_expires, content_disp, hash, content_id, name, content_type, size
-                  from files
-                  where files.action = a.pk
-                  order by content_id  -- TODO only used in tests I think, could be removed
-                ) f
-              ) as files
-              from actions as a
-
-              join users as actor_user on a.actor = actor_user.id
-              join conversations as c on a.conv = c.id
-
-              left join users as prt_user on a.participant_user = prt_user.id
-              left join actions as follows_action on a.follows = follows_action.pk
-              left join actions as parent_action on a.parent = parent_action.pk
-              where :where
-              order by a.id
-            ) t
-            """,
-            where=where_logic,
-        )
-    )
+    if before_id:
+        # with a limit we want the actions directly before before_id, they're reordered by the outer query
+        where_logic &= V('a.id') < before_id
+        return where_logic, V('a.id').desc()
+    else:
+        return where_logic, V('a.id').asc()
+
+
+async def _conv_actions_json(
+    conns: Connections,
+    c: ConvSummary,
+    *,
+    since_id: int = None,
+    before_id: int = None,
+    limit: int = None,
+    inc_seen: bool = False,
+) -> Optional[str]:
+    where, order = _conv_actions_where(c, since_id, before_id, inc_seen)
+    action_ids = await conns.main.fetchval_b(_conv_action_ids_sql, where=where, order=order, limit=limit)
+    if action_ids:
+        return '[' + ','.join(await conv_actions_cache.get(conns, c.id, action_ids)) + ']'
+
+
+async def _conv_actions_cursor(conns: Connections, where, order, limit: Optional[int]) -> AsyncIterator[str]:
+    async with conns.main.transaction():
+        async for r in conns.main.cursor_b(_conv_actions_rows_sql, where=where, order=order, limit=limit):
+            yield r[0]
 
 
 async def construct_conv(conns: Connections, user_id: int, conv_ref: StrInt, since_id: int = None):
-    actions_json = await conv_actions_json(conns, user_id, conv_ref, since_id=since_id)
-    actions = json.loads(actions_json)
-    return _construct_conv_actions(actions)
+    if since_id:
+        actions_json = await conv_actions_json(conns, user_id, conv_ref, since_id=since_id)
+        return _construct_conv_actions(json.loads(actions_json))
+
+    c = await get_conv_for_user(conns, user_id, conv_ref)
+    return _render_conv_snapshot(await _get_conv_snapshot(conns, c))
+
+
+def _conv_snapshot_key(conv_id: int):
+    return f'conv-snapshot-{conv_id}'
+
+
+async def delete_conv_snapshots(redis, conv_id: int):
+    """
+    Delete cached snapshots and action JSON of a conversation, required whenever existing actions or their
+    files are modified.
+    """
+    await redis.delete(_conv_snapshot_key(conv_id))
+    await ActionsJsonCache.clear(redis, conv_id)
+
+
+class ActionsJsonCache:
+    """
+    Redis cache of the JSON of individual actions so responses can be assembled by joining cached fragments
+    rather than serialising the same actions for every request and push.
+
+    Actions don't change once created, the exceptions (files being stored and conversations being published)
+    call delete_conv_snapshots which clears the cache. Each conversation has one hash with fields
+    "{prefix}:{action id}" so each way of serialising actions can share it, plus a generation which clear()
+    increments so JSON queried before a clear is never stored after it.
+
+    :param prefix: prefix of hash fields
+    :param sql: query taking a conversation id and array of action ids, returning rows of (action id, json)
+    """
+
+    ttl = 86400
+    _set_lua = """
+    if (redis.call('hget', KEYS[1], 'gen') or '0') == ARGV[1] then
+      for i = 3, #ARGV, 2 do
+        redis.call('hset', KEYS[1], ARGV[i], ARGV[i + 1])
+      end
+      redis.call('expire', KEYS[1], ARGV[2])
+    end
+    """
+    _clear_lua = """
+    local gen = redis.call('hincrby', KEYS[1], 'gen', 1)
+    redis.call('del', KEYS[1])
+    redis.call('hset', KEYS[1], 'gen', gen)
+    redis.call('expire', KEYS[1], ARGV[1])
+    """
+
+    def __init__(self, prefix: str, sql: str):
+        self.prefix = prefix
+        self.sql = sql
+        # keys are "hit" and "miss", counted per action
+        self.stats = Counter()
+
+    @staticmethod
+    def key(conv_id: int) -> str:
+        return f'conv-actions-{conv_id}'
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.stats['hit'] + self.stats['miss']
+        return self.stats['hit'] / total if total else None
+
+    async def get(self, conns: Connections, conv_id: int, action_ids: List[int]) -> List[str]:
+        """
+        Get the JSON of actions in the same order as action_ids, actions not cached are queried and stored.
+        """
+        key = self.key(conv_id)
+        gen, *actions_json = await conns.redis.hmget(key, 'gen', *(f'{self.prefix}:{a_id}' for a_id in action_ids))
+        missing = [a_id for a_id, a_json in zip(action_ids, actions_json) if a_json is None]
+        self.stats['hit'] += len(action_ids) - len(missing)
+        if not missing:
+            return actions_json
+
+        self.stats['miss'] += len(missing)
+        new = dict(await conns.main.fetch(self.sql, conv_id, missing))
+        if new:
+            fields = [v for a_id, a_json in new.items() for v in (f'{self.prefix}:{a_id}', a_json)]
+            await conns.redis.eval(self._set_lua, keys=[key], args=[gen or '0', self.ttl, *fields])
+        # actions deleted since action_ids was queried are omitted
+        actions_json = (a_json or new.get(a_id) for a_id, a_json in zip(action_ids, actions_json))
+        return [a_json for a_json in actions_json if a_json]
+
+    @classmethod
+    async def clear(cls, redis, conv_id: int):
+        await redis.eval(cls._clear_lua, keys=[cls.key(conv_id)], args=[cls.ttl])
+
+    def reset(self):
+        """
+        Clear stats, redis should be flushed at the same time.
+        """
+        self.stats.clear()
+
+
+conv_actions_cache = ActionsJsonCache(
+    'ui',
+    f"""
+    select t.id, json_strip_nulls(row_to_json(t))::text
+    from ({_conv_actions_select} where a.conv=$1 and a.id=any($2)) t
+    """,
+)
+
+
+async def _get_conv_snapshot(conns: Connections, c: ConvSummary, *, cache: bool = True) -> Dict[str, Any]:
+    """
+    Get the state of a conversation from the snapshot cache, applying only actions newer than the snapshot.
+
+    Snapshots are stored in a redis hash per conversation, the "live" field is the current state,
+    other fields hold the state as of a participant's removal_action_id.
+
+    With cache=False the snapshot is built from all actions and redis isn't used.
+    """
+    if not cache:
+        snapshot = _new_conv_snapshot()
+        _apply_conv_actions(snapshot, json.loads(await _conv_actions_json(conns, c) or '[]'))
+        return snapshot
+
+    key = _conv_snapshot_key(c.id)
+    field = str(c.last_action) if c.last_action else 'live'
+    snapshot_json = await conns.redis.hget(key, field)
+    snapshot = json.loads(snapshot_json) if snapshot_json else _new_conv_snapshot()
+
+    actions_json = await _conv_actions_json(conns, c, since_id=snapshot['last_id'])
+    if actions_json:
+        _apply_conv_actions(snapshot, json.loads(actions_json))
+        tr = conns.redis.multi_exec()
+        tr.hset(key, field, json.dumps(snapshot))
+        tr.expire(key, 86400)
+        await tr.execute()
+    return snapshot
+
+
+def _new_conv_snapshot() -> Dict[str, Any]:
+    # keys of messages and refs are strings so the snapshot survives a round trip through json
+    return {'last_id': 0, 'subject': None, 'created': None, 'messages': {}, 'refs': {}, 'participants': {}}
 
 
-def _construct_conv_actions(actions: List[Dict[str, Any]]) -> Dict[str, Any]:  # noqa: 901
-    subject = None
-    created = None
-    messages = {}
-    participants = {}
+def _apply_conv_actions(snapshot: Dict[str, Any], actions: List[Dict[str, Any]]):  # noqa: 901
+    """
+    Update a snapshot in place with new actions. Messages are keyed by the id of their message:add action,
+    "refs" maps the id of every message action to that key.
+    """
+    messages, refs, participants = snapshot['messages'], snapshot['refs'], snapshot['participants']
 
     for action in actions:
         act: ActionTypes = action['act']
         action_id: int = action['id']
         actor: str = action['actor']
         if act in {ActionTypes.conv_publish, ActionTypes.conv_create}:
-            subject = action['body']
-            created = action['ts']
+            snapshot['subject'] = action['body']
+            snapshot['created'] = action['ts']
         elif act == ActionTypes.subject_modify:
-            subject = action['body']
+            snapshot['subject'] = action['body']
         elif act == ActionTypes.msg_add:
             # FIXME add actor to message
             d = {
@@ -753,9 +1441,12 @@ def _construct_conv_actions(actions: List[Dict[str, Any]]) -> Dict[str, Any]:  #
             files = action.get('files')
             if files:
                 d['files'] = files
-            messages[action_id] = d
+            msg_key = str(action_id)
+            messages[msg_key] = d
+            refs[msg_key] = msg_key
         elif act in _msg_action_types:
-            message = messages[action['follows']]
+            msg_key = refs[str(action['follows'])]
+            message = messages[msg_key]
             message['ref'] = action_id
             if act == ActionTypes.msg_modify:
                 message['body'] = action['body']
@@ -767,29 +1458,45 @@ def _construct_conv_actions(actions: List[Dict[str, Any]]) -> Dict[str, Any]:  #
                 message['active'] = False
             elif act == ActionTypes.msg_recover:
                 message['active'] = True
-            messages[action_id] = message
+            refs[str(action_id)] = msg_key
         elif act == ActionTypes.prt_add:
             participants[action['participant']] = {'id': action_id}  # perms not implemented yet
         elif act == ActionTypes.prt_remove:
             participants.pop(action['participant'])
         elif act not in _meta_action_types:
             raise NotImplementedError(f'action "{act}" construction not implemented')
+        snapshot['last_id'] = action_id
+
 
+def _render_conv_snapshot(snapshot: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Build the message tree from a snapshot, this modifies the snapshot so it shouldn't be reused.
+    """
+    messages, refs = snapshot['messages'], snapshot['refs']
     msg_list = []
     for msg in messages.values():
-        parent = msg.pop('parent', -1)
-        # if 'parent' is missing (-1 here), msg has already been processed
-        if parent != -1:
-            if parent:
-                parent_msg = messages[parent]
-                if 'children' not in parent_msg:
-                    parent_msg['children'] = [msg]
-                else:
-                    parent_msg['children'].append(msg)
+        parent = msg.pop('parent')
+        if parent:
+            parent_msg = messages[refs[str(parent)]]
+            if 'children' not in parent_msg:
+                parent_msg['children'] = [msg]
             else:
-                msg_list.append(msg)
+                parent_msg['children'].append(msg)
+        else:
+            msg_list.append(msg)
+
+    return {
+        'subject': snapshot['subject'],
+        'created': snapshot['created'],
+        'messages': msg_list,
+        'participants': snapshot['participants'],
+    }
+
 
-    return {'subject': subject, 'created': created, 'messages': msg_list, 'participants': participants}
+def _construct_conv_actions(actions: List[Dict[str, Any]]) -> Dict[str, Any]:
+    snapshot = _new_conv_snapshot()
+    _apply_conv_actions(snapshot, actions)
+    return _render_conv_snapshot(snapshot)
 
 
 async def create_conv(  # noqa: 901
@@ -942,26 +1649,30 @@ async def create_conv(  # noqa: 901
                     action_pk,
                 )
 
-    if not publish:
-        updates = (UpdateFlag(creator_id, [(ConvFlags.draft, 1), (ConvFlags.all, 1)]),)
-    elif spam:
-        updates = (
-            UpdateFlag(creator_id, [(ConvFlags.sent, 1), (ConvFlags.all, 1)]),
-            *(UpdateFlag(u_id, [(ConvFlags.spam, 1), (ConvFlags.all, 1)]) for u_id in other_user_ids),
-        )
-    else:
-        updates = (
-            UpdateFlag(creator_id, [(ConvFlags.sent, 1), (ConvFlags.all, 1)]),
-            *(
-                UpdateFlag(u_id, [(ConvFlags.inbox, 1), (ConvFlags.unseen, 1), (ConvFlags.all, 1)])
-                for u_id in other_user_ids
-            ),
-        )
+        if not publish:
+            updates = (UpdateFlag(creator_id, [(ConvFlags.draft, 1), (ConvFlags.all, 1)]),)
+        elif spam:
+            updates = (
+                UpdateFlag(creator_id, [(ConvFlags.sent, 1), (ConvFlags.all, 1)]),
+                *(UpdateFlag(u_id, [(ConvFlags.spam, 1), (ConvFlags.all, 1)]) for u_id in other_user_ids),
+            )
+        else:
+            updates = (
+                UpdateFlag(creator_id, [(ConvFlags.sent, 1), (ConvFlags.all, 1)]),
+                *(
+                    UpdateFlag(u_id, [(ConvFlags.inbox, 1), (ConvFlags.unseen, 1), (ConvFlags.all, 1)])
+                    for u_id in other_user_ids
+                ),
+            )
+
+        # in the same transaction as participants, see update_conv_flags
+        flag_totals = await update_conv_flags(conns, *updates)
 
-    await update_conv_flags(conns, *updates)
+    await update_cached_flags(conns.redis, flag_totals)
     await search_create_conv(
         conns,
         conv_id=conv_id,
+        conv_key=conv_key,
         creator_email=creator_email,
         creator_id=creator_id,
         users=part_users,
@@ -995,34 +1706,70 @@ async def create_files(conns: Connections, files: List[File], conv_id: int, acti
     )
 
 
-conv_flag_count_sql = """
-select
+# {user} is the user whose conversations are being counted
+_count_flags_template = """
   count(*) filter (where inbox is true and deleted is not true and spam is not true) as inbox,
   count(*) filter (where inbox is true and deleted is not true and spam is not true and seen is not true) as unseen,
 
-  count(*) filter (where c.creator = $1 and publish_ts is null and deleted is not true) as draft,
-  count(*) filter (where c.creator = $1 and publish_ts is not null and deleted is not true) as sent,
+  count(*) filter (where c.creator = {user} and publish_ts is null and deleted is not true) as draft,
+  count(*) filter (where c.creator = {user} and publish_ts is not null and deleted is not true) as sent,
   count(*) filter (
-    where inbox is not true and deleted is not true and spam is not true and c.creator != $1
+    where inbox is not true and deleted is not true and spam is not true and c.creator != {user}
   ) as archive,
   count(*) as "all",
   count(*) filter (where spam is true and deleted is not true) as spam,
   count(*) filter (where deleted is true) as deleted
+"""
+conv_flag_count_sql = f"""
+select {_count_flags_template.format(user='$1')}
 from participants p
 join conversations c on p.conv = c.id
 where user_id = $1 and (c.publish_ts is not null or c.creator = $1)
 limit 9999
 """
 
-conv_label_count_sql = """
-select l.id, count(p)
-from labels l
-left join participants p on label_ids @> array[l.id]
-where l.user_id = $1
-group by l.id
-order by l.ordering, l.id
+
+_flag_count_fields = 'inbox, unseen, draft, sent, archive, "all", spam, deleted'
+
+init_flag_counts_sql = f"""
+insert into user_flag_counts (user_id, {_flag_count_fields})
+select $1, {_flag_count_fields} from ({conv_flag_count_sql}) t
+on conflict (user_id) do update set
+  inbox=excluded.inbox, unseen=excluded.unseen, draft=excluded.draft, sent=excluded.sent,
+  archive=excluded.archive, "all"=excluded."all", spam=excluded.spam, deleted=excluded.deleted
+returning {_flag_count_fields}
 """
 
+update_flag_counts_sql = """
+update user_flag_counts c set
+  inbox=c.inbox + t.inbox, unseen=c.unseen + t.unseen, draft=c.draft + t.draft, sent=c.sent + t.sent,
+  archive=c.archive + t.archive, "all"=c."all" + t."all", spam=c.spam + t.spam, deleted=c.deleted + t.deleted
+from json_to_recordset($1::json) as t(
+  user_id bigint, inbox int, unseen int, draft int, sent int, archive int, "all" int, spam int, deleted int
+)
+where c.user_id = t.user_id
+"""
+
+_select_flag_counts_sql = f'select {_flag_count_fields} from user_flag_counts where user_id=$1'
+
+# like init_flag_counts_sql for many users at once, users without conversations get zero counts
+_init_many_flag_counts_sql = f"""
+insert into user_flag_counts (user_id, {_flag_count_fields})
+select u.user_id, {', '.join(f'coalesce(t.{f}, 0)' for f in _flag_count_fields.split(', '))}
+from unnest($1::bigint[]) u(user_id)
+left join (
+  select p.user_id, {_count_flags_template.format(user='p.user_id')}
+  from participants p
+  join conversations c on p.conv = c.id
+  where p.user_id = any($1) and (c.publish_ts is not null or c.creator = p.user_id)
+  group by p.user_id
+) t on u.user_id = t.user_id
+-- no-op update so counts initialised concurrently are returned
+on conflict (user_id) do update set user_id=excluded.user_id
+returning user_id, {_flag_count_fields}
+"""
+_select_many_flag_counts_sql = f'select user_id, {_flag_count_fields} from user_flag_counts where user_id=any($1)'
+
 
 def _flags_count_key(user_id: int):
     return f'conv-counts-flags-{user_id}'
@@ -1030,14 +1777,19 @@ def _flags_count_key(user_id: int):
 
 async def get_flag_counts(conns: Connections, user_id, *, force_update=False) -> dict:
     """
-    Get counts for participant flags. Data is cached to a redis hash and retrieved from there if it exists.
+    Get counts for participant flags. Counts are kept in user_flag_counts, cached to a redis hash and retrieved
+    from there if it exists. The full count from participants is only used to initialise user_flag_counts
+    or with force_update.
     """
     flag_key = _flags_count_key(user_id)
     flags = await conns.redis.hgetall(flag_key)
     if flags and not force_update:
         flags = {k: int(v) for k, v in flags.items()}
     else:
-        flags = dict(await conns.main.fetchrow(conv_flag_count_sql, user_id))
+        r = None
+        if not force_update:
+            r = await conns.main.fetchrow(_select_flag_counts_sql, user_id)
+        flags = dict(r or await conns.main.fetchrow(init_flag_counts_sql, user_id))
         tr = conns.redis.multi_exec()
         tr.hmset_dict(flag_key, flags)
         tr.expire(flag_key, 86400)
@@ -1045,44 +1797,108 @@ async def get_flag_counts(conns: Connections, user_id, *, force_update=False) ->
     return flags
 
 
-@dataclass
-class UpdateFlag:
-    user_id: int
-    changes: Iterable[Tuple[ConvFlags, int]]
+async def get_many_flag_counts(conns: Connections, user_ids: List[int]) -> Dict[int, dict]:
+    """
+    Get flag counts for many users like get_flag_counts, with one redis round trip for cached counts and at most
+    two queries for users whose counts aren't cached.
+    """
+    tr = conns.redis.pipeline()
+    cached = [tr.hgetall(_flags_count_key(user_id)) for user_id in user_ids]
+    await tr.execute()
+    counts, missing = {}, []
+    for user_id, flags in zip(user_ids, cached):
+        flags = await flags
+        if flags:
+            counts[user_id] = {k: int(v) for k, v in flags.items()}
+        else:
+            missing.append(user_id)
+
+    if missing:
+        rows = await conns.main.fetch(_select_many_flag_counts_sql, missing)
+        found = {r['user_id'] for r in rows}
+        uninitialised = [user_id for user_id in missing if user_id not in found]
+        if uninitialised:
+            rows += await conns.main.fetch(_init_many_flag_counts_sql, uninitialised)
+        tr = conns.redis.multi_exec()
+        for r in rows:
+            flags = dict(r)
+            user_id = flags.pop('user_id')
+            counts[user_id] = flags
+            flag_key = _flags_count_key(user_id)
+            tr.hmset_dict(flag_key, flags)
+            tr.expire(flag_key, 86400)
+        await tr.execute()
+    return counts
 
 
-async def update_conv_flags(conns: Connections, *updates: UpdateFlag):
+async def reconcile_flag_counts(conns: Connections, user_id: int) -> bool:
     """
-    Increment or decrement counts for participant flags if they exist in the cache, also extends cache expiry.
+    Recount flags for a user from participants and correct user_flag_counts, returns True if the counts had drifted.
     """
+    async with conns.main.transaction():
+        old = await conns.main.fetchrow(_select_flag_counts_sql + ' for no key update', user_id)
+        new = await conns.main.fetchrow(init_flag_counts_sql, user_id)
+    if old and dict(old) == dict(new):
+        return False
+    await conns.redis.delete(_flags_count_key(user_id))
+    return True
 
-    async def update(u: UpdateFlag):
-        key = _flags_count_key(u.user_id)
-        if await conns.redis.exists(key):
-            await asyncio.gather(
-                conns.redis.expire(key, 86400), *(conns.redis.hincrby(key, c[0].value, c[1]) for c in u.changes if c)
-            )
 
-    await asyncio.gather(*(update(u) for u in updates if u))
+@dataclass
+class UpdateFlag:
+    user_id: int
+    changes: Iterable[Tuple[ConvFlags, int]]
 
 
-def _label_count_key(user_id: int):
-    return f'conv-counts-labels-{user_id}'
+async def update_conv_flags(conns: Connections, *updates: UpdateFlag) -> Dict[int, Dict[str, int]]:
+    """
+    Increment or decrement counts for participant flags in user_flag_counts.
 
+    Must be called in the transaction which changed participants: reconcile_flag_counts locks the user's row
+    while recounting, so a change can't be both counted and added. Returns the totals which should be passed to
+    update_cached_flags() once the transaction has committed.
+    """
+    totals: Dict[int, Dict[str, int]] = {}
+    for u in updates:
+        if u:
+            user_totals = totals.setdefault(u.user_id, {f.value: 0 for f in ConvFlags})
+            for c in u.changes:
+                if c:
+                    user_totals[c[0].value] += c[1]
+    if totals:
+        # users without a row yet are ignored, their counts are initialised from participants when first required
+        rows = [dict(user_id=user_id, **user_totals) for user_id, user_totals in totals.items()]
+        await conns.main.execute(update_flag_counts_sql, json.dumps(rows))
+    return totals
+
+
+# for each key: ARGV holds the number of changes followed by field, increment pairs, ARGV[1] is the expiry
+_update_cached_flags_lua = """
+local arg_i = 2
+for _, key in ipairs(KEYS) do
+  local n = tonumber(ARGV[arg_i])
+  if redis.call('exists', key) == 1 then
+    redis.call('expire', key, ARGV[1])
+    for j = 1, n do
+      redis.call('hincrby', key, ARGV[arg_i + j * 2 - 1], ARGV[arg_i + j * 2])
+    end
+  end
+  arg_i = arg_i + 1 + n * 2
+end
+"""
 
-async def get_label_counts(conns: Connections, user_id: int) -> dict:
+
+async def update_cached_flags(redis, totals: Dict[int, Dict[str, int]]):
     """
-    Get counts for labels. Data is cached to a redis hash and retrieved from there if it exists.
+    Update cached flag counts for many users in one round trip, counts are only changed if they're already cached,
+    also extends cache expiry.
     """
-    label_key = _label_count_key(user_id)
-    labels = await conns.redis.hgetall(label_key)
-    if labels:
-        labels = {k: int(v) for k, v in labels.items()}
-    else:
-        labels = {str(k): v for k, v in await conns.main.fetch(conv_label_count_sql, user_id)}
-        if labels:
-            tr = conns.redis.multi_exec()
-            tr.hmset_dict(label_key, labels)
-            tr.expire(label_key, 86400)
-            await tr.execute()
-    return labels
+    if not totals:
+        return
+    keys, args = [], [86400]
+    for user_id, user_totals in totals.items():
+        keys.append(_flags_count_key(user_id))
+        changes = [(f, v) for f, v in user_totals.items() if v]
+        args.append(len(changes))
+        args.extend(chain.from_iterable(changes))
+    await redis.eval(_update_cached_flags_lua, keys=keys, args=args)
@@ -37,7 +37,8 @@ create table labels (
   name varchar(255),
   ordering float not null default 0,
   description varchar(1027),
-  color varchar(31)
+  color varchar(31),
+  conv_count int not null default 0  -- number of conversations with this label, see participant-labels
 );
 create index idx_labels_user_id on labels using btree (user_id);
 create index idx_labels_ordering on labels using btree (ordering);
@@ -63,6 +64,9 @@ create table conversations (
   last_action_id int not null default 0 check (last_action_id >= 0),
   leader_node varchar (255),  -- null when this node is leader,
   live bool not null,  -- used when conversations are created but not yet ready to be read, also perhaps for deletion
+  -- counts kept up to date by the participant-count and action_insert triggers, used to build details
+  msg_count int not null default 0,
+  prt_count int not null default 0,
   details json
 );
 create index idx_conversations_key on conversations using btree (key);
@@ -100,6 +104,66 @@ create index idx_participants_conv on participants using btree (conv);
 create index idx_participants_deleted_ts on participants using btree (deleted_ts);
 create index idx_participants_label_ids on participants using gin (label_ids);
 
+-- { participant-labels
+create or replace function participant_labels() returns trigger as $$
+  declare
+    added_ bigint[];
+    removed_ bigint[];
+  begin
+    if TG_OP = 'DELETE' then
+      removed_ := old.label_ids;
+    else
+      added_ := array(select unnest(new.label_ids) except select unnest(old.label_ids));
+      removed_ := array(select unnest(old.label_ids) except select unnest(new.label_ids));
+    end if;
+
+    if cardinality(added_) > 0 then
+      update labels set conv_count=conv_count + 1 where id=any(added_);
+    end if;
+    if cardinality(removed_) > 0 then
+      update labels set conv_count=conv_count - 1 where id=any(removed_);
+    end if;
+    return null;
+  end;
+$$ language plpgsql;
+
+-- label_ids is never set when participants are created, so there's no insert trigger
+drop trigger if exists participant_labels_update on participants;
+create trigger participant_labels_update after update of label_ids on participants
+  for each row when (old.label_ids is distinct from new.label_ids) execute procedure participant_labels();
+drop trigger if exists participant_labels_delete on participants;
+create trigger participant_labels_delete after delete on participants
+  for each row when (old.label_ids is not null) execute procedure participant_labels();
+-- } participant-labels
+
+-- { participant-count
+create or replace function participant_insert() returns trigger as $$
+  begin
+    update conversations c set prt_count=prt_count + t.count
+    from (select conv, count(*) from new_prts group by conv) t
+    where c.id=t.conv;
+    return null;
+  end;
+$$ language plpgsql;
+
+create or replace function participant_delete() returns trigger as $$
+  begin
+    update conversations c set prt_count=prt_count - t.count
+    from (select conv, count(*) from old_prts group by conv) t
+    where c.id=t.conv;
+    return null;
+  end;
+$$ language plpgsql;
+
+-- statement level so inserting many participants at once only updates the conversation once
+drop trigger if exists participant_insert on participants;
+create trigger participant_insert after insert on participants
+  referencing new table as new_prts for each statement execute procedure participant_insert();
+drop trigger if exists participant_delete on participants;
+create trigger participant_delete after delete on participants
+  referencing old table as old_prts for each statement execute procedure participant_delete();
+-- } participant-count
+
 -- see core.ActionTypes enum which matches this
 create type ActionTypes as enum (
   'conv:publish', 'conv:create',
@@ -112,6 +176,20 @@ create type ActionTypes as enum (
 -- see core.MsgFormat enum which matches this
 create type MsgFormat as enum ('markdown', 'plain', 'html');
 
+-- counts of conversations in each "folder" for each user, maintained as participants change,
+-- see get_flag_counts and update_conv_flags
+create table user_flag_counts (
+  user_id bigint primary key references users on delete cascade,
+  inbox int not null default 0,
+  unseen int not null default 0,
+  draft int not null default 0,
+  sent int not null default 0,
+  archive int not null default 0,
+  "all" int not null default 0,
+  spam int not null default 0,
+  deleted int not null default 0
+);
+
 create table actions (
   pk bigserial primary key,
   id int not null check (id >= 0),
@@ -149,10 +227,11 @@ create or replace function action_insert() returns trigger as $$
     -- todo add actor name when we have it, could add attachment count etc. here too
     old_details_ json;
     creator_ varchar(255);
+    msg_count_ int;
+    prt_count_ int;
     details_ json;
     new_id_ int;
     subject_ats ActionTypes[] = array['conv:publish', 'conv:create', 'subject:modify'];
-    add_del_msg_ats ActionTypes[] = array['message:add', 'message:delete'];
     meta_ats ActionTypes[] = array['seen','subject:release','subject:lock','message:lock','message:release'];
   begin
     if new.act=any(meta_ats) then
@@ -161,27 +240,26 @@ create or replace function action_insert() returns trigger as $$
         where id=new.conv
         returning last_action_id into new_id_;
     else
-      select details, u.email into old_details_, creator_
+      select details, u.email, msg_count, prt_count into old_details_, creator_, msg_count_, prt_count_
       from conversations c
       join users u on u.id = c.creator
-      where c.id=new.conv;
+      where c.id=new.conv
+      for no key update of c;
 
+      msg_count_ := msg_count_ + case new.act when 'message:add' then 1
+                                              when 'message:delete' then -1
+                                              else 0 end;
       details_ := json_build_object(
         'act', new.act,
         'sub', case when new.act=any(subject_ats) then new.body else old_details_->>'sub' end,
         'email', (select email from users where id=new.actor),
         'creator', creator_,
         'prev', left(coalesce(new.preview, old_details_->>'prev'), 140),
-        'prts', (select count(*) from participants where conv=new.conv),
-        'msgs', (
-          select count(*) filter (where act='message:add') - count(*) filter (where act='message:delete')
-          from actions where conv=new.conv and act=any(add_del_msg_ats)
-        ) + case new.act when 'message:add' then 1
-                         when 'message:delete' then -1
-                         else 0 end
+        'prts', prt_count_,
+        'msgs', msg_count_
       );
       update conversations
-        set updated_ts=new.ts, details=details_,
+        set updated_ts=new.ts, details=details_, msg_count=msg_count_,
             last_action_id=case when new.id is null then last_action_id + 1 else new.id end
         where id=new.conv
         returning last_action_id into new_id_;
@@ -293,21 +371,75 @@ create table search (
   conv bigint references conversations,
   action int not null,
   freeze_action int not null default 0,
-  user_ids bigint[] not null,
-  ts timestamptz,
+  ts timestamptz not null default current_timestamp,
 
   -- might need other things like size, files, participants
   creator_email varchar(255) not null,
   vector tsvector,
+  -- start of the message text, html escaped, used to build snippets of matches on the page of results
+  snippet_text text,
   unique (conv, freeze_action)
 );
 create index idx_search_conv on search using btree (conv);
 create index idx_search_action on search using btree (conv, action);
-create index idx_search_user_ids on search using gin (user_ids);
 create index idx_search_ts on search using btree (ts);
 create index idx_search_creator_email on search using gin (creator_email gin_trgm_ops);
 create index idx_search_vector on search using gin (vector);
 
+-- users who can see each search entry, removed participants are moved to the frozen entry for the point
+-- they were removed at
+create table search_members (
+  search_id bigint not null references search on delete cascade,
+  user_id bigint not null references users on delete restrict,
+  ts timestamptz not null,  -- copy of search.ts so searches can be driven from a user's members, see search-members-ts
+  unique (search_id, user_id)
+);
+-- search_id is included to give a stable order for pagination
+create index idx_search_members_user_ts on search_members using btree (user_id, ts, search_id);
+
+-- { trim-snippet
+-- cut highlighted snippets to max_length without leaving a tag or entity cut in half or a match unclosed
+create or replace function trim_snippet(snippet text, max_length int) returns text as $$
+  declare
+    trimmed text;
+  begin
+    if length(snippet) <= max_length then
+      return snippet;
+    end if;
+    -- space is left to close a match
+    trimmed := regexp_replace(left(snippet, max_length - 4), '(<b>|<[^>]*|&[^;]*)$', '');
+    if trimmed ~ '<b>[^<]*$' then
+      trimmed := trimmed || '</b>';
+    end if;
+    return trimmed;
+  end;
+$$ language plpgsql immutable;
+-- } trim-snippet
+
+-- values for search-as-you-type suggestions, kept up to date with vectors
+create type SuggestionTypes as enum ('subject', 'participant', 'file');
+create table search_suggestions (
+  search_id bigint not null references search on delete cascade,
+  suggestion_type SuggestionTypes not null,
+  value varchar(255) not null,
+  unique (search_id, suggestion_type, value)
+);
+-- serves prefix matches from search suggest, "like" can only use an index with text_pattern_ops
+create index idx_search_suggestions_value on search_suggestions using btree (lower(value) text_pattern_ops);
+
+-- { search-members-ts
+create or replace function search_members_ts() returns trigger as $$
+  begin
+    update search_members set ts=new.ts where search_id=new.id;
+    return null;
+  end;
+$$ language plpgsql;
+
+drop trigger if exists search_members_ts on search;
+create trigger search_members_ts after update of ts on search
+  for each row when (old.ts is distinct from new.ts) execute procedure search_members_ts();
+-- } search-members-ts
+
 ----------------------------------------------------------------------------------
 -- auth tables, currently in the the same database as everything else, but with --
 -- no links so could easily be moved to a separate db.                          --
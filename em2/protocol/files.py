@@ -5,6 +5,7 @@ from aiohttp import ClientSession
 from arq import Retry
 from asyncpg.pool import Pool
 
+from em2.core import delete_conv_snapshots
 from em2.settings import Settings
 from em2.utils.storage import S3, DownloadError, download_remote_file
 
@@ -51,3 +52,4 @@ async def download_push_file(ctx, conv_id: int, content_id: str):
         )
 
     await pg.execute('update files set storage=$2 where id=$1', file_id, storage)
+    await delete_conv_snapshots(ctx['redis'], conv_id)
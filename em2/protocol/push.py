@@ -1,6 +1,7 @@
 import asyncio
 import json
 import logging
+import re
 from datetime import datetime
 from typing import Any, List, Set, Tuple
 
@@ -8,7 +9,7 @@ from arq import ArqRedis
 from asyncpg.pool import Pool
 from cryptography.fernet import Fernet
 
-from em2.core import Action, ActionTypes, UserTypes
+from em2.core import Action, ActionTypes, UserTypes, recipients_cache
 from em2.settings import Settings
 
 from .core import Em2Comms, HttpError, actions_to_body
@@ -16,6 +17,8 @@ from .core import Em2Comms, HttpError, actions_to_body
 logger = logging.getLogger('em2.push')
 RETRY = 'RT'
 SMTP = 'SMTP'
+# format of actions_data from em2.background.get_actions_data
+actions_data_re = re.compile(r'^{"actions":(\[.*\]),"conversation":"([^"]+)"}$', re.S)
 
 
 async def push_actions(ctx, actions_data: str, users: List[Tuple[str, UserTypes]], **extra: Any):
@@ -57,10 +60,17 @@ class Pusher:
                 _job_try=self.job_try + 1,
                 _defer_by=self.job_try * 10,
             )
-        data = json.loads(actions_data)
-        conversation, actions = data['conversation'], data['actions']
+        # actions are only parsed if they're needed for smtp, they're passed on as JSON to em2 nodes
+        m = actions_data_re.match(actions_data)
+        if m:
+            actions_json, conversation = m.groups()
+        else:
+            # jobs queued before actions_data had this format
+            data = json.loads(actions_data)
+            actions_json, conversation = json.dumps(data['actions']), data['conversation']
         if smtp_addresses:
             logger.info('%d smtp emails to send', len(smtp_addresses))
+            actions = json.loads(actions_json)
             # "seen" actions don't get sent via SMTP
             # TODO anything else to skip here?
             if not all(a['act'] == ActionTypes.seen for a in actions):
@@ -68,7 +78,7 @@ class Pusher:
         if em2_nodes:
             logger.info('%d em2 nodes to push action to', len(em2_nodes))
             await asyncio.gather(
-                self.em2_send(conversation, actions, em2_nodes, **extra), self.update_profiles(conversation)
+                self.em2_send(conversation, actions_json, em2_nodes, **extra), self.update_profiles(conversation)
             )
 
         return f'retry={len(retry_users)} smtp={len(smtp_addresses)} em2={len(em2_nodes)}'
@@ -122,6 +132,7 @@ class Pusher:
             if await self.em2.check_local(email):
                 # local user
                 await self.pg.execute("update users set user_type='local' where email=$1", email)
+                await recipients_cache.clear_user(self.pg, self.redis, email)
                 return
 
         try:
@@ -140,10 +151,12 @@ class Pusher:
 
         if current_user_type != user_type:
             await self.pg.execute('update users set user_type=$1, v=null where email=$2', user_type, email)
+            await recipients_cache.clear_user(self.pg, self.redis, email)
         return node, email
 
-    async def em2_send(self, conversation: str, actions: List[Any], em2_nodes: Set[str], **extra: Any):
-        data = json.dumps({'actions': actions, **extra}).encode()
+    async def em2_send(self, conversation: str, actions_json: str, em2_nodes: Set[str], **extra: Any):
+        data = '{"actions":' + actions_json + (',' + json.dumps(extra)[1:] if extra else '}')
+        data = data.encode()
         this_em2_node = self.em2.this_em2_node()
         await asyncio.gather(*[self.em2_send_node(data, n, this_em2_node, conversation) for n in em2_nodes])
 
@@ -11,7 +11,18 @@ from bs4 import BeautifulSoup
 from buildpg.asyncpg import BuildPgConnection
 
 from em2.background import push_all, push_multiple
-from em2.core import Action, ActionTypes, Connections, MsgFormat, UserTypes, apply_actions, create_conv, get_create_user
+from em2.core import (
+    Action,
+    ActionTypes,
+    Connections,
+    MsgFormat,
+    UserTypes,
+    apply_actions,
+    clear_conv_caches,
+    create_conv,
+    get_create_user,
+    recipients_cache,
+)
 from em2.protocol.core import Em2Comms, HttpError
 from em2.utils.smtp import find_smtp_files
 
@@ -126,7 +137,7 @@ class ProcessSMTP:
                 if actor_email not in existing_prts:
                     # reply from different address, we need to add the new address to the conversation
                     a = Action(act=ActionTypes.prt_add, participant=actor_email, actor_id=original_actor_id)
-                    all_action_ids = await apply_actions(self.conns, conv_id, [a])
+                    all_action_ids = await apply_actions(self.conns, conv_id, [a], clear_caches=False)
                     assert all_action_ids
                 else:
                     all_action_ids = []
@@ -142,7 +153,9 @@ class ProcessSMTP:
 
                 actions += [Action(act=ActionTypes.prt_add, actor_id=actor_id, participant=addr) for addr in new_prts]
 
-                action_ids = await apply_actions(self.conns, conv_id, actions, spam=spam, warnings=warnings)
+                action_ids = await apply_actions(
+                    self.conns, conv_id, actions, spam=spam, warnings=warnings, batch=True, clear_caches=False
+                )
                 assert action_ids
 
                 all_action_ids += action_ids
@@ -161,7 +174,11 @@ class ProcessSMTP:
                     action_ids,
                 )
                 await pg.execute('update files set send=$1 where action=$2', send_id, add_action_pk)
-                await push_multiple(self.conns, conv_id, action_ids, transmit=False)
+
+            if actor_email not in existing_prts or new_prts:
+                # participants caches are cleared once the outer transaction has committed
+                await clear_conv_caches(self.conns, conv_id)
+            await push_multiple(self.conns, conv_id, action_ids, transmit=False)
         else:
             async with pg.transaction():
                 actions = [Action(act=ActionTypes.prt_add, actor_id=actor_id, participant=r) for r in recipients]
@@ -335,6 +352,7 @@ async def get_leader(ctx, conv_id: int, pg: BuildPgConnection) -> Optional[str]:
         elif user_type == UserTypes.new:
             if await em2.check_local(email):
                 await pg.execute("update users set user_type='local' where email=$1", email)
+                await recipients_cache.clear_user(pg, ctx['redis'], email)
                 return
 
         try:
@@ -347,6 +365,7 @@ async def get_leader(ctx, conv_id: int, pg: BuildPgConnection) -> Optional[str]:
         new_user_type = UserTypes.remote_em2 if em2_node else UserTypes.remote_other
         if user_type != new_user_type:
             await pg.execute('update users set user_type=$1, v=null where email=$2', new_user_type, email)
+            await recipients_cache.clear_user(pg, ctx['redis'], email)
         if em2_node:
             return em2_node
 
@@ -16,9 +16,11 @@ from em2.core import (
     File,
     UserTypes,
     apply_actions,
+    clear_conv_caches,
     create_conv,
     get_create_multiple_users,
     get_create_user,
+    participant_action_types,
 )
 from em2.protocol.core import HttpError, InvalidSignature
 from em2.utils.core import MsgFormat
@@ -230,6 +232,9 @@ class _PushBase(ExecView):
             conv_id, action_ids = await self.execute_trans(m, request_em2_node)
 
         if conv_id:
+            if any(a.act in participant_action_types for a in m.actions):
+                # participants caches are cleared once the transaction has committed
+                await clear_conv_caches(self.conns, conv_id)
             await self.re_push(m, conv_id, action_ids)
 
             for content_id in file_content_ids:
@@ -342,7 +347,9 @@ class Em2Push(_PushBase):
         ]
 
         try:
-            await apply_actions(self.conns, conv_id, actions, allow_multiple_actors=True)
+            await apply_actions(
+                self.conns, conv_id, actions, allow_multiple_actors=True, batch=True, clear_caches=False
+            )
         except JsonErrors.HTTPNotFound:
             # happens when an actor hasn't yet been added to the conversation, any other times?
             # TODO any other errors?
@@ -444,7 +451,9 @@ class Em2FollowerPush(_PushBase):
         ]
 
         try:
-            action_ids = await apply_actions(self.conns, conv_id, actions, allow_multiple_actors=True)
+            action_ids = await apply_actions(
+                self.conns, conv_id, actions, allow_multiple_actors=True, batch=True, clear_caches=False
+            )
         except JsonErrors.HTTPNotFound:
             # happens when an actor hasn't yet been added to the conversation, any other times?
             # TODO any other errors?
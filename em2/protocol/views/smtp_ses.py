@@ -18,6 +18,7 @@ from pydantic.datetime_parse import parse_datetime
 from yarl import URL
 
 from em2.background import push_multiple
+from em2.core import conv_ref_cache, recipients_cache
 from em2.protocol.smtp.receive import InvalidEmailMsg, get_email_recipients, process_smtp, remove_participants
 from em2.settings import Settings
 from em2.utils.db import conns_from_request
@@ -208,10 +209,14 @@ async def _record_email_event(request, message: Dict):
         if not send_complete:
             await conn.execute('update sends set complete=true where id=$1', send_id)
 
-        if complaint:
+        if complaint and user_ids:
             action_ids = await remove_participants(conn, conv_id, ts, user_ids)
-            await push_multiple(conns_from_request(request), conv_id, action_ids)
 
+    if complaint and user_ids:
+        # caches are cleared once the removal has committed so the old participants can't be cached again
+        await recipients_cache.clear(request.app['redis'], [conv_id])
+        await conv_ref_cache.clear(request.app['redis'], user_ids)
+        await push_multiple(conns_from_request(request), conv_id, action_ids)
     return event_type
 
 
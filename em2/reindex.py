@@ -0,0 +1,119 @@
+"""
+Rebuild the text of all search entries with the configured search backend, required after changing how search
+text is built, e.g. weights or the parsing in message_simplify, _prepare_address or _prepare_files.
+
+Conversation ids are split into ranges which are reindexed in parallel by a process pool, each range is updated
+with short statements so no long locks are held and the database can remain live. Completed ranges are recorded
+in redis so an interrupted run resumes where it left off. Cached search results of users in each range are cleared
+once it's reindexed.
+
+    python -m em2.reindex [--processes 4] [--range-size 500] [--restart]
+"""
+import asyncio
+import logging
+import os
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+from typing import Tuple
+
+from arq import create_pool
+from buildpg import asyncpg
+
+from em2.search import get_search_backend, search_cache
+from em2.settings import Settings
+from em2.utils.db import Connections
+
+logger = logging.getLogger('em2.reindex')
+reindex_done_key = 'search-reindex-done'
+
+_process_state = {}
+
+
+def _init_process(settings: Settings):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    _process_state.update(
+        loop=loop,
+        settings=settings,
+        pool=loop.run_until_complete(asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=1, max_size=1)),
+        redis=loop.run_until_complete(create_pool(settings.redis_settings)),
+    )
+
+
+def _reindex_range(start: int, end: int) -> Tuple[int, int]:
+    return _process_state['loop'].run_until_complete(_reindex_range_process(start, end))
+
+
+async def _reindex_range_process(start: int, end: int) -> Tuple[int, int]:
+    async with _process_state['pool'].acquire() as conn:
+        # snapshots are built without the cache, redis is only used to clear cached search results
+        conns = Connections(conn, _process_state['redis'], _process_state['settings'])
+        return start, await reindex_range(conns, start, end)
+
+
+async def reindex_range(conns: Connections, start: int, end: int) -> int:
+    """
+    Reindex search entries for conversations with start <= id < end, returns the number of entries updated.
+    """
+    updated, user_ids = await get_search_backend(conns.settings).reindex_range(conns, start, end)
+    await search_cache.clear(conns.redis, user_ids)
+    return updated
+
+
+async def reindex(settings: Settings, *, processes: int, range_size: int, restart: bool) -> int:  # pragma: no cover
+    redis = await create_pool(settings.redis_settings)
+    pg = await asyncpg.connect_b(dsn=settings.pg_dsn)
+    try:
+        if restart:
+            await redis.delete(reindex_done_key)
+        done = {int(s) for s in await redis.smembers(reindex_done_key)}
+        max_conv_id = await pg.fetchval('select max(id) from conversations') or 0
+    finally:
+        await pg.close()
+
+    ranges = [(s, s + range_size) for s in range(0, max_conv_id + 1, range_size) if s not in done]
+    logger.info(
+        'reindexing search for conversations up to %d, %d ranges to do, %d already done',
+        max_conv_id,
+        len(ranges),
+        len(done),
+    )
+
+    loop = asyncio.get_event_loop()
+    start_time = perf_counter()
+    total = 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_process, initargs=(settings,)) as executor:
+        futures = [loop.run_in_executor(executor, _reindex_range, *r) for r in ranges]
+        for i, f in enumerate(asyncio.as_completed(futures), start=1):
+            range_start, count = await f
+            await redis.sadd(reindex_done_key, range_start)
+            total += count
+            time_taken = perf_counter() - start_time
+            logger.info(
+                '%d/%d ranges complete, %d entries updated, %0.1f entries/s', i, len(ranges), total, total / time_taken
+            )
+
+    await redis.delete(reindex_done_key)
+    redis.close()
+    await redis.wait_closed()
+    logger.info('reindex complete, %d entries updated in %0.1fs', total, perf_counter() - start_time)
+    return total
+
+
+def main():  # pragma: no cover
+    parser = ArgumentParser(description='rebuild search vectors for all conversations')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    parser.add_argument('--range-size', type=int, default=500, help='number of conversation ids per range')
+    parser.add_argument(
+        '--restart', action='store_true', help='ignore progress from previous runs, required if range-size changes'
+    )
+    ns = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    asyncio.get_event_loop().run_until_complete(
+        reindex(Settings(), processes=ns.processes, range_size=ns.range_size, restart=ns.restart)
+    )
+
+
+if __name__ == '__main__':  # pragma: no cover
+    main()
@@ -1,17 +1,37 @@
+import json
+import logging
 import re
-from itertools import chain
-from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from html import escape
+from time import time
+from typing import TYPE_CHECKING, Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
 
 from buildpg import Empty, Func, V, funcs
+from pydantic.utils import import_string
 
+from em2.settings import Settings
 from em2.utils.core import message_simplify
 from em2.utils.db import Connections
 
 if TYPE_CHECKING:  # pragma: no cover
-    from .core import Action, File  # noqa: F401
-
-__all__ = ['search_create_conv', 'search_publish_conv', 'search_update', 'search']
-
+    from .core import Action  # noqa: F401
+
+__all__ = [
+    'search_create_conv',
+    'search_publish_conv',
+    'search_update',
+    'search_index',
+    'search',
+    'search_suggest',
+    'SearchBackend',
+    'PostgresSearchBackend',
+    'get_search_backend',
+]
+logger = logging.getLogger('em2.search')
+
+search_pending_key = 'search-pending'
 has_files_sentinel = 'conversation.has.files'
 min_length = 3
 max_length = 100
@@ -21,6 +41,7 @@ async def search_create_conv(
     conns: Connections,
     *,
     conv_id: int,
+    conv_key: str,
     creator_id: int,
     creator_email: str,
     users: Dict[str, int],
@@ -28,220 +49,749 @@ async def search_create_conv(
     publish: bool,
     messages: List['Action'],
 ):
-    addresses = _prepare_address(creator_email, *users.keys())
-    files = _prepare_files(list(chain(*(m.files for m in messages if m.files))))
-    body = message_simplify(' '.join(m.body for m in messages), messages[0].msg_format)
-    user_ids = [creator_id]
-    if publish:
-        user_ids += list(users.values())
-
-    await conns.main.execute(
-        """
-        insert into search (conv, action, user_ids, creator_email, vector)
-        values (
-          $1,
-          1,
-          $2,
-          $3,
-          setweight(to_tsvector($4), 'A') ||
-          setweight(to_tsvector($5), 'B') ||
-          setweight(to_tsvector($6), 'C') ||
-          to_tsvector($7)
-        )
-        """,
-        conv_id,
-        user_ids,
-        creator_email,
-        subject,
-        addresses,
-        files,
-        body,
+    await get_search_backend(conns.settings).create_conv(
+        conns,
+        conv_id=conv_id,
+        conv_key=conv_key,
+        creator_id=creator_id,
+        creator_email=creator_email,
+        users=users,
+        subject=subject,
+        publish=publish,
+        messages=messages,
     )
 
 
 async def search_publish_conv(conns: Connections, conv_id: int, old_key: str, new_key: str):
-    await conns.main.execute(
-        """
-        with t as (
-            select p.conv, array_agg(p.user_id) user_ids
-            from participants p where p.conv = $1
-            group by p.conv
-        )
-        update search set user_ids=t.user_ids from t where search.conv=t.conv
-        """,
-        conv_id,
-    )
+    await get_search_backend(conns.settings).publish_conv(conns, conv_id, old_key, new_key)
 
 
 async def search_update(conns: Connections, conv_id: int, actions: List[Tuple[int, Optional[int], 'Action']]):
     """
-    If this gets slow it could be done on the worker.
+    Update who can see search entries straight away, but only mark the conversation as pending for text changes,
+    text is indexed by search_index to keep full text work out of the request.
+    """
+    if await get_search_backend(conns.settings).update(conns, conv_id, actions):
+        await conns.redis.sadd(search_pending_key, conv_id)
+
 
-    might need to use pg_column_size to to avoid vector getting too long.
+async def search_index(ctx):
+    """
+    Rebuild the text of conversations changed since the last run, run as a cron job so many changes to one
+    conversation in quick succession result in one rebuild.
+    """
+    redis = ctx['redis']
+    tr = redis.multi_exec()
+    conv_ids = tr.smembers(search_pending_key)
+    tr.delete(search_pending_key)
+    await tr.execute()
+    conv_ids = sorted(int(conv_id) for conv_id in await conv_ids)
+    if not conv_ids:
+        return 0
+
+    async with ctx['pg'].acquire() as conn:
+        conns = Connections(conn, redis, ctx['settings'])
+        try:
+            user_ids = await get_search_backend(conns.settings).index(conns, conv_ids)
+            await search_cache.clear(redis, user_ids)
+        except Exception:
+            # try again on the next run
+            await redis.sadd(search_pending_key, *conv_ids)
+            raise
+    return len(conv_ids)
+
+
+class SearchText(NamedTuple):
+    subject: str
+    addresses: str
+    files: str
+    body: str
+    suggestions: List[Tuple[str, str]]
+
+
+class SearchBackend:
     """
+    Indexes and searches conversations, backends are chosen with settings.search_backend.
+
+    Changes to who can see a conversation should take effect in update(), text changes need only take effect in
+    index() which is called by the search_index cron job.
+    """
+
+    async def create_conv(
+        self,
+        conns: Connections,
+        *,
+        conv_id: int,
+        conv_key: str,
+        creator_id: int,
+        creator_email: str,
+        users: Dict[str, int],
+        subject: str,
+        publish: bool,
+        messages: List['Action'],
+    ):
+        raise NotImplementedError()
+
+    async def publish_conv(self, conns: Connections, conv_id: int, old_key: str, new_key: str):
+        raise NotImplementedError()
+
+    async def update(
+        self, conns: Connections, conv_id: int, actions: List[Tuple[int, Optional[int], 'Action']]
+    ) -> bool:
+        """
+        Apply changes made by actions, return True if the conversation needs to be indexed.
+        """
+        raise NotImplementedError()
+
+    async def index(self, conns: Connections, conv_ids: List[int]) -> List[int]:
+        """
+        Rebuild the text of conversations, return ids of users whose search results may have changed.
+        """
+        raise NotImplementedError()
+
+    async def reindex_range(self, conns: Connections, start: int, end: int) -> Tuple[int, List[int]]:
+        """
+        Rebuild the text of conversations with start <= id < end without changing their order,
+        return the number of entries updated and ids of users whose search results may have changed.
+        """
+        raise NotImplementedError()
+
+    async def query(
+        self,
+        conns: Connections,
+        user_id: int,
+        new_query: Optional[str],
+        named_filters: List[Tuple[str, str]],
+        cursor: Optional[str],
+        limit: int,
+    ) -> str:
+        """
+        Find the most recently updated matches after cursor and return the page of results as JSON.
+        """
+        raise NotImplementedError()
+
+    async def suggest(self, conns: Connections, user_id: int, prefix: str) -> str:
+        """
+        Return JSON suggestions for a LIKE pattern matching the prefix typed so far.
+        """
+        raise NotImplementedError()
+
+
+@lru_cache()
+def _load_backend(path: str) -> SearchBackend:
+    return import_string(path)()
+
+
+def get_search_backend(settings: Settings) -> SearchBackend:
+    return _load_backend(settings.search_backend)
+
+
+def indexed_action_types():
     from .core import ActionTypes
 
-    s_update = SearchUpdate(conns, conv_id)
-    async with conns.main.transaction():
-        for action_id, user_id, action in actions:
-            if action.act is ActionTypes.subject_modify:
-                await s_update.modify_subject(action, action_id)
-            elif action.act in {ActionTypes.msg_add, ActionTypes.msg_modify}:
-                await s_update.msg_change(action, action_id, action.files)
-            elif action.act is ActionTypes.prt_add:
-                await s_update.prt_add(action, action_id, user_id)
-            elif action.act is ActionTypes.prt_remove:
-                await s_update.prt_remove(user_id)
+    return {
+        ActionTypes.subject_modify,
+        ActionTypes.msg_add,
+        ActionTypes.msg_modify,
+        ActionTypes.msg_delete,
+        ActionTypes.msg_recover,
+        ActionTypes.prt_add,
+    }
 
 
-class SearchUpdate:
-    def __init__(self, conns: Connections, conv_id: int):
-        self.conns = conns
-        self.conv_id: int = conv_id
+def create_conv_text(
+    conns: Connections, creator_email: str, users: Iterable[str], subject: str, messages: List['Action']
+) -> SearchText:
+    file_names = [f.name for m in messages for f in m.files or []]
+    body = message_simplify(' '.join(m.body for m in messages), messages[0].msg_format)
+    return SearchText(
+        subject,
+        _prepare_address(creator_email, *users),
+        _prepare_files(file_names),
+        body[: conns.settings.search_max_text],
+        _suggestions(subject, [creator_email, *users], file_names),
+    )
+
+
+def snapshot_text(conns: Connections, snapshot: Dict[str, Any], creator_email: str) -> SearchText:
+    """
+    Build the text for a search entry from a snapshot's subject, participants, active messages and their files.
+    """
+    messages = [m for m in snapshot['messages'].values() if m['active']]
+    body = ' '.join(message_simplify(m['body'], m['format']) for m in messages)
+    file_names = [f['name'] for m in messages for f in m.get('files', [])]
+    return SearchText(
+        snapshot['subject'],
+        _prepare_address(creator_email, *snapshot['participants']),
+        _prepare_files(file_names),
+        body[: conns.settings.search_max_text],
+        _suggestions(snapshot['subject'], [creator_email, *snapshot['participants']], file_names),
+    )
+
+
+# number of search entries updated by each statement when reindexing
+reindex_batch_size = 100
+
+
+class PostgresSearchBackend(SearchBackend):
+    """
+    Search with the search, search_members and search_suggestions tables in the main database.
+    """
 
-    async def modify_subject(self, action: 'Action', action_id: int):
-        await self.conns.main.execute(
+    async def create_conv(
+        self,
+        conns: Connections,
+        *,
+        conv_id: int,
+        conv_key: str,
+        creator_id: int,
+        creator_email: str,
+        users: Dict[str, int],
+        subject: str,
+        publish: bool,
+        messages: List['Action'],
+    ):
+        text = create_conv_text(conns, creator_email, users, subject, messages)
+        user_ids = [creator_id]
+        if publish:
+            user_ids += list(users.values())
+
+        search_id = await conns.main.fetchval(
             """
-            update search set vector=vector || setweight(to_tsvector($1), 'A'), action=$2, ts=current_timestamp
-            where conv=$3 and freeze_action=0
+            with s as (
+              insert into search (conv, action, creator_email, vector, snippet_text)
+              values (
+                $1,
+                1,
+                $3,
+                setweight(to_tsvector($4), 'A') ||
+                setweight(to_tsvector($5), 'B') ||
+                setweight(to_tsvector($6), 'C') ||
+                to_tsvector($7),
+                $8
+              )
+              returning id, ts
+            )
+            insert into search_members (search_id, user_id, ts) select s.id, unnest($2::bigint[]), s.ts from s
+            returning search_id
             """,
-            action.body,
-            action_id,
-            self.conv_id,
+            conv_id,
+            user_ids,
+            creator_email,
+            text.subject,
+            text.addresses,
+            text.files,
+            text.body,
+            _snippet_text(conns, text.body),
         )
+        await _insert_suggestions(conns, [(search_id, text.suggestions)])
 
-    async def msg_change(self, action: 'Action', action_id: int, files: Optional[List['File']]):
-        await self.conns.main.execute(
+    async def publish_conv(self, conns: Connections, conv_id: int, old_key: str, new_key: str):
+        await conns.main.execute(
+            """
+            insert into search_members (search_id, user_id, ts)
+            select s.id, p.user_id, s.ts
+            from search s
+            join participants p on s.conv = p.conv
+            where s.conv = $1 and s.freeze_action = 0
+            on conflict (search_id, user_id) do nothing
+            """,
+            conv_id,
+        )
+
+    async def update(
+        self, conns: Connections, conv_id: int, actions: List[Tuple[int, Optional[int], 'Action']]
+    ) -> bool:
+        from .core import ActionTypes
+
+        indexed_types = indexed_action_types()
+        s_update = SearchUpdate(conns, conv_id)
+        async with conns.main.transaction():
+            for action_id, user_id, action in actions:
+                if action.act is ActionTypes.prt_remove:
+                    await s_update.prt_remove(user_id)
+                elif action.act in indexed_types:
+                    if action.act is ActionTypes.prt_add:
+                        await s_update.prt_add(user_id)
+                    s_update.action_id = action_id
+            await s_update.record_action()
+        return s_update.reindex
+
+    async def index(self, conns: Connections, conv_ids: List[int]) -> List[int]:
+        entries = await build_search_entries(conns, V('s.conv') == Func('any', conv_ids))
+        await update_search_vectors(conns, entries, touch=True)
+        user_ids = await conns.main.fetchval(
+            """
+            select array_agg(distinct m.user_id)
+            from search_members m join search s on m.search_id = s.id
+            where s.conv = any($1)
+            """,
+            conv_ids,
+        )
+        return user_ids or []
+
+    async def reindex_range(self, conns: Connections, start: int, end: int) -> Tuple[int, List[int]]:
+        entries = await build_search_entries(conns, (V('s.conv') >= start) & (V('s.conv') < end), cache=False)
+        updated = 0
+        for start_index in range(0, len(entries), reindex_batch_size):
+            end_index = start_index + reindex_batch_size
+            updated += await update_search_vectors(conns, entries[start_index:end_index], touch=False)
+        user_ids = await conns.main.fetchval(
             """
-            update search set
-              vector=vector || setweight(to_tsvector($1), 'C') || to_tsvector($2), action=$3, ts=current_timestamp
-            where conv=$4 and freeze_action=0
+            select array_agg(distinct m.user_id)
+            from search_members m join search s on m.search_id = s.id
+            where s.conv >= $1 and s.conv < $2
             """,
-            _prepare_files(files),
-            message_simplify(action.body, action.msg_format),
-            action_id,
-            self.conv_id,
+            start,
+            end,
         )
+        return updated, user_ids or []
+
+    async def query(
+        self,
+        conns: Connections,
+        user_id: int,
+        new_query: Optional[str],
+        named_filters: List[Tuple[str, str]],
+        cursor: Optional[str],
+        limit: int,
+    ) -> str:
+        sql, kwargs = self.build_query(user_id, new_query, named_filters, cursor, limit)
+        return await conns.main.fetchval_b(sql, **kwargs)
+
+    @staticmethod
+    def build_query(
+        user_id: int,
+        new_query: Optional[str],
+        named_filters: List[Tuple[str, str]],
+        cursor: Optional[str],
+        limit: int,
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Build the query template and arguments used by query(), useful to inspect query plans.
+        """
+        where, page_where = Empty(), Empty()
+        if cursor:
+            rank, ts, search_id = parse_cursor(cursor, bool(new_query))
+            if new_query:
+                # ranked pages are taken from the same candidates, so the cursor is applied after ranking
+                after = Func('row', funcs.cast(rank, 'real'), ts, search_id)
+                page_where &= Func('row', V('rank'), V('updated_ts'), V('search_id')) < after
+            else:
+                where &= Func('row', V('m.ts'), V('m.search_id')) < Func('row', ts, search_id)
+
+        if new_query:
+            query_func = build_query_function(new_query)
+            query_match = V('s.vector').matches(query_func)
+            if re_hex.fullmatch(new_query):
+                # looks like it could be a conv key, search for that too
+                where &= funcs.OR(query_match, V('c.key').like('%' + new_query.lower() + '%'))
+            else:
+                where &= query_match
+            sql = search_rank_sql
+        else:
+            query_func = Empty()
+            sql = search_ts_sql
+
+        for name, value in named_filters:
+            where &= _apply_named_filters(name, value)
+
+        return sql, dict(user_id=user_id, where=where, page_where=page_where, query_func=query_func, limit=limit)
+
+    async def suggest(self, conns: Connections, user_id: int, prefix: str) -> str:
+        return await conns.main.fetchval(search_suggest_sql, user_id, prefix, suggest_limit)
+
+
+class SearchUpdate:
+    def __init__(self, conns: Connections, conv_id: int):
+        self.conns = conns
+        self.conv_id: int = conv_id
+        # last indexed action not yet recorded on the search entry
+        self.action_id: Optional[int] = None
+        self.reindex = False
 
-    async def prt_add(self, action: 'Action', action_id: int, user_id: int):
-        email = action.participant
+    async def record_action(self):
+        """
+        Set the action of the live search entry, this is what entries are frozen at when participants are removed.
+        """
+        if self.action_id:
+            await self.conns.main.execute(
+                'update search set action=$1 where conv=$2 and freeze_action=0', self.action_id, self.conv_id
+            )
+            self.action_id = None
+            self.reindex = True
+
+    async def prt_add(self, user_id: int):
         async with self.conns.main.transaction():
             v = await self.conns.main.execute(
                 """
-                update search set user_ids=array_remove(user_ids, $1)
-                where conv=$2 and freeze_action!=0 and user_ids @> array[$1::bigint]
+                delete from search_members m using search s
+                where m.search_id = s.id and s.conv = $1 and s.freeze_action != 0 and m.user_id = $2
                 """,
-                user_id,
                 self.conv_id,
+                user_id,
             )
-            if v != 'UPDATE 0':
-                # if we've got any search entries with no users delete them
-                await self.conns.main.execute("delete from search where conv=$1 and user_ids='{}'", self.conv_id)
+            if v != 'DELETE 0':
+                # if we've got any frozen search entries with no users delete them
+                await self.conns.main.execute(
+                    """
+                    delete from search s
+                    where conv = $1 and freeze_action != 0
+                    and not exists (select 1 from search_members m where m.search_id = s.id)
+                    """,
+                    self.conv_id,
+                )
             await self.conns.main.execute(
                 """
-                update search set
-                  user_ids=user_ids || array[$1::bigint],
-                  vector=vector || setweight(to_tsvector($2), 'B'),
-                  action=$3,
-                  ts=current_timestamp
-                where conv=$4 and freeze_action=0
+                with s as (
+                  update search set ts=current_timestamp where conv=$1 and freeze_action=0 returning id, ts
+                )
+                insert into search_members (search_id, user_id, ts) select s.id, $2, s.ts from s
+                on conflict (search_id, user_id) do nothing
                 """,
-                user_id,
-                '{} {}'.format(email, email.split('@', 1)[1]),
-                action_id,
                 self.conv_id,
+                user_id,
             )
 
     async def prt_remove(self, user_id: int):
+        """
+        The removed user is moved to a frozen copy of the entry shared by everyone removed at the same action,
+        the vector is copied as of the last search_index run so may be missing changes made in the moments before
+        they were removed until search_index rebuilds it.
+        """
+        await self.record_action()
+        self.reindex = True
         async with self.conns.main.transaction():
             await self.conns.main.execute(
                 """
-                insert into search (conv, action, freeze_action, user_ids, creator_email, vector)
-                select $1, s.action, s.action, array[$2::bigint], s.creator_email, s.vector
-                from search s where conv=$1 and freeze_action=0
-                on conflict (conv, freeze_action) do update set user_ids=search.user_ids || array[$2::bigint]
+                with frozen as (
+                  insert into search (conv, action, freeze_action, ts, creator_email, vector, snippet_text)
+                  select conv, action, action, ts, creator_email, vector, snippet_text
+                  from search where conv=$1 and freeze_action=0
+                  -- no-op update so an existing entry is returned
+                  on conflict (conv, freeze_action) do update set action=search.action
+                  returning id, ts
+                )
+                update search_members m set search_id=frozen.id, ts=frozen.ts
+                from frozen, search s
+                where m.search_id = s.id and s.conv = $1 and s.freeze_action = 0 and m.user_id = $2
                 """,
                 self.conv_id,
                 user_id,
             )
             await self.conns.main.execute(
                 """
-                update search set user_ids=array_remove(user_ids, $1), ts=current_timestamp
-                where conv=$2 and freeze_action=0
+                insert into search_suggestions (search_id, suggestion_type, value)
+                select f.id, ss.suggestion_type, ss.value
+                from search l
+                join search f on l.conv = f.conv and f.freeze_action = l.action
+                join search_suggestions ss on l.id = ss.search_id
+                where l.conv = $1 and l.freeze_action = 0
+                on conflict (search_id, suggestion_type, value) do nothing
                 """,
-                user_id,
                 self.conv_id,
             )
+            await self.conns.main.execute(
+                'update search set ts=current_timestamp where conv=$1 and freeze_action=0', self.conv_id
+            )
+
+
+search_entries_sql = """
+select s.id, s.conv, c.key, c.publish_ts, c.leader_node, s.freeze_action, s.creator_email
+from search s
+join conversations c on s.conv = c.id
+where :where
+order by s.id
+"""
+
+
+class SearchEntry(NamedTuple):
+    search_id: int
+    action: int
+    text: SearchText
+
+
+async def build_search_entries(conns: Connections, where, *, cache: bool = True) -> List[SearchEntry]:
+    """
+    Build the text for search entries, frozen entries use the state of the conversation when they were frozen.
+    """
+    from .core import ConvSummary, _get_conv_snapshot
+
+    entries = []
+    for r in await conns.main.fetch_b(search_entries_sql, where=where):
+        search_id, conv_id, key, publish_ts, leader, freeze_action, creator_email = r
+        c = ConvSummary(conv_id, key, publish_ts, leader, freeze_action or None)
+        snapshot = await _get_conv_snapshot(conns, c, cache=cache)
+        text = snapshot_text(conns, snapshot, creator_email)
+        entries.append(SearchEntry(search_id, freeze_action or snapshot['last_id'], text))
+    return entries
+
+
+async def update_search_vectors(conns: Connections, entries: List[SearchEntry], *, touch: bool) -> int:
+    """
+    Replace search vectors with one multi-row update, "touch" sets ts on live entries so the conversations are
+    ordered as updated. Suggestions for the entries are also replaced, the number of entries updated is returned.
+
+    Without "touch" (when reindexing) entries whose action has moved on since they were built are skipped,
+    search_index has either already written newer text or will do so.
+
+    Vectors and suggestions are replaced in one transaction so suggest never finds an entry without suggestions.
+    """
+    if not entries:
+        return 0
+    async with conns.main.transaction():
+        search_ids = await conns.main.fetchval(
+            """
+            with updated as (
+              update search s set
+                vector=setweight(to_tsvector(t.subject), 'A') ||
+                  setweight(to_tsvector(t.addresses), 'B') ||
+                  setweight(to_tsvector(t.files), 'C') ||
+                  to_tsvector(t.body),
+                action=t.action,
+                snippet_text=t.snippet_text,
+                ts=case when $8 and s.freeze_action=0 then current_timestamp else s.ts end
+              from unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::text[], $6::int[], $7::text[])
+                as t(id, subject, addresses, files, body, action, snippet_text)
+              where s.id = t.id and ($8 or s.action <= t.action)
+              returning s.id
+            )
+            select coalesce(array_agg(id), '{}') from updated
+            """,
+            [e.search_id for e in entries],
+            [e.text.subject for e in entries],
+            [e.text.addresses for e in entries],
+            [e.text.files for e in entries],
+            [e.text.body for e in entries],
+            [e.action for e in entries],
+            [_snippet_text(conns, e.text.body) for e in entries],
+            touch,
+        )
+        await conns.main.execute('delete from search_suggestions where search_id=any($1)', search_ids)
+        updated = set(search_ids)
+        suggestions = [(e.search_id, e.text.suggestions) for e in entries if e.search_id in updated]
+        await _insert_suggestions(conns, suggestions)
+    return len(search_ids)
+
+
+def _snippet_text(conns: Connections, body: str) -> str:
+    # escaped here so ts_headline's <b> tags are the only markup in snippets
+    return escape(body[: conns.settings.search_snippet_text], quote=False)
+
+
+def _suggestions(subject: Optional[str], addresses: Iterable[str], file_names: Iterable[str]) -> List[Tuple[str, str]]:
+    suggestions = {('participant', a) for a in addresses}
+    suggestions |= {('file', n) for n in file_names if n}
+    if subject:
+        suggestions.add(('subject', subject))
+    # values longer than the column can't usefully be completed anyway
+    return [(t, v[:255]) for t, v in sorted(suggestions)]
+
+
+async def _insert_suggestions(conns: Connections, suggestions: List[Tuple[int, List[Tuple[str, str]]]]):
+    rows = [(search_id, t, v) for search_id, s in suggestions for t, v in s]
+    if rows:
+        await conns.main.execute(
+            """
+            insert into search_suggestions (search_id, suggestion_type, value)
+            select search_id, suggestion_type::SuggestionTypes, value
+            from unnest($1::bigint[], $2::varchar[], $3::varchar[]) as t(search_id, suggestion_type, value)
+            on conflict (search_id, suggestion_type, value) do nothing
+            """,
+            *zip(*rows),
+        )
 
 
-search_rank_sql = """
+suggest_limit = 10
+# idx_search_suggestions_value serves the prefix match, matches are then limited to the user's conversations,
+# the user's own address is left out since it's a participant in every conversation
+search_suggest_sql = """
 select json_build_object(
-  'conversations', conversations
-) from (
-  select coalesce(array_to_json(array_agg(row_to_json(t))), '[]') as conversations
+  'suggestions', coalesce(json_agg(json_build_object('type', suggestion_type, 'value', value)), '[]')
+)
+from (
+  select suggestion_type, value
   from (
-    select key, updated_ts, details, publish_ts, seen
-    from (
-      select
-        c.key, coalesce(s.ts, c.updated_ts) updated_ts, c.details, c.publish_ts, p.seen, s.vector,
-        ts_rank_cd(vector, :query_func, 16) rank
-      from search s
-      join conversations c on s.conv = c.id
-      join participants p on c.id = p.conv
-      where p.user_id = :user_id and user_ids @> array[:user_id::bigint] :where
-      order by s.ts desc
-      limit 200
-    ) tt
-    order by rank desc
-    limit 50
+    select distinct on (ss.suggestion_type, lower(ss.value)) ss.suggestion_type, ss.value, m.ts
+    from search_suggestions ss
+    join search_members m on ss.search_id = m.search_id and m.user_id = $1
+    where lower(ss.value) like lower($2) and
+      not (ss.suggestion_type = 'participant' and ss.value = (select email from users where id = $1))
+    order by ss.suggestion_type, lower(ss.value), m.ts desc
   ) t
-) conversations
+  order by ts desc, value
+  limit $3
+) t
 """
+re_like_escape = re.compile(r'([%_\\])')
+
 
-search_ts_sql = """
+async def search_suggest(conns: Connections, user_id: int, query: str) -> str:
+    """
+    Suggest completions of query from the subjects, participants and file names of the user's conversations,
+    this is designed to be called as the user types, search() should be used when they submit.
+    """
+    query = re_null.sub('', query).strip()[:max_length]
+    if not query:
+        return '{"suggestions": []}'
+    prefix = re_like_escape.sub(r'\\\1', query) + '%'
+    return await get_search_backend(conns.settings).suggest(conns, user_id, prefix)
+
+
+# page of results. Without a text query the page is the most recently updated matches after the cursor so each
+# page costs the same. With a text query the search_rank_candidates most recently updated matches are ranked and
+# pages are taken from them in rank order, so a strong older match isn't pushed behind weak recent ones.
+# "next" is the cursor for the next page if this page is full. Snippets are only built for conversations on the page.
+_search_page_sql = """
+with matches as (
+  select c.key, m.ts updated_ts, c.details, c.publish_ts, p.seen, m.search_id {rank}
+  from search_members m
+  join search s on m.search_id = s.id
+  join conversations c on s.conv = c.id
+  join participants p on c.id = p.conv and m.user_id = p.user_id
+  where m.user_id = :user_id :where
+  order by m.ts desc, m.search_id desc
+  limit {matches_limit}
+),
+page as (
+  select * from matches where true :page_where order by {order} limit :limit
+)
 select json_build_object(
-  'conversations', conversations
-) from (
-  select coalesce(array_to_json(array_agg(row_to_json(t))), '[]') as conversations
-  from (
-    select c.key, coalesce(s.ts, c.updated_ts) updated_ts, c.details, c.publish_ts, p.seen
-    from search s
-    join conversations c on s.conv = c.id
-    join participants p on c.id = p.conv
-    where p.user_id = :user_id and user_ids @> array[:user_id::bigint] :where
-    order by s.ts desc
-    limit 50
-  ) t
-) conversations
+  'conversations', (
+    select coalesce(array_to_json(array_agg(row_to_json(t))), '[]')
+    from (select key, updated_ts, details, publish_ts, seen, {snippet} snippet from page order by {order}) t
+  ),
+  'next', (
+    select {cursor}(extract(epoch from updated_ts) * 1000000)::bigint || '-' || search_id
+    from page
+    order by {order}
+    offset :limit - 1
+  )
+)
 """
+# snippets are at most snippet_words words and snippet_max_length characters with matches wrapped in <b></b>,
+# trim_snippet() cuts them without breaking the html
+snippet_words = 20
+snippet_max_length = 300
+search_rank_candidates = 200
+search_rank_sql = _search_page_sql.format(
+    rank=', ts_rank_cd(s.vector, :query_func, 16) rank, s.snippet_text',
+    matches_limit=search_rank_candidates,
+    snippet=(
+        f"trim_snippet(ts_headline(snippet_text, :query_func, "
+        f"'MaxWords={snippet_words}, MinWords={snippet_words // 2}'), {snippet_max_length})"
+    ),
+    order='rank desc, updated_ts desc, search_id desc',
+    cursor="rank::text || '_' || ",
+)
+search_ts_sql = _search_page_sql.format(
+    rank='', matches_limit=':limit', snippet='null', order='updated_ts desc, search_id desc', cursor=''
+)
+search_page_size = 50
+re_cursor = re.compile(r'(?:(-?[0-9.]+(?:e[+-]?[0-9]+)?)_)?(\d+)-(\d+)')
+epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+def parse_cursor(cursor: str, ranked: bool) -> Tuple[Optional[float], datetime, int]:
+    """
+    Parse a cursor "<ts as epoch microseconds>-<id of the entry>" as returned in "next", cursors for queries
+    ordered by rank are prefixed with "<rank>_".
+    """
+    m = re_cursor.fullmatch(cursor)
+    if not m or (m.group(1) is None) == ranked:
+        raise ValueError(f'invalid search cursor "{cursor}"')
+    rank = m.group(1) and float(m.group(1))
+    return rank, epoch + timedelta(microseconds=int(m.group(2))), int(m.group(3))
 
 
-async def search(conns: Connections, user_id: int, query: str):
-    # TODO cache results based on user id and query, clear on prepare above
+class SearchCache:
+    """
+    Redis cache of search results for each user.
+
+    Results are stored against the user's v which changes whenever one of their conversations changes, so results
+    are never stale, search_index clears the cache for users of conversations it reindexes since vectors change
+    after v. Each user's cache holds at most max_size results, the least recently used are evicted first.
+    """
+
+    _set_lua = """
+    local results_key, lru_key = KEYS[1], KEYS[2]
+    local field, max_size, ttl = ARGV[1], tonumber(ARGV[4]), ARGV[5]
+    redis.call('hset', results_key, field, ARGV[2])
+    redis.call('zadd', lru_key, ARGV[3], field)
+    local excess = redis.call('zcard', lru_key) - max_size
+    if excess > 0 then
+      redis.call('hdel', results_key, unpack(redis.call('zrange', lru_key, 0, excess - 1)))
+      redis.call('zremrangebyrank', lru_key, 0, excess - 1)
+    end
+    redis.call('expire', results_key, ttl)
+    redis.call('expire', lru_key, ttl)
+    """
+
+    def __init__(self, max_size: int = 50, ttl: int = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        # keys are "hit" and "miss"
+        self.stats = Counter()
+
+    @staticmethod
+    def _keys(user_id: int) -> Tuple[str, str]:
+        return f'search-cache-{user_id}', f'search-cache-lru-{user_id}'
+
+    @property
+    def hit_rate(self) -> Optional[float]:
+        total = self.stats['hit'] + self.stats['miss']
+        return self.stats['hit'] / total if total else None
+
+    async def get(self, redis, user_id: int, v: int, query_key: str) -> Optional[str]:
+        results_key, lru_key = self._keys(user_id)
+        field = f'{v}:{query_key}'
+        tr = redis.multi_exec()
+        result = tr.hget(results_key, field)
+        tr.zadd(lru_key, time(), field, exist=redis.ZSET_IF_EXIST)
+        await tr.execute()
+        result = await result
+        self.stats['hit' if result is not None else 'miss'] += 1
+        return result
+
+    async def set(self, redis, user_id: int, v: int, query_key: str, result: str):
+        args = [f'{v}:{query_key}', result, time(), self.max_size, self.ttl]
+        await redis.eval(self._set_lua, keys=self._keys(user_id), args=args)
+
+    async def clear(self, redis, user_ids: Iterable[int]):
+        keys = [k for user_id in user_ids for k in self._keys(user_id)]
+        if keys:
+            await redis.delete(*keys)
+
+    def reset(self):
+        """
+        Clear stats, redis should be flushed at the same time.
+        """
+        self.stats.clear()
+
+
+search_cache = SearchCache()
+re_whitespace = re.compile(r'\s+')
+
+
+async def search(conns: Connections, user_id: int, query: str, cursor: Optional[str] = None):
+    """
+    Search a user's conversations, cursor should be the "next" value from the previous page of results.
+    """
     new_query, named_filters = _parse_query(query)
     if not new_query and not named_filters:
         # nothing to filter on
-        return '{"conversations": []}'
-
-    where = Empty()
-
-    if new_query:
-        query_func = build_query_function(new_query)
-        query_match = V('s.vector').matches(query_func)
-        if re_hex.fullmatch(new_query):
-            # looks like it could be a conv key, search for that too
-            where &= funcs.OR(query_match, V('c.key').like('%' + new_query.lower() + '%'))
-        else:
-            where &= query_match
-        sql = search_rank_sql
-    else:
-        query_func = Empty()
-        sql = search_ts_sql
+        return '{"conversations": [], "next": null}'
 
-    for name, value in named_filters:
-        where &= _apply_named_filters(name, value)
+    from .core import get_users_v
 
-    return await conns.main.fetchval_b(sql, user_id=user_id, where=where, query_func=query_func)
+    v = (await get_users_v(conns, [user_id]))[user_id]
+    query_key = json.dumps([new_query and re_whitespace.sub(' ', new_query), named_filters, cursor])
+    result = await search_cache.get(conns.redis, user_id, v, query_key)
+    if result is None:
+        backend = get_search_backend(conns.settings)
+        result = await backend.query(conns, user_id, new_query, named_filters, cursor, search_page_size)
+        await search_cache.set(conns.redis, user_id, v, query_key, result)
+    return result
 
 
 re_null = re.compile('\x00')
@@ -325,9 +875,10 @@ def _prepare_address(*addresses: str) -> str:
     return ' '.join(sorted(a))  # sort just to make tests easier
 
 
-def _prepare_files(files: Optional[List['File']]) -> str:
-    if files:
-        f = {has_files_sentinel, *(f.name for f in files if f.name)}
+def _prepare_files(file_names: Iterable[Optional[str]]) -> str:
+    f = set(file_names)
+    if f:
+        f = {has_files_sentinel, *(n for n in f if n)}
         f |= {n.split('.', 1)[1] for n in f if '.' in n}
         return ' '.join(sorted(f))
     else:
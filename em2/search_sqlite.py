@@ -0,0 +1,526 @@
+"""
+Search backend using sqlite FTS5 files so full text search doesn't load the main database, enable with
+search_backend = 'em2.search_sqlite.SqliteSearchBackend'.
+
+Entries are sharded into files by user id, each user has their own entry for every conversation they can search.
+Entries of users removed from a conversation are frozen at the action which removed them so, like the postgres
+backend, they can still find the conversation as they last saw it. Text is only written when conversations are
+created, published and by search_index; access changes are applied by update() straight away.
+
+settings.search_sqlite_dir must be shared by the ui and worker processes.
+"""
+import asyncio
+import json
+import re
+import sqlite3
+from collections import defaultdict
+from datetime import datetime, timedelta
+from html import escape
+from time import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+
+from em2.core import Action, ActionTypes, ConvSummary, _get_conv_snapshot
+from em2.search import (
+    SearchBackend,
+    SearchText,
+    create_conv_text,
+    epoch,
+    has_files_sentinel,
+    indexed_action_types,
+    parse_cursor,
+    re_file_attachment,
+    re_hex,
+    re_tsquery,
+    re_websearch,
+    search_rank_candidates,
+    snapshot_text,
+    snippet_max_length,
+    snippet_words,
+    suggest_limit,
+)
+from em2.settings import Settings
+from em2.utils.db import Connections
+
+schema_sql = """
+pragma journal_mode=wal;
+create table if not exists entries (
+  id integer primary key,
+  user_id integer not null,
+  conv_id integer not null,
+  conv_key text not null,
+  creator_email text not null,
+  -- action which removed the user from the conversation, 0 for live entries
+  freeze_action integer not null default 0,
+  -- last action included in the text
+  action integer not null,
+  -- epoch microseconds
+  ts integer not null,
+  unique (user_id, conv_id)
+);
+create index if not exists idx_entries_user_ts on entries (user_id, ts, id);
+-- rowid is entries.id
+create virtual table if not exists entries_text using fts5(
+  subject, addresses, files, body, tokenize='porter unicode61'
+);
+create table if not exists suggestions (
+  entry_id integer not null,
+  suggestion_type text not null,
+  value text not null,
+  primary key (entry_id, suggestion_type, value)
+) without rowid;
+create index if not exists idx_suggestions_value on suggestions (value collate nocase);
+"""
+# weights of the subject, addresses, files and body columns, like the A, B, C and default weights in postgres
+bm25_weights = '10.0, 4.0, 2.0, 1.0'
+
+# idx_suggestions_value serves the prefix match since like is case insensitive, see search.search_suggest_sql
+search_suggest_sql = r"""
+select s.suggestion_type, s.value, max(e.ts) ts
+from suggestions s
+join entries e on s.entry_id = e.id
+where s.value like ? escape '\' and e.user_id = ? and not (s.suggestion_type = 'participant' and s.value = ?)
+group by s.suggestion_type, lower(s.value)
+order by ts desc, s.value
+limit ?
+"""
+# matches are marked with control characters which can't be in the text so the snippet can be html escaped
+search_snippets_sql = f"""
+select rowid, snippet(entries_text, 3, char(2), char(3), '', {snippet_words})
+from entries_text
+where entries_text match ? and rowid in (select value from json_each(?))
+"""
+search_convs_sql = """
+select c.id, c.key, c.details::text, c.publish_ts, p.seen
+from conversations c
+join participants p on c.id = p.conv
+where c.id = any($1) and p.user_id = $2
+"""
+
+
+class SqliteEntry(NamedTuple):
+    user_id: int
+    conv_id: int
+    conv_key: str
+    creator_email: str
+    freeze_action: int
+    action: int
+    text: SearchText
+    # whether to set ts on existing entries so the conversation is ordered as updated
+    touch: bool
+
+
+class SqliteSearchBackend(SearchBackend):
+    async def create_conv(
+        self,
+        conns: Connections,
+        *,
+        conv_id: int,
+        conv_key: str,
+        creator_id: int,
+        creator_email: str,
+        users: Dict[str, int],
+        subject: str,
+        publish: bool,
+        messages: List[Action],
+    ):
+        text = create_conv_text(conns, creator_email, users, subject, messages)
+        user_ids = [creator_id]
+        if publish:
+            user_ids += list(users.values())
+        await _write(
+            conns.settings, [SqliteEntry(u, conv_id, conv_key, creator_email, 0, 1, text, True) for u in user_ids]
+        )
+
+    async def publish_conv(self, conns: Connections, conv_id: int, old_key: str, new_key: str):
+        # the conversation is indexed straight away so other participants can find it
+        await _write(conns.settings, await _build_entries(conns, [conv_id], touch=True, cache=True))
+
+    async def update(self, conns: Connections, conv_id: int, actions: List[Tuple[int, Optional[int], Action]]) -> bool:
+        indexed_types = indexed_action_types()
+        reindex = False
+        for action_id, user_id, action in actions:
+            if action.act is ActionTypes.prt_remove:
+                await _run(_freeze_entry, conns.settings, user_id, conv_id, action_id)
+                reindex = True
+            elif action.act in indexed_types:
+                # new participants can search the conversation after the next search_index run
+                reindex = True
+        return reindex
+
+    async def index(self, conns: Connections, conv_ids: List[int]) -> List[int]:
+        entries = await _build_entries(conns, conv_ids, touch=True, cache=True)
+        await _write(conns.settings, entries)
+        return sorted({e.user_id for e in entries})
+
+    async def reindex_range(self, conns: Connections, start: int, end: int) -> Tuple[int, List[int]]:
+        conv_ids = await conns.main.fetchval(
+            'select array_agg(id) from conversations where id >= $1 and id < $2', start, end
+        )
+        entries = await _build_entries(conns, conv_ids or [], touch=False, cache=False)
+        return await _write(conns.settings, entries), sorted({e.user_id for e in entries})
+
+    async def query(
+        self,
+        conns: Connections,
+        user_id: int,
+        new_query: Optional[str],
+        named_filters: List[Tuple[str, str]],
+        cursor: Optional[str],
+        limit: int,
+    ) -> str:
+        if new_query:
+            # like postgres, the most recently updated matches are ranked and pages are taken from them in rank order
+            sql, args = _query_sql(user_id, new_query, named_filters, None, search_rank_candidates)
+            rows = sorted(await _run(_fetch, conns.settings, user_id, sql, args), key=_rank_key)
+            if cursor:
+                rank, ts, entry_id = parse_cursor(cursor, True)
+                after = rank, -_epoch_us(ts), -entry_id
+                rows = [r for r in rows if _rank_key(r) > after]
+            page = rows[:limit]
+        else:
+            sql, args = _query_sql(user_id, new_query, named_filters, cursor, limit)
+            page = await _run(_fetch, conns.settings, user_id, sql, args)
+
+        next_cursor = None
+        if len(page) == limit:
+            rank, _, ts, entry_id = page[-1]
+            next_cursor = f'{rank!r}_{ts}-{entry_id}' if new_query else f'{ts}-{entry_id}'
+
+        convs, snippets = {}, {}
+        if page:
+            convs = {r[0]: r for r in await conns.main.fetch(search_convs_sql, [r[1] for r in page], user_id)}
+            match = new_query and fts_query(new_query)
+            if match:
+                args = match, json.dumps([r[3] for r in page])
+                snippets = dict(await _run(_fetch, conns.settings, user_id, search_snippets_sql, args))
+        conversations = []
+        for _, conv_id, ts, entry_id in page:
+            c = convs.get(conv_id)
+            if c:
+                _, key, details, publish_ts, seen = c
+                conversations.append(
+                    {
+                        'key': key,
+                        'updated_ts': (epoch + timedelta(microseconds=ts)).isoformat(),
+                        'details': json.loads(details),
+                        'publish_ts': publish_ts and publish_ts.isoformat(),
+                        'seen': seen,
+                        'snippet': _snippet_html(snippets.get(entry_id)),
+                    }
+                )
+        return json.dumps({'conversations': conversations, 'next': next_cursor})
+
+    async def suggest(self, conns: Connections, user_id: int, prefix: str) -> str:
+        email = await conns.main.fetchval('select email from users where id=$1', user_id)
+        args = prefix, user_id, email, suggest_limit
+        rows = await _run(_fetch, conns.settings, user_id, search_suggest_sql, args)
+        return json.dumps({'suggestions': [{'type': t, 'value': v} for t, v, _ in rows]})
+
+
+async def _build_entries(conns: Connections, conv_ids: List[int], *, touch: bool, cache: bool) -> List[SqliteEntry]:
+    """
+    Build entries for every user who can search the conversations, removed participants get the text as of the
+    action that removed them.
+    """
+    convs = await conns.main.fetch(
+        """
+        select c.id, c.key, c.publish_ts, c.leader_node, c.creator, u.email,
+          array_agg(array[p.user_id, coalesce(p.removal_action_id, 0)]) prts
+        from conversations c
+        join users u on c.creator = u.id
+        join participants p on c.id = p.conv
+        where c.id = any($1)
+        group by c.id, u.email
+        order by c.id
+        """,
+        conv_ids,
+    )
+    entries = []
+    for conv_id, key, publish_ts, leader, creator_id, creator_email, prts in convs:
+        live = await _get_conv_snapshot(conns, ConvSummary(conv_id, key, publish_ts, leader, None), cache=cache)
+        texts = {0: snapshot_text(conns, live, creator_email)}
+        for user_id, removal_action_id in prts:
+            if not publish_ts and user_id != creator_id:
+                # drafts can only be searched by their creator
+                continue
+            if removal_action_id:
+                if removal_action_id not in texts:
+                    c = ConvSummary(conv_id, key, publish_ts, leader, removal_action_id)
+                    snapshot = await _get_conv_snapshot(conns, c, cache=cache)
+                    texts[removal_action_id] = snapshot_text(conns, snapshot, creator_email)
+                action = removal_action_id
+            else:
+                action = live['last_id']
+            text = texts[removal_action_id]
+            entries.append(
+                SqliteEntry(
+                    user_id,
+                    conv_id,
+                    key,
+                    creator_email,
+                    removal_action_id,
+                    action,
+                    text,
+                    touch and not removal_action_id,
+                )
+            )
+    return entries
+
+
+async def _write(settings: Settings, entries: List[SqliteEntry]) -> int:
+    shards = defaultdict(list)
+    for e in entries:
+        shards[_shard(settings, e.user_id)].append(e)
+    return sum(await asyncio.gather(*(_run(_write_entries, settings, shard, es) for shard, es in shards.items())))
+
+
+async def _run(func, *args):
+    # sqlite is blocking, so run in a thread
+    return await asyncio.get_event_loop().run_in_executor(None, func, *args)
+
+
+def _shard(settings: Settings, user_id: int) -> int:
+    return user_id % settings.search_sqlite_shards
+
+
+_prepared_paths: Set[str] = set()
+
+
+def _connect(settings: Settings, shard: int) -> sqlite3.Connection:
+    path = str(settings.search_sqlite_dir / f'search-{shard}.sqlite')
+    if path in _prepared_paths:
+        return sqlite3.connect(path, timeout=30)
+
+    settings.search_sqlite_dir.mkdir(parents=True, exist_ok=True)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(schema_sql)
+    _prepared_paths.add(path)
+    return conn
+
+
+def _fetch(settings: Settings, user_id: int, sql: str, args: Tuple[Any, ...]) -> List[Tuple[Any, ...]]:
+    conn = _connect(settings, _shard(settings, user_id))
+    try:
+        return conn.execute(sql, args).fetchall()
+    finally:
+        conn.close()
+
+
+def _write_entries(settings: Settings, shard: int, entries: List[SqliteEntry]) -> int:
+    now = int(time() * 1_000_000)
+    written = 0
+    conn = _connect(settings, shard)
+    try:
+        with conn:
+            for e in entries:
+                r = conn.execute(
+                    'select id, ts, action from entries where user_id=? and conv_id=?', (e.user_id, e.conv_id)
+                ).fetchone()
+                if r:
+                    entry_id, ts, action = r
+                    if action > e.action:
+                        # a concurrent write (e.g. search_index during a reindex) has already stored newer text
+                        continue
+                    conn.execute(
+                        'update entries set conv_key=?, creator_email=?, freeze_action=?, action=?, ts=? where id=?',
+                        (e.conv_key, e.creator_email, e.freeze_action, e.action, now if e.touch else ts, entry_id),
+                    )
+                    conn.execute('delete from entries_text where rowid=?', (entry_id,))
+                    conn.execute('delete from suggestions where entry_id=?', (entry_id,))
+                else:
+                    entry_id = conn.execute(
+                        """
+                        insert into entries (user_id, conv_id, conv_key, creator_email, freeze_action, action, ts)
+                        values (?, ?, ?, ?, ?, ?, ?)
+                        """,
+                        (e.user_id, e.conv_id, e.conv_key, e.creator_email, e.freeze_action, e.action, now),
+                    ).lastrowid
+                t = e.text
+                conn.execute(
+                    'insert into entries_text (rowid, subject, addresses, files, body) values (?, ?, ?, ?, ?)',
+                    (entry_id, t.subject, t.addresses, t.files, t.body),
+                )
+                conn.executemany(
+                    'insert or ignore into suggestions (entry_id, suggestion_type, value) values (?, ?, ?)',
+                    [(entry_id, suggestion_type, value) for suggestion_type, value in t.suggestions],
+                )
+                written += 1
+    finally:
+        conn.close()
+    return written
+
+
+def _freeze_entry(settings: Settings, user_id: int, conv_id: int, freeze_action: int):
+    conn = _connect(settings, _shard(settings, user_id))
+    try:
+        with conn:
+            conn.execute(
+                'update entries set freeze_action=? where user_id=? and conv_id=? and freeze_action=0',
+                (freeze_action, user_id, conv_id),
+            )
+    finally:
+        conn.close()
+
+
+def _query_sql(
+    user_id: int, new_query: Optional[str], named_filters: List[Tuple[str, str]], cursor: Optional[str], limit: int
+) -> Tuple[str, Tuple[Any, ...]]:
+    """
+    Build sql to find a page of entries, rows are (rank, conv_id, ts, entry_id) ordered by ts, rank is bm25 so lower
+    is better.
+    """
+    ranked, ranked_args = '', []
+    conditions, args = ['e.user_id = ?'], [user_id]
+    if cursor:
+        _, ts, entry_id = parse_cursor(cursor, False)
+        conditions.append('(e.ts, e.id) < (?, ?)')
+        args += [_epoch_us(ts), entry_id]
+
+    rank = 'null'
+    if new_query:
+        rank = '0'
+        match = fts_query(new_query)
+        if match:
+            ranked = f"""
+            with ranked as (
+              select rowid, bm25(entries_text, {bm25_weights}) rank from entries_text where entries_text match ?
+            )
+            """
+            ranked_args = [match]
+            # rank is null for matches on just the conversation key, bm25 is negative so they come last
+            rank = 'coalesce(ranked.rank, 0)'
+            query_match = 'ranked.rowid is not null'
+        else:
+            query_match = '0'
+        if re_hex.fullmatch(new_query):
+            # looks like it could be a conv key, search for that too
+            conditions.append(f"({query_match} or e.conv_key like ? escape '\\')")
+            args.append('%' + _like_escape(new_query.lower()) + '%')
+        else:
+            conditions.append(query_match)
+
+    for name, value in named_filters:
+        condition, condition_args = _named_filter(name, value)
+        conditions.append(condition)
+        args += condition_args
+
+    sql = f"""
+    {ranked}
+    select {rank}, e.conv_id, e.ts, e.id
+    from entries e {'left join ranked on e.id = ranked.rowid' if ranked else ''}
+    where {' and '.join(conditions)}
+    order by e.ts desc, e.id desc
+    limit ?
+    """
+    return sql, (*ranked_args, *args, limit)
+
+
+re_partial_markup = re.compile(r'(?:<b>|<[^>]*|&[^;]*)\Z')
+re_open_match = re.compile(r'<b>[^<]*\Z')
+
+
+def _snippet_html(snippet: Optional[str]) -> Optional[str]:
+    if snippet is None:
+        return None
+    html = escape(snippet, quote=False).replace('\x02', '<b>').replace('\x03', '</b>')
+    if len(html) <= snippet_max_length:
+        return html
+    # same as trim_snippet() in models.sql: space is left to close a match, then cut tags or entities are removed
+    html = re_partial_markup.sub('', html[: snippet_max_length - len('</b>')])
+    if re_open_match.search(html):
+        html += '</b>'
+    return html
+
+
+def _rank_key(row: Tuple[float, int, int, int]) -> Tuple[float, int, int]:
+    rank, _, ts, entry_id = row
+    return rank, -ts, -entry_id
+
+
+def _epoch_us(ts: datetime) -> int:
+    return (ts - epoch) // timedelta(microseconds=1)
+
+
+re_like_escape = re.compile(r'([%_\\])')
+
+
+def _like_escape(s: str) -> str:
+    return re_like_escape.sub(r'\\\1', s)
+
+
+def _named_filter(name: str, value: str) -> Tuple[str, List[Any]]:
+    if name == 'from':
+        return "e.creator_email like ? escape '\\'", [f'%{_like_escape(value)}%']
+    elif name == 'include':
+        return _fts_filter(value, 'addresses')
+    elif name == 'to':
+        condition, args = _fts_filter(value, 'addresses')
+        for a in re_tsquery.findall(value):
+            condition += " and e.creator_email not like ? escape '\\'"
+            args.append(f'%{_like_escape(a)}%')
+        return condition, args
+    elif name in {'file', 'attachment'}:
+        return _fts_filter(value, 'files', sentinel=True)
+    elif name == 'has':
+        if re_file_attachment.fullmatch(value):
+            # this is just any files
+            return _fts_filter('', 'files', sentinel=True)
+        else:
+            return _fts_filter(value, 'addresses')
+    else:
+        assert name == 'subject', name
+        return _fts_filter(value, 'subject', prefixes=False)
+
+
+def _fts_filter(value: str, column: str, *, sentinel: bool = False, prefixes: bool = True) -> Tuple[str, List[Any]]:
+    phrases = [_fts_phrase(w, prefix=prefixes) for w in re_tsquery.findall(value)]
+    if sentinel:
+        phrases.append(_fts_phrase(has_files_sentinel, prefix=False))
+    phrases = [p for p in phrases if p]
+    if not phrases:
+        return '0', []
+    match = ' AND '.join(f'{column} : {p}' for p in phrases)
+    return 'e.id in (select rowid from entries_text where entries_text match ?)', [match]
+
+
+# like unicode61, letters and numbers are token characters
+re_fts_token = re.compile(r'[^\W_]')
+re_fts_websearch = re.compile(r'(-?)(?:"([^"]*)"?|(\S+))')
+
+
+def _fts_phrase(text: str, *, prefix: bool) -> Optional[str]:
+    if re_fts_token.search(text):
+        return '"' + text.replace('"', '""') + '"' + ('*' if prefix else '')
+
+
+def fts_query(query: str) -> Optional[str]:
+    """
+    Build an FTS5 query matching the same conversations as the tsquery from build_query_function.
+    """
+    if not re_websearch.search(query):
+        phrases = [p for p in (_fts_phrase(w, prefix=True) for w in re_tsquery.findall(query)) if p]
+        return ' AND '.join(phrases) or None
+
+    # like websearch_to_tsquery: quoted phrases, "or" and "-" to exclude, no prefix matching
+    clauses: List[List[str]] = []
+    exclude: List[str] = []
+    or_next = False
+    for m in re_fts_websearch.finditer(query):
+        negate, quoted, word = m.groups()
+        if word and word.lower() == 'or' and not negate:
+            or_next = bool(clauses)
+            continue
+        phrase = _fts_phrase(quoted if quoted is not None else ' '.join(re_tsquery.findall(word)), prefix=False)
+        if not phrase:
+            continue
+        if negate:
+            exclude.append(phrase)
+        elif or_next:
+            clauses[-1].append(phrase)
+        else:
+            clauses.append([phrase])
+        or_next = False
+
+    if clauses:
+        match = ' AND '.join('(' + ' OR '.join(c) + ')' for c in clauses)
+        return ''.join([match, *(f' NOT {p}' for p in exclude)])
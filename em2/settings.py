@@ -34,6 +34,14 @@ class Settings(BaseSettings):
     max_login_attempts = 20
     # how long micro sessions can last before they need to be checked with auth
     micro_session_duration = 60 * 15
+    # number of events and seconds events are kept for each user so websockets can replay events missed while
+    # reconnecting
+    ws_replay_events = 200
+    ws_replay_ttl = 3600
+    # messages queued for each websocket before messages are merged or the websocket is closed, and seconds to wait
+    # for a message to send before closing the websocket
+    ws_queue_size = 100
+    ws_send_timeout = 10
     # how many seconds until an idle session expires
     session_expiry = 86400 * 4
     # used for testing only to slow down the UI app
@@ -67,6 +75,15 @@ class Settings(BaseSettings):
     max_ref_image_size = 10 * 1024 ** 2
     max_ref_image_count = 20
     upload_pending_ttl = 3600
+    # maximum length of message text used to build a conversation's search vector
+    search_max_text = 200_000
+    # length of message text stored for search result snippets, matches after this aren't highlighted
+    search_snippet_text = 2000
+    # class used to index and search conversations, em2.search_sqlite.SqliteSearchBackend moves full text search
+    # out of postgres into sqlite files in search_sqlite_dir which must be shared by the ui and worker
+    search_backend = 'em2.search.PostgresSearchBackend'
+    search_sqlite_dir: Path = Path('search-index')
+    search_sqlite_shards = 64
 
     image_sizes = [(800, 800), (400, 400)]
     image_thumbnail_sizes = [(120, 120)]
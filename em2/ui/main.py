@@ -21,6 +21,7 @@ from .views.conversations import (
     ConvPublish,
     GetConvCounts,
     Search,
+    SearchSuggest,
     SetConvFlag,
 )
 from .views.files import GetFile, GetHtmlImage, UploadFile
@@ -59,6 +60,7 @@ async def create_app_ui(main_app: web.Application):
         web.get(s + fr'conv/{conv_match}/html-image/{{url:.*}}', GetHtmlImage.view(), name='get-html-image'),
         web.get(s + fr'conv/{conv_match}/upload-file/', UploadFile.view(), name='upload-file'),
         web.get(s + 'search/', Search.view(), name='search'),
+        web.get(s + 'search/suggest/', SearchSuggest.view(), name='search-suggest'),
         web.get(s + 'ws/', websocket, name='websocket'),
         web.post(s + 'webpush-subscribe/', WebPushSubscribe.view(), name='webpush-subscribe'),
         web.post(s + 'webpush-unsubscribe/', WebPushUnsubscribe.view(), name='webpush-unsubscribe'),
@@ -5,9 +5,10 @@ from itertools import chain
 from typing import Any, Dict, List, Optional, Tuple
 from uuid import uuid4
 
+from aiohttp.web import StreamResponse
 from atoolbox import JsonErrors, get_offset, json_response, parse_request_query, raw_json_response
 from buildpg import MultipleValues, SetValues, V, Values, funcs
-from pydantic import BaseModel, EmailStr, Extra, constr, validator
+from pydantic import BaseModel, EmailStr, Extra, conint, constr, validator
 
 from em2.background import push_all, user_actions
 from em2.contacts import add_contacts
@@ -18,19 +19,23 @@ from em2.core import (
     UpdateFlag,
     construct_conv,
     conv_actions_json,
+    conv_actions_stream,
+    conv_ref_cache,
     create_conv,
+    delete_conv_snapshots,
     follow_action_types,
     generate_conv_key,
     get_conv_for_user,
     get_flag_counts,
-    get_label_counts,
     max_participants,
     participant_action_types,
+    recipients_cache,
+    update_cached_flags,
     update_conv_flags,
     update_conv_users,
     with_body_actions,
 )
-from em2.search import search, search_publish_conv
+from em2.search import search, search_publish_conv, search_suggest
 from em2.utils.core import MsgFormat
 from em2.utils.datetime import utcnow
 from em2.utils.db import or404
@@ -121,13 +126,26 @@ class ConvList(View):
 class ConvActions(View):
     class QueryModel(BaseModel):
         since: int = None
+        before: int = None
+        limit: conint(ge=1, le=1000) = None
+        stream: bool = False
 
     async def call(self):
         m = parse_request_query(self.request, self.QueryModel)
-        json_str = await conv_actions_json(
-            self.conns, self.session.user_id, self.request.match_info['conv'], since_id=m.since, inc_seen=True
-        )
-        return raw_json_response(json_str)
+        kwargs = dict(since_id=m.since, before_id=m.before, limit=m.limit, inc_seen=True)
+        conv_ref = self.request.match_info['conv']
+        if not m.stream:
+            json_str = await conv_actions_json(self.conns, self.session.user_id, conv_ref, **kwargs)
+            return raw_json_response(json_str)
+
+        # newline delimited json, one action per line, avoids building the full response in memory
+        actions = await conv_actions_stream(self.conns, self.session.user_id, conv_ref, **kwargs)
+        response = StreamResponse()
+        response.content_type = 'text/plain'
+        await response.prepare(self.request)
+        async for action_json in actions:
+            await response.write(action_json.encode() + b'\n')
+        return response
 
 
 class ConvDetails(View):
@@ -328,7 +346,10 @@ class ConvPublish(ExecView):
                 if publish_ts:
                     raise JsonErrors.HTTPBadRequest('Conversation already published')
                 await self.conn.execute(
-                    'update conversations set publish_ts=current_timestamp, last_action_id=0, key=$2 where id=$1',
+                    """
+                    update conversations set publish_ts=current_timestamp, last_action_id=0, msg_count=0, key=$2
+                    where id=$1
+                    """,
                     c.id,
                     conv_key,
                 )
@@ -366,15 +387,20 @@ class ConvPublish(ExecView):
             )
             user_ids = await update_conv_users(self.conns, c.id)
 
-        other_user_ids = set(user_ids) - {self.session.user_id}
-        updates = (
-            UpdateFlag(self.session.user_id, [(ConvFlags.draft, -1), (ConvFlags.sent, 1)]),
-            *(
-                UpdateFlag(u_id, [(ConvFlags.inbox, 1), (ConvFlags.unseen, 1), (ConvFlags.all, 1)])
-                for u_id in other_user_ids
-            ),
-        )
-        await update_conv_flags(self.conns, *updates)
+            other_user_ids = set(user_ids) - {self.session.user_id}
+            updates = (
+                UpdateFlag(self.session.user_id, [(ConvFlags.draft, -1), (ConvFlags.sent, 1)]),
+                *(
+                    UpdateFlag(u_id, [(ConvFlags.inbox, 1), (ConvFlags.unseen, 1), (ConvFlags.all, 1)])
+                    for u_id in other_user_ids
+                ),
+            )
+            flag_totals = await update_conv_flags(self.conns, *updates)
+
+        await update_cached_flags(self.conns.redis, flag_totals)
+        await delete_conv_snapshots(self.conns.redis, c.id)
+        await conv_ref_cache.clear(self.conns.redis, user_ids)
+        await recipients_cache.clear(self.conns.redis, [c.id])
         await search_publish_conv(self.conns, c.id, old_key, conv_key)
         await push_all(self.conns, c.id)
         return dict(key=conv_key)
@@ -434,7 +460,8 @@ class SetConvFlag(View):
 
             values, changes = self.get_update_values(flag, inbox, seen, deleted, spam, sent, draft)
             await self.conn.execute_b('update participants set :values where id=:id', values=values, id=participant_id)
-        await update_conv_flags(self.conns, UpdateFlag(self.session.user_id, changes))
+            flag_totals = await update_conv_flags(self.conns, UpdateFlag(self.session.user_id, changes))
+        await update_cached_flags(self.conns.redis, flag_totals)
 
         conv_flags = await self.conn.fetchrow(
             """
@@ -551,31 +578,45 @@ class GetConvCounts(View):
     class QueryModel(BaseModel):
         force_update: bool = False
 
+    # conv_count is maintained by the participant-labels triggers
     labels_sql = """
-    select l.id, name, color, description
-    from labels l
-    left join participants p on label_ids @> array[l.id]
-    where l.user_id = $1
-    group by l.id
-    order by l.ordering, l.id
+    select id, name, color, description, conv_count count
+    from labels
+    where user_id = $1
+    order by ordering, id
     """
 
     async def call(self):
         force_update = parse_request_query(self.request, self.QueryModel).force_update
         flags = await get_flag_counts(self.conns, self.session.user_id, force_update=force_update)
-        label_counts = await get_label_counts(self.conns, self.session.user_id)
-        labels = [
-            dict(id=r[0], name=r[1], color=r[2], description=r[3], count=label_counts[str(r[0])])
-            for r in await self.conn.fetch(self.labels_sql, self.session.user_id)
-        ]
+        labels = [dict(r) for r in await self.conn.fetch(self.labels_sql, self.session.user_id)]
         return json_response(flags=flags, labels=labels)
 
 
+# "next" from the previous page, prefixed with the rank for text queries, see em2.search.parse_cursor
+search_cursor_regex = r'^(?:-?[0-9.]+(?:e[+-]?[0-9]+)?_)?\d+-\d+$'
+
+
 class Search(View):
+    class QueryModel(BaseModel):
+        query: str = ''
+        cursor: constr(regex=search_cursor_regex) = None
+
+    async def call(self):
+        m = parse_request_query(self.request, self.QueryModel)
+        try:
+            ans = await search(self.conns, self.session.user_id, m.query, m.cursor)
+        except ValueError as e:
+            # eg. a cursor from a query without text used with one that's ranked
+            raise JsonErrors.HTTPBadRequest(str(e))
+        return raw_json_response(ans)
+
+
+class SearchSuggest(View):
     class QueryModel(BaseModel):
         query: str = ''
 
     async def call(self):
         query = parse_request_query(self.request, self.QueryModel).query
-        ans = await search(self.conns, self.session.user_id, query)
+        ans = await search_suggest(self.conns, self.session.user_id, query)
         return raw_json_response(ans)
@@ -7,6 +7,8 @@ from aiohttp.web_ws import WebSocketResponse
 from atoolbox import JsonErrors
 
 from em2.background import Background
+from em2.core import get_users_v
+from em2.utils.db import Connections
 from em2.utils.web_push import SubscriptionModel, subscribe, unsubscribe
 
 from ..middleware import WsReauthenticate, load_session
@@ -32,15 +34,18 @@ async def websocket(request):
     logger.debug('ws connection user=%s', session.user_id)
     await ws.prepare(request)
 
-    pg = request.app['pg']
-    json_obj = await pg.fetchval("select json_build_object('user_v', v) from users where id=$1", session.user_id)
-    await ws.send_str(json_obj)
-
     background: Background = request.app['background']
-    background.add_ws(session.user_id, ws)
+    conns = Connections(request.app['pg'], request.app['redis'], request.app['settings'])
+    users_v = await get_users_v(conns, [session.user_id])
+    await ws.send_json({'user_v': users_v.get(session.user_id)})
+    # clients reconnecting send the id of the last event they received so missed events can be replayed
+    last_event_id = request.query.get('last_event_id')
 
     # could update
     try:
+        await background.add_ws(session.user_id, ws, replay=bool(last_event_id))
+        if last_event_id:
+            await background.replay(session.user_id, ws, last_event_id)
         async for msg in ws:
             if msg.tp == WSMsgType.ERROR:
                 logger.warning('ws connection closed with exception %s', ws.exception())
@@ -52,7 +57,7 @@ async def websocket(request):
         pass
     finally:
         logger.debug('ws disconnection user=%s', session.user_id)
-        background.remove_ws(session.user_id, ws)
+        await background.remove_ws(session.user_id, ws)
     return ws
 
 
@@ -11,7 +11,7 @@ from aiohttp.web_exceptions import HTTPGatewayTimeout
 from aioredis import Redis
 from buildpg.asyncpg import BuildPgConnection
 
-from em2.core import File
+from em2.core import File, delete_conv_snapshots
 from em2.settings import Settings
 
 from . import listify
@@ -115,6 +115,7 @@ class CopyToTemp:
                 content_id,
             )
             assert v
+        await delete_conv_snapshots(self.redis, conv_id)
 
     async def _upload_file(self, s3_client: S3Client, conv_key, send_path, file: File) -> Tuple[str, str, int]:
         path = f'{conv_key}/{send_path}/{file.content_id}/{file.name}'
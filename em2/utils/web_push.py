@@ -16,7 +16,7 @@ from cryptography.hazmat.primitives.asymmetric import ec
 from py_vapid import Vapid02 as Vapid
 from pydantic import BaseModel, HttpUrl
 
-from em2.core import get_flag_counts
+from em2.core import get_flag_counts, get_users_v
 from em2.settings import Settings
 from em2.utils.db import Connections
 
@@ -50,15 +50,10 @@ async def subscribe(conns: Connections, client_session: ClientSession, sub: Subs
     key = web_push_user_key_prefix(user_id) + sub.hash()
     # we could use expirationTime here, but it seems to generally be null
     await conns.redis.setex(key, 86400, sub.json())
-    msg = await conns.main.fetchval(
-        """
-        select json_build_object('user_v', v, 'user_id', id)
-        from users where id=$1
-        """,
-        user_id,
-    )
-    if not msg:
+    users_v = await get_users_v(conns, [user_id])
+    if users_v.get(user_id) is None:
         raise JsonErrors.HTTPUnauthorized('user not found')
+    msg = ujson.dumps({'user_v': users_v[user_id], 'user_id': user_id})
     await _sub_post(conns, client_session, sub, user_id, msg)
 
 
@@ -3,11 +3,11 @@ from typing import Type
 
 from aiodns import DNSResolver
 from aiohttp import ClientSession, ClientTimeout
-from arq import Worker
+from arq import Worker, cron
 from buildpg import asyncpg
 from pydantic.utils import import_string
 
-from em2.background import user_actions_with_files
+from em2.background import flush_user_versions, reconcile_all_flag_counts, user_actions_with_files
 from em2.protocol.contacts import update_profiles
 from em2.protocol.core import get_signing_key
 from em2.protocol.files import download_push_file
@@ -15,6 +15,7 @@ from em2.protocol.push import follower_push_actions, push_actions
 from em2.protocol.smtp import BaseSmtpHandler, smtp_send
 from em2.protocol.smtp.images import get_images
 from em2.protocol.smtp.receive import post_receipt
+from em2.search import search_index
 from em2.settings import Settings
 from em2.ui.views.contacts import delete_stale_image
 from em2.ui.views.files import delete_stale_upload
@@ -53,7 +54,12 @@ functions = [
     update_profiles,
     delete_stale_image,
 ]
-worker_settings = dict(functions=functions, on_startup=startup, on_shutdown=shutdown)
+cron_jobs = [
+    cron(flush_user_versions, second={0, 10, 20, 30, 40, 50}, microsecond=0),
+    cron(search_index, second=set(range(0, 60, 5)), microsecond=0),
+    cron(reconcile_all_flag_counts, hour=3, minute=0, second=0, microsecond=0, timeout=3600),
+]
+worker_settings = dict(functions=functions, cron_jobs=cron_jobs, on_startup=startup, on_shutdown=shutdown)
 
 
 def run_worker(settings: Settings):  # pragma: no cover
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Benchmark updating cached flag counts for many users, compares the previous approach of separate exists, expire
+and hincrby commands per user with the single lua script used by update_cached_flags.
+
+Requires redis running locally, uses database 15 which is flushed.
+
+    ./tests/benchmark_flags.py [participants] [repeats]
+"""
+import asyncio
+import sys
+from pathlib import Path
+from time import perf_counter
+
+from aioredis import create_redis
+
+THIS_DIR = Path(__file__).parent.resolve()
+sys.path.append(str(THIS_DIR.parent))
+
+from em2.core import ConvFlags, _flags_count_key, update_cached_flags  # noqa: E402
+
+
+async def update_separate_commands(redis, totals):
+    # equivalent of update_cached_flags before it used a script
+    async def update(user_id, user_totals):
+        key = _flags_count_key(user_id)
+        if await redis.exists(key):
+            await asyncio.gather(redis.expire(key, 86400), *(redis.hincrby(key, f, v) for f, v in user_totals.items()))
+
+    await asyncio.gather(*(update(user_id, user_totals) for user_id, user_totals in totals.items()))
+
+
+async def main(participants: int, repeats: int):
+    redis = await create_redis(('localhost', 6379), db=15, encoding='utf8')
+    await redis.flushdb()
+    # as when a conversation is published: inbox, unseen and all change for every participant
+    totals = {user_id: {'inbox': 1, 'unseen': 1, 'all': 1} for user_id in range(1, participants + 1)}
+    for user_id in totals:
+        await redis.hmset_dict(_flags_count_key(user_id), {f.value: 0 for f in ConvFlags})
+
+    for name, func in (('separate commands', update_separate_commands), ('lua script', update_cached_flags)):
+        start = perf_counter()
+        for _ in range(repeats):
+            await func(redis, totals)
+        time_taken = (perf_counter() - start) / repeats * 1000
+        print(f'{name:>20}: {time_taken:6.2f}ms per update, {participants} participants')
+
+    counts = await redis.hgetall(_flags_count_key(1))
+    assert int(counts['inbox']) == repeats * 2, counts
+    redis.close()
+    await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    participants_, repeats_ = 64, 200
+    if len(sys.argv) > 1:
+        participants_ = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        repeats_ = int(sys.argv[2])
+    asyncio.get_event_loop().run_until_complete(main(participants_, repeats_))
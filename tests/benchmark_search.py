@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+"""
+Benchmark search against a synthetic mailbox corpus.
+
+Users, conversations (with a power-law distribution of messages and participants), markdown, html and plain
+bodies and attachments are created with create_conv and apply_actions, then a mix of queries is run through
+em2.search.search for random users. Prints p50, p95 and p99 latency for each type of query and a summary of the
+query plan of one query of each type.
+
+Requires postgres and redis running locally, the "em2_search_benchmark" database is recreated unless --skip-load
+is used and redis database 15 is flushed.
+
+    ./tests/benchmark_search.py [--users 50] [--convs 2000] [--queries 200] [--skip-load] [--max-p95 ms]
+"""
+import asyncio
+import json
+import sys
+from argparse import ArgumentParser
+from pathlib import Path
+from random import Random
+from time import perf_counter
+from typing import Callable, Dict, List, Tuple
+from uuid import uuid4
+
+from arq import create_pool
+from atoolbox.db import prepare_database
+from buildpg import asyncpg, render
+
+THIS_DIR = Path(__file__).parent.resolve()
+sys.path.append(str(THIS_DIR.parent))
+
+from em2.core import (  # noqa: E402
+    Action,
+    ActionTypes,
+    Connections,
+    File,
+    MsgFormat,
+    UserTypes,
+    apply_actions,
+    create_conv,
+    get_create_user,
+)
+from em2.search import (  # noqa: E402
+    PostgresSearchBackend,
+    _parse_query,
+    get_search_backend,
+    search,
+    search_cache,
+    search_index,
+    search_page_size,
+)
+from em2.settings import Settings  # noqa: E402
+
+vocabulary = """
+meeting project budget report invoice contract schedule review proposal design launch customer client supplier
+order delivery shipment payment account quarter revenue forecast target strategy marketing campaign product
+release feature roadmap sprint deadline update agenda minutes notes summary draft final approval signature
+office travel flight hotel conference dinner lunch coffee holiday birthday party team hiring interview candidate
+offer salary benefits policy security password access server database backup migration deploy incident outage
+support ticket issue feedback survey results analysis spreadsheet presentation slides document photo video
+apple banana cherry garden kitchen house rent lease mortgage insurance school teacher homework football tennis
+weather london paris berlin tokyo york sydney monday tuesday wednesday thursday friday weekend morning evening
+""".split()
+# word frequencies roughly follow Zipf's law
+vocabulary_weights = [1 / (i + 1) for i in range(len(vocabulary))]
+domains = 'example.com', 'example.org', 'acme.co.uk', 'widgets.io', 'mail.example.net'
+file_types = 'pdf', 'docx', 'xlsx', 'png', 'jpg', 'txt', 'zip'
+
+
+class Corpus:
+    def __init__(self, rng: Random, users: int):
+        self.rng = rng
+        self.user_emails = [f'user-{i}@example.com' for i in range(users)]
+        self.external_emails = [f'{w}.{rng.choice(vocabulary)}@{rng.choice(domains)}' for w in vocabulary]
+
+    def words(self, n: int) -> List[str]:
+        return self.rng.choices(vocabulary, weights=vocabulary_weights, k=n)
+
+    def power_law(self, alpha: float, maximum: int) -> int:
+        return min(int(self.rng.paretovariate(alpha)), maximum)
+
+    def body(self) -> Tuple[str, MsgFormat]:
+        paragraphs = [' '.join(self.words(self.rng.randint(8, 60))) for _ in range(self.rng.randint(1, 4))]
+        msg_format = self.rng.choices([MsgFormat.markdown, MsgFormat.html, MsgFormat.plain], weights=[6, 3, 1])[0]
+        if msg_format == MsgFormat.html:
+            return ''.join(f'<p>{p} <b>{self.words(1)[0]}</b></p>' for p in paragraphs), msg_format
+        elif msg_format == MsgFormat.markdown:
+            link = self.words(1)[0]
+            return '\n\n'.join(paragraphs) + f'\n\n**{link}** [{link}](https://example.com/{link})', msg_format
+        else:
+            return '\n\n'.join(paragraphs), msg_format
+
+    def files(self) -> List[File]:
+        if self.rng.random() > 0.15:
+            return []
+        return [
+            File(
+                hash=uuid4().hex,
+                name='-'.join(self.words(2)) + '.' + self.rng.choice(file_types),
+                content_id=uuid4().hex,
+                content_disp='attachment',
+                content_type='application/octet-stream',
+                size=self.rng.randint(1000, 10_000_000),
+            )
+            for _ in range(self.rng.randint(1, 3))
+        ]
+
+    def message(self, actor_id: int) -> Action:
+        body, msg_format = self.body()
+        return Action(act=ActionTypes.msg_add, actor_id=actor_id, body=body, msg_format=msg_format, files=self.files())
+
+
+async def load(conns: Connections, corpus: Corpus, convs: int) -> Tuple[int, List[int]]:
+    rng = corpus.rng
+    user_ids = {email: await get_create_user(conns, email, UserTypes.local) for email in corpus.user_emails}
+    messages = 0
+    for i in range(convs):
+        creator = rng.choice(corpus.user_emails)
+        creator_id = user_ids[creator]
+        others = set(corpus.user_emails + corpus.external_emails) - {creator}
+        participants = rng.sample(sorted(others), corpus.power_law(1.5, 30) - 1)
+        publish = rng.random() < 0.9
+        actions = [Action(act=ActionTypes.prt_add, actor_id=creator_id, participant=p) for p in participants]
+        actions += [
+            corpus.message(creator_id),
+            Action(
+                act=ActionTypes.conv_publish if publish else ActionTypes.conv_create,
+                actor_id=creator_id,
+                body=' '.join(corpus.words(rng.randint(2, 6))).capitalize(),
+            ),
+        ]
+        conv_id, _ = await create_conv(conns=conns, creator_email=creator, actions=actions)
+        messages += 1
+
+        actors = [creator_id]
+        if publish:
+            actors += [user_ids[p] for p in participants if p in user_ids]
+        for _ in range(corpus.power_law(1.2, 100) - 1):
+            await apply_actions(conns, conv_id, [corpus.message(rng.choice(actors))])
+            messages += 1
+        if i % 100 == 99:
+            print(f'{i + 1}/{convs} conversations created, {messages} messages')
+    return messages, list(user_ids.values())
+
+
+def query_types(corpus: Corpus, keys: List[str]) -> Dict[str, Callable[[], str]]:
+    rng = corpus.rng
+    return {
+        'word': lambda: corpus.words(1)[0],
+        'words': lambda: ' '.join(corpus.words(2)),
+        'prefix': lambda: corpus.words(1)[0][:4],
+        'phrase': lambda: '"{}"'.format(' '.join(corpus.words(2))),
+        'from': lambda: 'from:' + rng.choice(corpus.user_emails),
+        'to': lambda: 'to:' + rng.choice(corpus.user_emails + corpus.external_emails),
+        'file': lambda: 'file:' + corpus.words(1)[0],
+        'subject': lambda: 'subject:' + corpus.words(1)[0],
+        'key': lambda: rng.choice(keys)[5:12],
+    }
+
+
+def percentile(times: List[float], p: float) -> float:
+    # nearest rank, times must be sorted
+    return times[max(0, int(round(p / 100 * len(times))) - 1)]
+
+
+def plan_summary(plan: Dict) -> str:
+    nodes = []
+
+    def walk(node):
+        name = node['Node Type']
+        if 'Index Name' in node:
+            name += f' using {node["Index Name"]}'
+        elif 'Relation Name' in node:
+            name += f' on {node["Relation Name"]}'
+        nodes.append(name)
+        for child in node.get('Plans', []):
+            walk(child)
+
+    walk(plan['Plan'])
+    scans = ', '.join(n for n in nodes if 'Scan' in n)
+    return f'planning {plan["Planning Time"]:0.1f}ms, execution {plan["Execution Time"]:0.1f}ms: {scans}'
+
+
+async def run_queries(conns: Connections, corpus: Corpus, user_ids: List[int], queries: int) -> Dict[str, List[float]]:
+    keys = [r[0] for r in await conns.main.fetch('select key from conversations where publish_ts is not null')]
+    backend = get_search_backend(conns.settings)
+    explain = isinstance(backend, PostgresSearchBackend)
+    results = {}
+    print(f'\n{"query":>8} {"p50":>8} {"p95":>8} {"p99":>8} {"hits":>6}')
+    for name, build_query in query_types(corpus, keys).items():
+        times, hits = [], 0
+        for _ in range(queries):
+            user_id, query = corpus.rng.choice(user_ids), build_query()
+            # measure queries without the result cache
+            await search_cache.clear(conns.redis, [user_id])
+            start = perf_counter()
+            result = await search(conns, user_id, query)
+            times.append((perf_counter() - start) * 1000)
+            hits += bool(json.loads(result)['conversations'])
+
+        times.sort()
+        results[name] = times
+        p50, p95, p99 = (percentile(times, p) for p in (50, 95, 99))
+        print(f'{name:>8} {p50:6.2f}ms {p95:6.2f}ms {p99:6.2f}ms {hits / queries:6.0%}')
+        if explain:
+            new_query, named_filters = _parse_query(query)
+            sql, kwargs = backend.build_query(user_id, new_query, named_filters, None, search_page_size)
+            sql, args = render(sql, **kwargs)
+            plan = json.loads(await conns.main.fetchval('explain (analyze, format json) ' + sql, *args))[0]
+            print(f'{"":>8} {query!r}: {plan_summary(plan)}')
+    return results
+
+
+async def main(*, users: int, convs: int, queries: int, skip_load: bool, seed: int) -> Dict[str, List[float]]:
+    settings = Settings(
+        pg_dsn='postgres://postgres@localhost:5432/em2_search_benchmark', redis_settings='redis://localhost:6379/15'
+    )
+    if not skip_load:
+        await prepare_database(settings, True)
+    redis = await create_pool(settings.redis_settings)
+    await redis.flushdb()
+    pg = await asyncpg.create_pool_b(dsn=settings.pg_dsn, min_size=1, max_size=2)
+    corpus = Corpus(Random(seed), users)
+    try:
+        async with pg.acquire() as conn:
+            conns = Connections(conn, redis, settings)
+            if skip_load:
+                user_ids = await conn.fetchval(
+                    'select array_agg(id) from users where email=any($1)', corpus.user_emails
+                )
+            else:
+                start = perf_counter()
+                messages, user_ids = await load(conns, corpus, convs)
+                time_taken = perf_counter() - start
+                print(f'{convs} conversations, {messages} messages created in {time_taken:0.1f}s')
+
+                start = perf_counter()
+                ctx = {'redis': redis, 'pg': pg, 'settings': settings}
+                while await search_index(ctx):
+                    pass
+                print(f'search index built in {perf_counter() - start:0.1f}s')
+                await conn.execute('analyze')
+
+            return await run_queries(conns, corpus, user_ids, queries)
+    finally:
+        await pg.close()
+        redis.close()
+        await redis.wait_closed()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='benchmark search with a synthetic corpus')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--convs', type=int, default=2000)
+    parser.add_argument('--queries', type=int, default=200, help='number of queries of each type')
+    parser.add_argument('--skip-load', action='store_true', help='use the corpus from the previous run')
+    parser.add_argument('--seed', type=int, default=123)
+    parser.add_argument('--max-p95', type=float, help='exit with an error if any p95 latency in ms is over this')
+    ns = parser.parse_args()
+    results_ = asyncio.get_event_loop().run_until_complete(
+        main(users=ns.users, convs=ns.convs, queries=ns.queries, skip_load=ns.skip_load, seed=ns.seed)
+    )
+    if ns.max_p95:
+        slow = [name for name, times in results_.items() if percentile(times, 95) > ns.max_p95]
+        if slow:
+            print(f'p95 latency over {ns.max_p95}ms: {", ".join(slow)}')
+            sys.exit(1)
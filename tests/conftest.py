@@ -24,11 +24,20 @@ from PIL import Image, ImageDraw
 from yarl import URL
 
 from em2.auth.utils import mk_password
-from em2.background import push_multiple
-from em2.core import Action, Connections, apply_actions, generate_conv_key
+from em2.background import push_actions_cache, push_multiple
+from em2.core import (
+    Action,
+    Connections,
+    apply_actions,
+    conv_actions_cache,
+    conv_ref_cache,
+    generate_conv_key,
+    recipients_cache,
+)
 from em2.main import create_app
 from em2.protocol.core import get_signing_key
 from em2.protocol.smtp import LogSmtpHandler, SesSmtpHandler
+from em2.search import search_cache
 from em2.settings import Settings
 from em2.utils.web import MakeUrl
 from em2.worker import worker_settings
@@ -134,6 +143,11 @@ async def _fix_redis(loop, settings):
 
     redis = await create_redis(addr, db=settings.redis_settings.database, encoding='utf8', commands_factory=ArqRedis)
     await redis.flushdb()
+    conv_ref_cache.reset()
+    conv_actions_cache.reset()
+    push_actions_cache.reset()
+    recipients_cache.reset()
+    search_cache.reset()
 
     yield redis
 
@@ -4,7 +4,7 @@ import pytest
 from pytest_toolbox.comparison import AnyInt, RegexStr
 
 from em2.contacts import add_contacts
-from em2.core import Action, ActionTypes
+from em2.core import Action, ActionTypes, get_users_v
 from em2.ui.views.contacts import delete_stale_image
 from em2.utils.images import InvalidImage, _do_resize, _resize_crop_dims
 
@@ -27,10 +27,10 @@ async def test_create_conv(cli: UserTestClient, factory: Factory, db_conn):
     assert profile_user == await db_conn.fetchval('select id from users where email=$1', 'foobar@example.com')
 
 
-async def test_act_add_contact(cli: UserTestClient, factory: Factory, db_conn):
+async def test_act_add_contact(cli: UserTestClient, factory: Factory, db_conn, conns):
     user = await factory.create_user()
     conv = await factory.create_conv()
-    assert 2 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 2 == (await get_users_v(conns, [user.id]))[user.id]
 
     assert await db_conn.fetchval('select count(*) from contacts') == 0
     data = {'actions': [{'act': 'participant:add', 'participant': 'new@example.com'}]}
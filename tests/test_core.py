@@ -7,7 +7,20 @@ from atoolbox import JsonErrors
 from pydantic import ValidationError
 from pytest_toolbox.comparison import AnyInt, CloseToNow
 
-from em2.core import Action, ActionTypes, construct_conv
+from em2.core import (
+    Action,
+    ActionsJsonCache,
+    ActionTypes,
+    Recipients,
+    apply_actions,
+    clear_conv_caches,
+    construct_conv,
+    conv_actions_cache,
+    conv_ref_cache,
+    delete_conv_snapshots,
+    get_conv_for_user,
+    recipients_cache,
+)
 from em2.ui.views.conversations import ActionModel
 
 from .conftest import Factory
@@ -451,6 +464,59 @@ async def test_object_add_remove_participants(factory: Factory, conns):
     }
 
 
+async def test_object_snapshot(factory: Factory, conns):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+
+    obj = await construct_conv(conns, user.id, conv.id)
+    assert [m['body'] for m in obj['messages']] == ['Test Message']
+    snapshot = json.loads(await conns.redis.hget(f'conv-snapshot-{conv.id}', 'live'))
+    assert snapshot['last_id'] == 3
+
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='reply'))
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='child', parent=4))
+    obj = await construct_conv(conns, user.id, conv.id)
+    assert obj == {
+        'subject': 'Test Subject',
+        'created': CloseToNow(),
+        'messages': [
+            {
+                'ref': 2,
+                'author': 'testing-1@example.com',
+                'body': 'Test Message',
+                'created': CloseToNow(),
+                'format': 'markdown',
+                'active': True,
+            },
+            {
+                'ref': 4,
+                'author': 'testing-1@example.com',
+                'body': 'reply',
+                'created': CloseToNow(),
+                'format': 'markdown',
+                'active': True,
+                'children': [
+                    {
+                        'ref': 5,
+                        'author': 'testing-1@example.com',
+                        'body': 'child',
+                        'created': CloseToNow(),
+                        'format': 'markdown',
+                        'active': True,
+                    }
+                ],
+            },
+        ],
+        'participants': {'testing-1@example.com': {'id': 1}},
+    }
+    snapshot = json.loads(await conns.redis.hget(f'conv-snapshot-{conv.id}', 'live'))
+    assert snapshot['last_id'] == 5
+    assert snapshot['refs'] == {'2': '2', '4': '4', '5': '5'}
+
+    # a snapshot from the cache is unchanged by rendering it
+    assert await construct_conv(conns, user.id, conv.id) == obj
+
+
 async def test_participant_add_cant_get(factory: Factory, conns):
     user = await factory.create_user()
     conv = await factory.create_conv()
@@ -529,6 +595,105 @@ async def test_already_seen(factory: Factory, db_conn):
     assert True is await db_conn.fetchval('select seen from participants where user_id=$1', user2_id)
 
 
+async def test_seen_creator(factory: Factory, db_conn):
+    user = await factory.create_user()
+    conv = await factory.create_conv(publish=True)
+    assert True is await db_conn.fetchval('select seen from participants where user_id=$1', user.id)
+
+    # the creator has seen the conversation, but hasn't yet recorded a seen action
+    assert [4] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.seen))
+    assert [] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.seen))
+    assert 1 == await db_conn.fetchval("select count(*) from actions where conv=$1 and act='seen'", conv.id)
+
+
+async def test_conv_ref_cache(factory: Factory, conns):
+    user = await factory.create_user()
+    user2 = await factory.create_user()
+    conv = await factory.create_conv(publish=True, participants=[{'email': user2.email}])
+    conv_ref_cache.reset()
+
+    c = await get_conv_for_user(conns, user2.id, conv.key[:10])
+    assert (c.id, c.last_action) == (conv.id, None)
+    assert conv_ref_cache.stats == {'miss': 1}
+    assert await get_conv_for_user(conns, user2.id, conv.key[:10]) == c
+    assert conv_ref_cache.stats == {'miss': 1, 'local_hit': 1}
+
+    conv_ref_cache._local.clear()
+    assert await get_conv_for_user(conns, user2.id, conv.key[:10]) == c
+    assert conv_ref_cache.stats == {'miss': 1, 'local_hit': 1, 'redis_hit': 1}
+
+    action = Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=user2.email, follows=2)
+    assert [5] == await factory.act(conv.id, action)
+    c = await get_conv_for_user(conns, user2.id, conv.key[:10])
+    assert c.last_action == 5
+    assert conv_ref_cache.stats['miss'] == 2
+
+
+async def test_actions_json_cache_cleared_during_get(factory: Factory, conns, redis, monkeypatch):
+    await factory.create_user()
+    conv = await factory.create_conv()
+    conv_actions_cache.reset()
+    fetch = conns.main.fetch
+
+    async def fetch_then_clear(*args):
+        r = await fetch(*args)
+        # eg. a file's storage is updated while actions are being queried
+        await delete_conv_snapshots(redis, conv.id)
+        return r
+
+    monkeypatch.setattr(conns.main, 'fetch', fetch_then_clear)
+    actions = await conv_actions_cache.get(conns, conv.id, [1, 2, 3])
+    assert [json.loads(a)['id'] for a in actions] == [1, 2, 3]
+    # the JSON may be out of date so it's not cached
+    assert await redis.hgetall(ActionsJsonCache.key(conv.id)) == {'gen': '1'}
+
+    monkeypatch.setattr(conns.main, 'fetch', fetch)
+    assert await conv_actions_cache.get(conns, conv.id, [1, 2, 3]) == actions
+    assert len(await redis.hgetall(ActionsJsonCache.key(conv.id))) == 4
+    assert conv_actions_cache.stats == {'hit': 0, 'miss': 6}
+
+
+async def test_recipients_cache(factory: Factory, conns):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+    recipients_cache.reset()
+
+    assert await recipients_cache.get(conns, conv.id) == Recipients(False, [(user.id, user.email, 'local')])
+    assert recipients_cache.stats == {'miss': 1}
+    assert await recipients_cache.get(conns, conv.id) == Recipients(False, [(user.id, user.email, 'local')])
+    assert recipients_cache.stats == {'miss': 1, 'hit': 1}
+
+    # pushing the action uses the invalidated cache
+    email2 = 'different@example.com'
+    assert [4] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email2))
+    assert recipients_cache.stats == {'miss': 2, 'hit': 1}
+    # participants other than the creator can't see the draft
+    assert await recipients_cache.get(conns, conv.id) == Recipients(False, [(user.id, user.email, 'local')])
+    assert recipients_cache.stats == {'miss': 2, 'hit': 2}
+
+    action = Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=email2, follows=4)
+    assert [5] == await factory.act(conv.id, action)
+    assert recipients_cache.stats == {'miss': 3, 'hit': 2}
+    assert recipients_cache.hit_rate == 0.4
+
+
+async def test_recipients_cache_outer_transaction(factory: Factory, conns):
+    user = await factory.create_user()
+    conv = await factory.create_conv(publish=True)
+    recipients_cache.reset()
+    assert len((await recipients_cache.get(conns, conv.id)).users) == 1
+
+    email2 = 'different@example.com'
+    async with conns.main.transaction():
+        action = Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email2)
+        assert [4] == await apply_actions(conns, conv.id, [action], clear_caches=False)
+    # not cleared by apply_actions since the outer transaction hadn't committed
+    assert len((await recipients_cache.get(conns, conv.id)).users) == 1
+
+    await clear_conv_caches(conns, conv.id)
+    assert len((await recipients_cache.get(conns, conv.id)).users) == 2
+
+
 async def test_participant_add_many(factory: Factory, db_conn):
     user = await factory.create_user()
     conv = await factory.create_conv()
@@ -755,3 +920,187 @@ async def test_msg_add_not_live(factory: Factory, db_conn):
 
     with pytest.raises(JsonErrors.HTTPNotFound):
         await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='This is a **test**'))
+
+
+async def test_batch_lock_modify_release(factory: Factory, conns, db_conn):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+
+    actions = [
+        Action(actor_id=user.id, act=ActionTypes.msg_lock, follows=2),
+        Action(actor_id=user.id, act=ActionTypes.msg_modify, follows=4, body='modified body'),
+        Action(actor_id=user.id, act=ActionTypes.msg_add, body='child', parent=2),
+        Action(actor_id=user.id, act=ActionTypes.subject_lock, follows=3),
+        Action(actor_id=user.id, act=ActionTypes.subject_modify, follows=7, body='new subject'),
+    ]
+    assert [4, 5, 6, 7, 8] == await apply_actions(conns, conv.id, actions, batch=True)
+
+    fields = ', '.join(['id', 'act', 'follows', 'parent', 'body', 'preview', 'msg_format'])
+    actions_info = [dict(r) for r in await db_conn.fetch(f'select {fields} from actions where id>=4 order by id')]
+    pk = {r[0]: r[1] for r in await db_conn.fetch('select id, pk from actions')}
+    assert actions_info == [
+        {
+            'id': 4,
+            'act': 'message:lock',
+            'follows': pk[2],
+            'parent': None,
+            'body': None,
+            'preview': None,
+            'msg_format': None,
+        },
+        {
+            'id': 5,
+            'act': 'message:modify',
+            'follows': pk[4],
+            'parent': None,
+            'body': 'modified body',
+            'preview': 'modified body',
+            'msg_format': None,
+        },
+        {
+            'id': 6,
+            'act': 'message:add',
+            'follows': None,
+            'parent': pk[2],
+            'body': 'child',
+            'preview': 'child',
+            'msg_format': 'markdown',
+        },
+        {
+            'id': 7,
+            'act': 'subject:lock',
+            'follows': pk[3],
+            'parent': None,
+            'body': None,
+            'preview': None,
+            'msg_format': None,
+        },
+        {
+            'id': 8,
+            'act': 'subject:modify',
+            'follows': pk[7],
+            'parent': None,
+            'body': 'new subject',
+            'preview': None,
+            'msg_format': None,
+        },
+    ]
+    assert 8 == await db_conn.fetchval('select last_action_id from conversations where id=$1', conv.id)
+    obj = await construct_conv(conns, user.id, conv.id)
+    assert obj['subject'] == 'new subject'
+
+
+async def test_batch_participants(factory: Factory, conns, db_conn):
+    user = await factory.create_user()
+    conv = await factory.create_conv(publish=True)
+
+    actions = [
+        Action(actor_id=user.id, act=ActionTypes.msg_add, body='first'),
+        Action(actor_id=user.id, act=ActionTypes.prt_add, participant='new@example.com'),
+        Action(actor_id=user.id, act=ActionTypes.msg_lock, follows=4),
+        Action(actor_id=user.id, act=ActionTypes.msg_delete, follows=6),
+    ]
+    assert [4, 5, 6, 7] == await apply_actions(conns, conv.id, actions, batch=True)
+    acts = [tuple(r) for r in await db_conn.fetch('select id, act from actions where id>=4 order by id')]
+    assert acts == [(4, 'message:add'), (5, 'participant:add'), (6, 'message:lock'), (7, 'message:delete')]
+    assert 2 == await db_conn.fetchval('select count(*) from participants where conv=$1', conv.id)
+
+
+@pytest.mark.parametrize(
+    'actions,error,msg',
+    [
+        (
+            [{'act': ActionTypes.msg_lock, 'follows': 2}, {'act': ActionTypes.msg_lock, 'follows': 2}],
+            JsonErrors.HTTPConflict,
+            'other actions already follow action 2',
+        ),
+        (
+            [{'act': ActionTypes.msg_lock, 'follows': 3}],
+            JsonErrors.HTTPBadRequest,
+            '"follows" action has the wrong type',
+        ),
+        ([{'act': ActionTypes.msg_lock, 'follows': 123}], JsonErrors.HTTPBadRequest, '"follows" action not found'),
+        (
+            [{'act': ActionTypes.msg_modify, 'follows': 2, 'body': 'x'}],
+            JsonErrors.HTTPBadRequest,
+            'message:modify must follow message:lock by the same user',
+        ),
+        ([{'act': ActionTypes.msg_add, 'body': 'x', 'parent': 3}], JsonErrors.HTTPNotFound, 'parent action not found'),
+        (
+            [{'act': ActionTypes.msg_add, 'body': 'x'}, {'act': ActionTypes.subject_lock, 'follows': 4}],
+            JsonErrors.HTTPBadRequest,
+            '"follows" action has the wrong type',
+        ),
+    ],
+)
+async def test_batch_errors(factory: Factory, conns, db_conn, actions, error, msg):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+
+    for a in actions:
+        a['actor_id'] = user.id
+    # check the batch path gives the same error as applying the actions one at a time
+    with pytest.raises(error) as exc_info:
+        await apply_actions(conns, conv.id, [Action(**a) for a in actions])
+    assert exc_info.value.message == msg
+
+    with pytest.raises(error) as exc_info:
+        await apply_actions(conns, conv.id, [Action(**a) for a in actions], batch=True)
+    assert exc_info.value.message == msg
+    assert 3 == await db_conn.fetchval('select count(*) from actions where conv=$1', conv.id)
+
+
+async def test_batch_multiple_actors(factory: Factory, conns, db_conn):
+    user = await factory.create_user()
+    conv = await factory.create_conv(publish=True)
+    assert [4] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_lock, follows=2))
+
+    user2 = await factory.create_user()
+    actions = [
+        Action(actor_id=user.id, act=ActionTypes.msg_release, follows=4),
+        Action(actor_id=user2.id, act=ActionTypes.msg_lock, follows=6),
+    ]
+    with pytest.raises(JsonErrors.HTTPNotFound) as exc_info:
+        await apply_actions(conns, conv.id, actions, allow_multiple_actors=True, batch=True)
+    assert exc_info.value.message == 'Conversation not found'
+
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=user2.email))
+    assert [6, 7] == await apply_actions(conns, conv.id, actions, allow_multiple_actors=True, batch=True)
+    actors = [tuple(r) for r in await db_conn.fetch('select id, actor from actions where id>=6 order by id')]
+    assert actors == [(6, user.id), (7, user2.id)]
+
+
+async def test_batch_actor_returns(factory: Factory, conns, db_conn):
+    user = await factory.create_user()
+    user2 = await factory.create_user()
+    conv = await factory.create_conv(publish=True, participants=[{'email': user2.email}])
+
+    actions = [
+        Action(actor_id=user.id, act=ActionTypes.msg_add, body='a'),
+        Action(actor_id=user2.id, act=ActionTypes.msg_add, body='b'),
+        Action(actor_id=user.id, act=ActionTypes.msg_add, body='c'),
+    ]
+    assert [5, 6, 7] == await apply_actions(conns, conv.id, actions, allow_multiple_actors=True, batch=True)
+    actors = [tuple(r) for r in await db_conn.fetch('select id, actor from actions where id>=5 order by id')]
+    assert actors == [(5, user.id), (6, user2.id), (7, user.id)]
+
+
+async def test_batch_participant_changes_then_act(factory: Factory, conns, db_conn):
+    user = await factory.create_user()
+    conv = await factory.create_conv(publish=True)
+    user2 = await factory.create_user()
+
+    actions = [
+        Action(actor_id=user.id, act=ActionTypes.prt_add, participant=user2.email),
+        Action(actor_id=user2.id, act=ActionTypes.msg_add, body='added'),
+    ]
+    assert [4, 5] == await apply_actions(conns, conv.id, actions, allow_multiple_actors=True, batch=True)
+
+    actions = [
+        Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=user2.email, follows=4),
+        Action(actor_id=user2.id, act=ActionTypes.msg_add, body='removed'),
+    ]
+    with pytest.raises(JsonErrors.HTTPBadRequest) as exc_info:
+        await apply_actions(conns, conv.id, actions, allow_multiple_actors=True, batch=True)
+    assert exc_info.value.message == "You can't act on conversations you've been removed from"
+    assert 5 == await db_conn.fetchval('select count(*) from actions where conv=$1', conv.id)
@@ -103,4 +103,49 @@ async def test_last_action_id(db_conn):
     assert await db_conn.fetchval('select last_action_id from conversations where id=$1', conv_id) == 20
 
 
-# TODO tests for message count and tests for body choices
+async def test_conv_counts(db_conn):
+    user_id = await db_conn.fetchval("insert into users (email) values ('testing-1@example.com') returning id")
+    conv_id = await db_conn.fetchval(
+        """
+        insert into conversations (key, creator, created_ts, updated_ts, live)
+        values ('key', $1, current_timestamp, current_timestamp, true) returning id
+        """,
+        user_id,
+    )
+
+    async def get_counts():
+        r = await db_conn.fetchrow('select msg_count, prt_count, details from conversations where id=$1', conv_id)
+        details = json.loads(r['details']) if r['details'] else {}
+        return r['msg_count'], r['prt_count'], details.get('msgs'), details.get('prts')
+
+    assert await get_counts() == (0, 0, None, None)
+
+    user2_id = await db_conn.fetchval("insert into users (email) values ('testing-2@example.com') returning id")
+    await db_conn.execute(
+        'insert into participants (conv, user_id) values ($1, $2), ($1, $3)', conv_id, user_id, user2_id
+    )
+    assert await get_counts() == (0, 2, None, None)
+
+    for _ in range(3):
+        await db_conn.execute(
+            "insert into actions (conv, act, actor, body) values ($1, 'message:add', $2, 'x')", conv_id, user_id
+        )
+    assert await get_counts() == (3, 2, 3, 2)
+
+    msg_pk = await db_conn.fetchval('select pk from actions where conv=$1 and id=1', conv_id)
+    await db_conn.execute(
+        "insert into actions (conv, act, actor, follows) values ($1, 'message:delete', $2, $3)",
+        conv_id,
+        user_id,
+        msg_pk,
+    )
+    assert await get_counts() == (2, 2, 2, 2)
+
+    await db_conn.execute("insert into actions (conv, act, actor) values ($1, 'seen', $2)", conv_id, user_id)
+    assert await get_counts() == (2, 2, 2, 2)
+
+    await db_conn.execute('delete from participants where conv=$1 and user_id=$2', conv_id, user2_id)
+    assert await db_conn.fetchval('select prt_count from conversations where id=$1', conv_id) == 1
+
+
+# TODO tests for body choices
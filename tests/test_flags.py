@@ -4,7 +4,7 @@ import pytest
 from arq import Worker
 from pytest_toolbox.comparison import CloseToNow
 
-from em2.core import Action, ActionTypes, get_flag_counts
+from em2.core import Action, ActionTypes, get_flag_counts, get_many_flag_counts, reconcile_flag_counts
 
 from .conftest import Factory
 
@@ -195,6 +195,25 @@ async def test_seen(factory: Factory, conv, conns):
     assert flags == {'inbox': 1, 'unseen': 0, 'draft': 0, 'sent': 0, 'archive': 0, 'all': 1, 'spam': 0, 'deleted': 0}
 
 
+async def test_flag_counts_table(factory: Factory, conv, conns, db_conn, redis):
+    flags = await get_flag_counts(conns, factory.user.id)
+    assert flags == {'inbox': 1, 'unseen': 1, 'draft': 0, 'sent': 0, 'archive': 0, 'all': 1, 'spam': 0, 'deleted': 0}
+    sql = 'select inbox, unseen, draft, sent, archive, "all", spam, deleted from user_flag_counts where user_id=$1'
+    assert dict(await db_conn.fetchrow(sql, factory.user.id)) == flags
+
+    await factory.act(conv.id, Action(actor_id=factory.user.id, act=ActionTypes.seen))
+    assert dict(await db_conn.fetchrow(sql, factory.user.id)) == {**flags, 'unseen': 0}
+
+    # without the cache counts come from the table, not a recount
+    await redis.delete(f'conv-counts-flags-{factory.user.id}')
+    await db_conn.execute('update user_flag_counts set archive=10 where user_id=$1', factory.user.id)
+    assert (await get_flag_counts(conns, factory.user.id))['archive'] == 10
+
+    assert await reconcile_flag_counts(conns, factory.user.id) is True
+    assert await get_flag_counts(conns, factory.user.id) == {**flags, 'unseen': 0}
+    assert await reconcile_flag_counts(conns, factory.user.id) is False
+
+
 flags_empty = {
     'flags': {'inbox': 0, 'unseen': 0, 'draft': 0, 'sent': 0, 'archive': 0, 'all': 0, 'spam': 0, 'deleted': 0},
     'labels': [],
@@ -418,6 +437,33 @@ async def test_filter_flags_conv_list(cli, factory: Factory, db_conn, query, exp
     }
 
 
+async def test_many_flag_counts(factory: Factory, conns, redis):
+    user = await factory.create_user()
+    user2 = await factory.create_user()
+    user3 = await factory.create_user()
+    await factory.create_conv(participants=[{'email': user2.email}], publish=True)
+    await factory.create_conv()
+
+    # user's counts are cached, user2's are only in user_flag_counts and user3's don't exist yet
+    flags = await get_flag_counts(conns, user.id)
+    await get_flag_counts(conns, user2.id)
+    await redis.delete(f'conv-counts-flags-{user2.id}')
+    assert not await conns.main.fetchval('select 1 from user_flag_counts where user_id=$1', user3.id)
+
+    counts = await get_many_flag_counts(conns, [user.id, user2.id, user3.id])
+    assert counts == {
+        user.id: flags,
+        user2.id: {'inbox': 1, 'unseen': 1, 'draft': 0, 'sent': 0, 'archive': 0, 'all': 1, 'spam': 0, 'deleted': 0},
+        user3.id: {'inbox': 0, 'unseen': 0, 'draft': 0, 'sent': 0, 'archive': 0, 'all': 0, 'spam': 0, 'deleted': 0},
+    }
+    assert flags == {'inbox': 0, 'unseen': 0, 'draft': 1, 'sent': 1, 'archive': 0, 'all': 2, 'spam': 0, 'deleted': 0}
+    # all counts are now cached and match get_flag_counts
+    assert await redis.exists(f'conv-counts-flags-{user2.id}')
+    for user_id, user_counts in counts.items():
+        assert await get_flag_counts(conns, user_id) == user_counts
+        assert await get_flag_counts(conns, user_id, force_update=True) == user_counts
+
+
 async def test_draft_counts(factory: Factory, conns):
     user = await factory.create_user()
     user2 = await factory.create_user()
@@ -136,6 +136,41 @@ async def test_add_remove_label_multiple(cli, factory: Factory, db_conn):
     assert await db_conn.fetchval('select label_ids from participants') == [label2]
 
 
+async def test_label_counts_maintained(cli, factory: Factory, db_conn):
+    await factory.create_user()
+    conv1 = await factory.create_conv(subject='c1')
+    conv2 = await factory.create_conv(subject='c2')
+    label1 = await factory.create_label('label 1')
+    label2 = await factory.create_label('label 2')
+
+    async def get_counts():
+        return await db_conn.fetch('select name, conv_count from labels order by id')
+
+    for conv in (conv1, conv2):
+        await cli.post_json(
+            factory.url('ui:add-remove-label', conv=conv.key, query={'action': 'add', 'label_id': label1})
+        )
+    await cli.post_json(factory.url('ui:add-remove-label', conv=conv1.key, query={'action': 'add', 'label_id': label2}))
+    assert [tuple(r) for r in await get_counts()] == [('label 1', 2), ('label 2', 1)]
+
+    await cli.post_json(
+        factory.url('ui:add-remove-label', conv=conv2.key, query={'action': 'remove', 'label_id': label1})
+    )
+    assert [tuple(r) for r in await get_counts()] == [('label 1', 1), ('label 2', 1)]
+
+    # search entries would otherwise prevent the conversation being deleted
+    await db_conn.execute('delete from search where conv=$1', conv1.id)
+    await db_conn.execute('delete from conversations where id=$1', conv1.id)
+    assert [tuple(r) for r in await get_counts()] == [('label 1', 0), ('label 2', 0)]
+
+    await db_conn.execute('update participants set label_ids=$1 where conv=$2', [label1, label2], conv2.id)
+    assert [tuple(r) for r in await get_counts()] == [('label 1', 1), ('label 2', 1)]
+
+    await db_conn.execute('delete from labels where id=$1', label1)
+    assert [tuple(r) for r in await get_counts()] == [('label 2', 1)]
+    assert await db_conn.fetchval('select label_ids from participants where conv=$1', conv2.id) == [label2]
+
+
 async def test_bread_list(cli, factory: Factory):
     await factory.create_user()
 
@@ -4,8 +4,10 @@ from arq import Worker
 from atoolbox.test_utils import DummyServer
 from pytest_toolbox.comparison import AnyInt, CloseToNow, RegexStr
 
-from em2.core import Action, ActionTypes
+from em2.background import get_actions_data
+from em2.core import Action, ActionTypes, UserTypes
 from em2.protocol.core import get_signing_key
+from em2.protocol.push import push_actions
 from em2.settings import Settings
 
 from .conftest import Factory
@@ -73,6 +75,20 @@ async def test_publish_em2(factory: Factory, db_conn, worker: Worker, dummy_serv
     }
 
 
+async def test_push_json_build_object_data(factory: Factory, conns, worker_ctx, dummy_server: DummyServer):
+    await factory.create_user()
+    conv = await factory.create_conv(participants=[{'email': 'whatever@em2-ext.example.com'}])
+    actions = json.loads(await get_actions_data(conns, conv.id))['actions']
+    # jobs queued by earlier versions have actions_data formatted by postgres
+    actions_data = f'{{"actions" : {json.dumps(actions)}, "conversation" : "{conv.key}"}}'
+
+    ctx = dict(worker_ctx, job_try=1)
+    r = await push_actions(ctx, actions_data, [('whatever@em2-ext.example.com', UserTypes.new)], interaction_id='x')
+    assert r == 'retry=0 smtp=0 em2=1'
+    assert len(dummy_server.app['em2push']) == 1
+    assert json.loads(dummy_server.app['em2push'][0]['body']) == {'actions': actions, 'interaction_id': 'x'}
+
+
 async def test_publish_ses(factory: Factory, db_conn, ses_worker: Worker, dummy_server):
     await factory.create_user()
     conv = await factory.create_conv(participants=[{'email': 'whatever@example.net'}], publish=True)
@@ -6,7 +6,7 @@ from arq import ArqRedis
 from atoolbox.test_utils import DummyServer
 from pytest_toolbox.comparison import CloseToNow
 
-from em2.background import push_sql_all
+from em2.background import get_actions_data
 from em2.core import ActionTypes, construct_conv, generate_conv_key
 from em2.protocol.core import actions_to_body, get_signing_key
 
@@ -18,7 +18,9 @@ async def test_signing_verification(cli, url):
     assert obj == {'keys': [{'key': 'd759793bbc13a2819a827c76adb6fba8a49aee007f49f2d0992d99b825ad2c48', 'ttl': 86400}]}
 
 
-async def test_push(em2_cli: Em2TestClient, settings, dummy_server: DummyServer, db_conn, redis, factory: Factory):
+async def test_push(
+    em2_cli: Em2TestClient, settings, dummy_server: DummyServer, db_conn, conns, redis, factory: Factory
+):
     user = await factory.create_user(email='recipient@example.com')
     ts = datetime(2032, 6, 6, 12, 0)
     conv_key = '8d69cb97ea2607ad5dcead82e7373d159289db11f9709c126e0ef8b2cf324d82'
@@ -84,7 +86,7 @@ async def test_push(em2_cli: Em2TestClient, settings, dummy_server: DummyServer,
     assert publish_ts == ts.replace(tzinfo=timezone.utc)
     assert last_action_id == 4
     assert leader_node == em2_node
-    actions_data = await db_conn.fetchval(push_sql_all, conv_id)
+    actions_data = await get_actions_data(conns, conv_id)
     assert json.loads(actions_data)['actions'] == post_data['actions']
     jobs = await redis.queued_jobs()
     assert len(jobs) == 1
@@ -89,6 +89,25 @@ async def test_ses_complaint_webhook(factory: Factory, db_conn, cli, url, sns_da
     assert extra == {'complaintFeedbackType': 'grumpy', 'emails': ['sender@example.net']}
 
 
+async def test_ses_complaint_not_participant(factory: Factory, db_conn, cli, url, sns_data, send_to_remote):
+    send_id, message_id = send_to_remote
+    data = sns_data(
+        message_id,
+        eventType='Complaint',
+        complaint={
+            'complainedRecipients': [{'emailAddress': 'other@example.net'}],
+            'timestamp': '2032-10-16T12:00:00.000Z',
+        },
+        mail={'messageId': message_id},
+    )
+
+    r = await cli.post(url('protocol:webhook-ses', token='testing'), json=data)
+    assert r.status == 204, await r.text()
+    assert 2 == await db_conn.fetchval('select count(*) from participants where conv=$1', factory.conv.id)
+    r = await db_conn.fetchrow('select status, user_ids from send_events where send=$1', send_id)
+    assert dict(r) == {'status': 'Complaint', 'user_ids': None}
+
+
 async def test_ses_invalid_sig(cli, url, sns_data):
     data = sns_data('whatever', mock_verify=False, eventType='whatever')
     r = await cli.post(url('protocol:webhook-ses', token='testing'), json=data)
@@ -1,13 +1,26 @@
 import json
+from datetime import datetime, timezone
 
 import pytest
 from pytest_toolbox.comparison import AnyInt, CloseToNow
 
 from em2.core import Action, ActionTypes, File
-from em2.search import search
+from em2.reindex import reindex_range
+from em2.search import SearchCache, search, search_cache, search_index, search_suggest, snippet_max_length
 
 from .conftest import Factory
 
+# user ids for search entries
+members_sql = 'select array_agg(m.user_id order by m.user_id) from search_members m join search s on m.search_id = s.id'
+
+
+@pytest.fixture(name='run_search_index')
+def _fix_run_search_index(redis, db_conn, settings):
+    async def run():
+        return await search_index({'redis': redis, 'pg': db_conn, 'settings': settings})
+
+    return run
+
 
 async def test_create_conv(cli, factory: Factory, db_conn):
     user = await factory.create_user()
@@ -26,11 +39,11 @@ async def test_create_conv(cli, factory: Factory, db_conn):
         'conv': conv_id,
         'action': 1,
         'freeze_action': 0,
-        'ts': None,
-        'user_ids': [user.id],
+        'ts': CloseToNow(),
         'creator_email': user.email,
         'vector': "'appl':3A 'discuss':1A 'example.com':4B 'prefer':7 'red':8 'testing-1@example.com':5B",
     }
+    assert [user.id] == await db_conn.fetchval(members_sql)
 
 
 async def test_publish_conv(factory: Factory, cli, db_conn):
@@ -39,7 +52,7 @@ async def test_publish_conv(factory: Factory, cli, db_conn):
     conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins', participants=participants)
     assert 1 == await db_conn.fetchval('select count(*) from search')
     assert conv.id == await db_conn.fetchval('select conv from search')
-    assert [user.id] == await db_conn.fetchval('select user_ids from search')
+    assert [user.id] == await db_conn.fetchval(members_sql)
 
     await cli.post_json(factory.url('ui:publish', conv=conv.key), {'publish': True})
 
@@ -49,10 +62,10 @@ async def test_publish_conv(factory: Factory, cli, db_conn):
         'select array_agg(id) from (select id from users where email like $1) as t', '%@other.com'
     )
     assert len(user_ids) == 3
-    assert {user.id, *user_ids} == set(await db_conn.fetchval('select user_ids from search'))
+    assert {user.id, *user_ids} == set(await db_conn.fetchval(members_sql))
 
 
-async def test_add_prt_add_msg(factory: Factory, db_conn):
+async def test_add_prt_add_msg(factory: Factory, db_conn, run_search_index):
     user = await factory.create_user()
     conv = await factory.create_conv()
     assert 1 == await db_conn.fetchval('select count(*) from search')
@@ -60,12 +73,13 @@ async def test_add_prt_add_msg(factory: Factory, db_conn):
     await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='apple **pie**'))
     assert 4 == await db_conn.fetchval('select count(*) from actions')
     assert 1 == await db_conn.fetchval('select count(*) from search')
+    assert 'appl' not in await db_conn.fetchval('select vector from search')
+    assert 1 == await run_search_index()
 
-    search = dict(await db_conn.fetchrow('select conv, action, user_ids, creator_email, vector from search'))
+    search = dict(await db_conn.fetchrow('select conv, action, creator_email, vector from search'))
     assert search == {
         'conv': conv.id,
         'action': 4,
-        'user_ids': [user.id],
         'creator_email': user.email,
         'vector': "'appl':7 'example.com':3B 'messag':6 'pie':8 'subject':2A 'test':1A,5 'testing-1@example.com':4B",
     }
@@ -74,59 +88,68 @@ async def test_add_prt_add_msg(factory: Factory, db_conn):
     await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=user2.email))
     assert 5 == await db_conn.fetchval('select count(*) from actions')
     assert 1 == await db_conn.fetchval('select count(*) from search')
+    assert [user.id, user2.id] == await db_conn.fetchval(members_sql)
+    assert 1 == await run_search_index()
 
-    search = dict(await db_conn.fetchrow('select conv, action, user_ids, creator_email, vector from search'))
+    search = dict(await db_conn.fetchrow('select conv, action, creator_email, vector from search'))
     assert search == {
         'conv': conv.id,
         'action': 5,
-        'user_ids': [user.id, user2.id],
         'creator_email': user.email,
         'vector': (
-            "'appl':7 'example.com':3B,10B 'messag':6 'pie':8 'subject':2A "
-            "'test':1A,5 'testing-1@example.com':4B 'testing-2@example.com':9B"
+            "'appl':8 'example.com':3B 'messag':7 'pie':9 'subject':2A "
+            "'test':1A,6 'testing-1@example.com':4B 'testing-2@example.com':5B"
         ),
     }
 
 
-async def test_add_remove_prt(factory: Factory, db_conn):
+async def test_add_remove_prt(factory: Factory, db_conn, run_search_index):
     user = await factory.create_user(email='testing@example.com')
     conv = await factory.create_conv()
 
     email2 = 'different@foobar.com'
     assert [4] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email2))
     user2_id = await db_conn.fetchval('select id from users where email=$1', email2)
+    assert 1 == await run_search_index()
     assert 1 == await db_conn.fetchval('select count(*) from search')
     assert 4 == await db_conn.fetchval('select action from search')
-    assert [user.id, user2_id] == await db_conn.fetchval('select user_ids from search')
+    assert [user.id, user2_id] == await db_conn.fetchval(members_sql)
 
     email3 = 'three@foobar.com'
     assert [5] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email3))
     user3_id = await db_conn.fetchval('select id from users where email=$1', email3)
+    assert 1 == await run_search_index()
     assert 1 == await db_conn.fetchval('select count(*) from search')
     assert 5 == await db_conn.fetchval('select action from search')
-    assert [user.id, user2_id, user3_id] == await db_conn.fetchval('select user_ids from search')
+    assert [user.id, user2_id, user3_id] == await db_conn.fetchval(members_sql)
 
     await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=email2, follows=4))
     assert 2 == await db_conn.fetchval('select count(*) from search')
     assert 5, 5 == await db_conn.fetchrow('select action, freeze_action from search where freeze_action!=0')
-    assert [user2_id] == await db_conn.fetchval('select user_ids from search where freeze_action!=0')
+    assert [user2_id] == await db_conn.fetchval(members_sql + ' where s.freeze_action!=0')
     assert 5, 0 == await db_conn.fetchrow('select action, freeze_action from search where freeze_action=0')
-    assert [user.id, user3_id] == await db_conn.fetchval('select user_ids from search where freeze_action=0')
+    assert [user.id, user3_id] == await db_conn.fetchval(members_sql + ' where s.freeze_action=0')
 
     await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=email3, follows=5))
     assert 2 == await db_conn.fetchval('select count(*) from search')
     assert 5, 5 == await db_conn.fetchrow('select action, freeze_action from search where freeze_action!=0')
-    assert [user2_id, user3_id] == await db_conn.fetchval('select user_ids from search where freeze_action!=0')
+    assert [user2_id, user3_id] == await db_conn.fetchval(members_sql + ' where s.freeze_action!=0')
     assert 5, 0 == await db_conn.fetchrow('select action, freeze_action from search where freeze_action=0')
-    assert [user.id] == await db_conn.fetchval('select user_ids from search where freeze_action=0')
+    assert [user.id] == await db_conn.fetchval(members_sql + ' where s.freeze_action=0')
 
     assert [8] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='spagetti'))
+    assert 1 == await run_search_index()
     assert 2 == await db_conn.fetchval('select count(*) from search')
     assert 5, 5 == await db_conn.fetchrow('select action, freeze_action from search where freeze_action!=0')
     assert 8, 0 == await db_conn.fetchrow('select action, freeze_action from search where freeze_action=0')
 
     assert 'spagetti' not in await db_conn.fetchval('select vector from search where freeze_action!=0')
     assert 'spagetti' in await db_conn.fetchval('select vector from search where freeze_action=0')
+    # search_members.ts should always match the ts of the entry
+    assert 3 == await db_conn.fetchval('select count(*) from search_members')
+    assert 0 == await db_conn.fetchval(
+        'select count(*) from search_members m join search s on m.search_id = s.id where m.ts is distinct from s.ts'
+    )
 
 
 async def test_readd_prt(factory: Factory, db_conn):
@@ -137,16 +160,16 @@ async def test_readd_prt(factory: Factory, db_conn):
     assert [4] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email2))
     user2_id = await db_conn.fetchval('select id from users where email=$1', email2)
     assert 1 == await db_conn.fetchval('select count(*) from search')
-    assert [user.id, user2_id] == await db_conn.fetchval('select user_ids from search where freeze_action=0')
+    assert [user.id, user2_id] == await db_conn.fetchval(members_sql + ' where s.freeze_action=0')
 
     await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=email2, follows=4))
     assert 2 == await db_conn.fetchval('select count(*) from search')
-    assert [user2_id] == await db_conn.fetchval('select user_ids from search where freeze_action=4')
-    assert [user.id] == await db_conn.fetchval('select user_ids from search where freeze_action=0')
+    assert [user2_id] == await db_conn.fetchval(members_sql + ' where s.freeze_action=4')
+    assert [user.id] == await db_conn.fetchval(members_sql + ' where s.freeze_action=0')
 
     assert [6] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email2))
     assert 1 == await db_conn.fetchval('select count(*) from search')
-    assert [user.id, user2_id] == await db_conn.fetchval('select user_ids from search where freeze_action=0')
+    assert [user.id, user2_id] == await db_conn.fetchval(members_sql + ' where s.freeze_action=0')
 
 
 async def test_search_query(factory: Factory, conns):
@@ -162,6 +185,7 @@ async def test_search_query(factory: Factory, conns):
                 'updated_ts': CloseToNow(),
                 'publish_ts': None,
                 'seen': False,
+                'snippet': 'eggs, flour and raisins',
                 'details': {
                     'act': 'conv:create',
                     'sub': 'apple pie',
@@ -172,13 +196,14 @@ async def test_search_query(factory: Factory, conns):
                     'msgs': 1,
                 },
             }
-        ]
+        ],
+        'next': None,
     }
     # this is the other way of building queries, so check the output is the same
     r2 = json.loads(await search(conns, user.id, 'includes:' + user.email))
     assert r2 == r1
     r = json.loads(await search(conns, user.id, 'banana'))
-    assert r == {'conversations': []}
+    assert r == {'conversations': [], 'next': None}
     assert len(json.loads(await search(conns, user.id, conv.key[5:12]))['conversations']) == 1
     assert len(json.loads(await search(conns, user.id, conv.key[5:12] + 'aaa'))['conversations']) == 0
     assert len(json.loads(await search(conns, user.id, conv.key[5:8]))['conversations']) == 0
@@ -219,10 +244,11 @@ async def test_search_query(factory: Factory, conns):
         ('\x1e' * 5, 0),
     ],
 )
-async def test_search_query_participants(factory: Factory, conns, query, count):
+async def test_search_query_participants(factory: Factory, conns, run_search_index, query, count):
     user = await factory.create_user(email='testing@example.com')
     conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
     await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant='recipient@foobar.com'))
+    await run_search_index()
 
     assert len(json.loads(await search(conns, user.id, query))['conversations']) == count, repr(query)
 
@@ -240,7 +266,7 @@ async def test_search_query_participants(factory: Factory, conns, query, count):
         ('files:apple', 0),
     ],
 )
-async def test_search_query_files(factory: Factory, conns, query, count):
+async def test_search_query_files(factory: Factory, conns, run_search_index, query, count):
     user = await factory.create_user(email='testing@example.com')
     conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
 
@@ -249,6 +275,7 @@ async def test_search_query_files(factory: Factory, conns, query, count):
         File(hash='x', name='rat.png', content_id='b', content_disp='inline', content_type='image/png', size=100),
     ]
     await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='apple **pie**', files=files))
+    await run_search_index()
 
     assert len(json.loads(await search(conns, user.id, query))['conversations']) == count
 
@@ -265,6 +292,7 @@ async def test_http_search(factory: Factory, cli):
                 'updated_ts': CloseToNow(),
                 'publish_ts': CloseToNow(),
                 'seen': True,
+                'snippet': 'processed <b>meat</b> and bread',
                 'details': {
                     'act': 'conv:publish',
                     'sub': 'spam sandwich',
@@ -275,16 +303,46 @@ async def test_http_search(factory: Factory, cli):
                     'msgs': 1,
                 },
             }
-        ]
+        ],
+        'next': None,
     }
 
     obj = await cli.get_json(factory.url('ui:search'))
-    assert obj == {'conversations': []}
+    assert obj == {'conversations': [], 'next': None}
     obj = await cli.get_json(factory.url('ui:search', query={'query': 'bacon'}))
-    assert obj == {'conversations': []}
+    assert obj == {'conversations': [], 'next': None}
 
     obj = await cli.get_json(factory.url('ui:search', query={'query': 'x' * 200}))
-    assert obj == {'conversations': []}
+    assert obj == {'conversations': [], 'next': None}
+
+
+async def test_search_snippet(factory: Factory, conns):
+    user = await factory.create_user()
+    filler = ' '.join(f'word{i}' for i in range(150))
+    await factory.create_conv(subject='snippets', message=f'{filler} fish < banana & chips {filler}')
+
+    r = json.loads(await search(conns, user.id, 'banana'))
+    snippet = r['conversations'][0]['snippet']
+    assert 'fish &lt; <b>banana</b> &amp; chips' in snippet
+    assert len(snippet) <= snippet_max_length
+    assert 'word0 ' not in snippet
+
+    r = json.loads(await search(conns, user.id, 'subject:snippets'))
+    assert r['conversations'][0]['snippet'] is None
+
+
+@pytest.mark.parametrize(
+    'snippet,expected',
+    [
+        ('short <b>x</b>', 'short <b>x</b>'),
+        ('aaaaaaaaaa <b>bananas</b> and more', 'aaaaaaaaaa <b>ba</b>'),
+        ('aaaaaaaaaaaaa &amp; x more text', 'aaaaaaaaaaaaa '),
+        ('aaaaaaaaaa<b>bb</b> more text', 'aaaaaaaaaa<b>bb</b>'),
+        ('aaaaaaaaaaaaaaa<b>bb</b> more', 'aaaaaaaaaaaaaaa'),
+    ],
+)
+async def test_trim_snippet(db_conn, snippet, expected):
+    assert await db_conn.fetchval('select trim_snippet($1, 20)', snippet) == expected
 
 
 async def test_search_ranking(factory: Factory, conns):
@@ -294,3 +352,205 @@ async def test_search_ranking(factory: Factory, conns):
     assert 2 == await conns.main.fetchval('select count(*) from search')
     results = [c['details']['sub'] for c in json.loads(await search(conns, user.id, 'apple'))['conversations']]
     assert results == ['apple pie', 'fish pie']
+
+
+@pytest.mark.parametrize('query', ['apple', 'subject:apple'])
+async def test_search_pagination(factory: Factory, conns, mocker, query):
+    mocker.patch('em2.search.search_page_size', 2)
+    user = await factory.create_user()
+    for i in range(5):
+        await factory.create_conv(subject=f'apple {i}')
+
+    subjects, cursor = [], None
+    for _ in range(3):
+        r = json.loads(await search(conns, user.id, query, cursor))
+        subjects.append([c['details']['sub'] for c in r['conversations']])
+        cursor = r['next']
+    assert subjects == [['apple 4', 'apple 3'], ['apple 2', 'apple 1'], ['apple 0']]
+    assert cursor is None
+
+
+async def test_search_pagination_rank(factory: Factory, conns, mocker):
+    mocker.patch('em2.search.search_page_size', 2)
+    user = await factory.create_user()
+    await factory.create_conv(subject='apple apple apple', message='apple pie')
+    for i in range(4):
+        await factory.create_conv(subject=f'recent {i}', message='apple')
+
+    subjects, cursor = [], None
+    for _ in range(3):
+        r = json.loads(await search(conns, user.id, 'apple', cursor))
+        subjects.append([c['details']['sub'] for c in r['conversations']])
+        cursor = r['next']
+    # the strongest match comes first even though it's the oldest
+    assert subjects == [['apple apple apple', 'recent 3'], ['recent 2', 'recent 1'], ['recent 0']]
+    assert cursor is None
+
+
+async def test_http_search_cursor(factory: Factory, cli):
+    await factory.create_user()
+    await factory.create_conv(subject='spam sandwich', publish=True)
+
+    obj = await cli.get_json(factory.url('ui:search', query={'query': 'spam', 'cursor': '0_1-1'}))
+    assert obj == {'conversations': [], 'next': None}
+    obj = await cli.get_json(factory.url('ui:search', query={'query': 'subject:spam', 'cursor': '1-1'}))
+    assert obj == {'conversations': [], 'next': None}
+    await cli.get_json(factory.url('ui:search', query={'query': 'spam', 'cursor': 'foobar'}), status=400)
+    # ranked queries need a cursor with the rank
+    await cli.get_json(factory.url('ui:search', query={'query': 'spam', 'cursor': '1-1'}), status=400)
+
+
+async def test_search_index_rebuild(factory: Factory, db_conn, run_search_index):
+    user = await factory.create_user()
+    conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
+    assert 0 == await run_search_index()
+
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_lock, follows=2))
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_modify, body='cherries', follows=4))
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.subject_lock, follows=3))
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.subject_modify, body='cherry pie', follows=6))
+    assert [8] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='custard'))
+    # changes to one conversation are indexed together
+    assert 1 == await run_search_index()
+    assert 0 == await run_search_index()
+
+    s = dict(await db_conn.fetchrow('select action, vector from search'))
+    assert s == {
+        'action': 8,
+        'vector': "'cherri':1A,5 'custard':6 'example.com':3B 'pie':2A 'testing-1@example.com':4B",
+    }
+
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_delete, follows=8))
+    assert 1 == await run_search_index()
+    assert 'custard' not in await db_conn.fetchval('select vector from search')
+
+
+async def test_reindex_range(factory: Factory, db_conn, conns):
+    user = await factory.create_user(email='testing@example.com')
+    conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
+    email2 = 'different@foobar.com'
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email2))
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=email2, follows=4))
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='spagetti'))
+    await db_conn.execute("update search set vector='', ts='2032-01-01'")
+
+    assert 0 == await reindex_range(conns, conv.id + 1, conv.id + 10)
+    assert 2 == await reindex_range(conns, 0, conv.id + 1)
+
+    live, frozen = await db_conn.fetch('select action, freeze_action, ts, vector from search order by id')
+    assert live['action'] == 6
+    assert live['ts'] == datetime(2032, 1, 1, tzinfo=timezone.utc)
+    assert 'spagetti' in live['vector']
+    assert 'different@foobar.com' not in live['vector']
+    assert 'appl' in live['vector']
+
+    assert (frozen['action'], frozen['freeze_action']) == (4, 4)
+    assert 'spagetti' not in frozen['vector']
+    assert 'different@foobar.com' in frozen['vector']
+    assert 'appl' in frozen['vector']
+
+
+async def test_reindex_range_skip_newer(factory: Factory, db_conn, conns):
+    await factory.create_user()
+    conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
+    # as if search_index ran with a newer action after reindex built its entries
+    await db_conn.execute("update search set action=100, vector='banana'")
+
+    assert 0 == await reindex_range(conns, 0, conv.id + 1)
+    assert dict(await db_conn.fetchrow('select action, vector from search')) == {'action': 100, 'vector': "'banana'"}
+
+
+async def test_search_cache(factory: Factory, conns, run_search_index):
+    user = await factory.create_user()
+    conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
+
+    r1 = json.loads(await search(conns, user.id, 'apple'))
+    assert len(r1['conversations']) == 1
+    assert search_cache.stats == {'miss': 1}
+    assert json.loads(await search(conns, user.id, '  apple ')) == r1
+    assert search_cache.stats == {'miss': 1, 'hit': 1}
+    assert search_cache.hit_rate == 0.5
+
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='banana'))
+    # user's v has changed so the result isn't used
+    assert len(json.loads(await search(conns, user.id, 'apple'))['conversations']) == 1
+    assert search_cache.stats == {'miss': 2, 'hit': 1}
+
+    assert json.loads(await search(conns, user.id, 'banana')) == {'conversations': [], 'next': None}
+    assert 1 == await run_search_index()
+    # search_index clears the cache as vectors change after v
+    assert len(json.loads(await search(conns, user.id, 'banana'))['conversations']) == 1
+    assert search_cache.stats == {'miss': 4, 'hit': 1}
+
+
+async def test_search_cache_reindex(factory: Factory, db_conn, conns):
+    user = await factory.create_user()
+    conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
+
+    assert len(json.loads(await search(conns, user.id, 'apple'))['conversations']) == 1
+    await db_conn.execute("update search set vector=''")
+    assert len(json.loads(await search(conns, user.id, 'apple'))['conversations']) == 1
+    assert search_cache.stats == {'miss': 1, 'hit': 1}
+
+    assert 1 == await reindex_range(conns, 0, conv.id + 1)
+    # reindex clears the cache of users in the range
+    assert len(json.loads(await search(conns, user.id, 'apple'))['conversations']) == 1
+    assert search_cache.stats == {'miss': 2, 'hit': 1}
+
+
+async def test_search_cache_eviction(redis):
+    cache = SearchCache(max_size=2)
+    await cache.set(redis, 1, 1, 'a', 'result a')
+    await cache.set(redis, 1, 1, 'b', 'result b')
+    assert await cache.get(redis, 1, 1, 'a') == 'result a'
+    await cache.set(redis, 1, 1, 'c', 'result c')
+
+    assert await cache.get(redis, 1, 1, 'b') is None
+    assert await cache.get(redis, 1, 1, 'a') == 'result a'
+    assert await cache.get(redis, 1, 1, 'c') == 'result c'
+    assert await cache.get(redis, 1, 2, 'c') is None
+    assert await redis.hlen('search-cache-1') == 2
+    assert cache.stats == {'hit': 3, 'miss': 2}
+
+    await cache.clear(redis, [1])
+    assert await cache.get(redis, 1, 1, 'a') is None
+
+
+async def test_search_suggest(factory: Factory, conns, run_search_index):
+    user = await factory.create_user(email='testing@example.com')
+    conv = await factory.create_conv(subject='Apple pie', participants=[{'email': 'apricot@example.com'}])
+    files = [
+        File(hash='x', name='apple sauce.txt', content_id='a', content_disp='inline', content_type='text/plain', size=1)
+    ]
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='spam', files=files))
+    assert 1 == await run_search_index()
+
+    def suggestions(r):
+        return sorted((s['type'], s['value']) for s in json.loads(r)['suggestions'])
+
+    assert suggestions(await search_suggest(conns, user.id, 'ap')) == [
+        ('file', 'apple sauce.txt'),
+        ('participant', 'apricot@example.com'),
+        ('subject', 'Apple pie'),
+    ]
+    assert suggestions(await search_suggest(conns, user.id, ' APPLE')) == [
+        ('file', 'apple sauce.txt'),
+        ('subject', 'Apple pie'),
+    ]
+    # the user's own address isn't suggested
+    assert suggestions(await search_suggest(conns, user.id, 'test')) == []
+    assert suggestions(await search_suggest(conns, user.id, 'a%')) == []
+    assert suggestions(await search_suggest(conns, user.id, 'pie')) == []
+    assert await search_suggest(conns, user.id, ' ') == '{"suggestions": []}'
+
+    # conversation isn't published so other participants can't see suggestions from it
+    other_user_id = await conns.main.fetchval("select id from users where email='apricot@example.com'")
+    assert suggestions(await search_suggest(conns, other_user_id, 'ap')) == []
+
+
+async def test_http_search_suggest(factory: Factory, cli):
+    await factory.create_user()
+    await factory.create_conv(subject='spam sandwich', publish=True)
+
+    obj = await cli.get_json(factory.url('ui:search-suggest', query={'query': 'sp'}))
+    assert obj == {'suggestions': [{'type': 'subject', 'value': 'spam sandwich'}]}
@@ -0,0 +1,130 @@
+import json
+from pathlib import Path
+
+import pytest
+from pytest_toolbox.comparison import CloseToNow
+
+from em2.core import Action, ActionTypes
+from em2.reindex import reindex_range
+from em2.search import search, snippet_max_length
+from em2.search_sqlite import _connect, _shard, _snippet_html
+
+from .conftest import Factory
+from .test_search import (  # noqa: F401
+    _fix_run_search_index,
+    test_http_search,
+    test_http_search_cursor,
+    test_http_search_suggest,
+    test_search_cache,
+    test_search_pagination,
+    test_search_pagination_rank,
+    test_search_query_files,
+    test_search_query_participants,
+    test_search_snippet,
+    test_search_suggest,
+)
+
+
+# the tests imported from test_search run again here, search behaviour should be the same with the sqlite backend
+@pytest.fixture(name='settings')
+def _fix_sqlite_settings(settings, tmpdir):
+    return settings.copy(
+        update={'search_backend': 'em2.search_sqlite.SqliteSearchBackend', 'search_sqlite_dir': Path(tmpdir) / 'search'}
+    )
+
+
+async def test_search_query(factory: Factory, conns):
+    user = await factory.create_user()
+    conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
+    assert 0 == await conns.main.fetchval('select count(*) from search')
+
+    r = json.loads(await search(conns, user.id, 'apple'))
+    assert r == {
+        'conversations': [
+            {
+                'key': conv.key,
+                'updated_ts': CloseToNow(),
+                'details': {
+                    'act': 'conv:create',
+                    'sub': 'apple pie',
+                    'email': user.email,
+                    'creator': user.email,
+                    'prev': 'eggs, flour and raisins',
+                    'prts': 1,
+                    'msgs': 1,
+                },
+                'publish_ts': None,
+                'seen': True,
+                'snippet': 'eggs, flour and raisins',
+            }
+        ],
+        'next': None,
+    }
+    assert len(json.loads(await search(conns, user.id, 'banana'))['conversations']) == 0
+    assert len(json.loads(await search(conns, user.id, conv.key[5:12]))['conversations']) == 1
+    assert len(json.loads(await search(conns, user.id, conv.key[5:12] + 'aaa'))['conversations']) == 0
+    assert 1 == await reindex_range(conns, 0, conv.id + 1)
+
+
+async def test_publish_conv(factory: Factory, cli, conns):
+    user = await factory.create_user()
+    conv = await factory.create_conv(subject='apple pie', participants=[{'email': 'anne@other.com'}])
+    anne_id = await conns.main.fetchval("select id from users where email='anne@other.com'")
+    assert len(json.loads(await search(conns, user.id, 'apple'))['conversations']) == 1
+    assert len(json.loads(await search(conns, anne_id, 'apple'))['conversations']) == 0
+
+    await cli.post_json(factory.url('ui:publish', conv=conv.key), {'publish': True})
+    new_key = await conns.main.fetchval('select key from conversations where id=$1', conv.id)
+    r = json.loads(await search(conns, anne_id, 'apple'))
+    assert [c['key'] for c in r['conversations']] == [new_key]
+    assert len(json.loads(await search(conns, user.id, new_key[5:12]))['conversations']) == 1
+
+
+async def test_add_remove_prt(factory: Factory, conns, run_search_index):
+    user = await factory.create_user(email='testing@example.com')
+    conv = await factory.create_conv(subject='apple pie', publish=True)
+
+    email2 = 'different@foobar.com'
+    assert [4] == await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_add, participant=email2))
+    user2_id = await conns.main.fetchval('select id from users where email=$1', email2)
+    # new participants can search the conversation once it's indexed
+    assert len(json.loads(await search(conns, user2_id, 'apple'))['conversations']) == 0
+    assert 1 == await run_search_index()
+    assert len(json.loads(await search(conns, user2_id, 'apple'))['conversations']) == 1
+
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.prt_remove, participant=email2, follows=4))
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='spagetti'))
+    assert 1 == await run_search_index()
+
+    assert len(json.loads(await search(conns, user.id, 'spagetti'))['conversations']) == 1
+    # user2's entry is frozen when they were removed
+    assert len(json.loads(await search(conns, user2_id, 'spagetti'))['conversations']) == 0
+    assert len(json.loads(await search(conns, user2_id, 'apple'))['conversations']) == 1
+
+
+async def test_reindex_range_skip_newer(factory: Factory, conns, settings):
+    user = await factory.create_user()
+    conv = await factory.create_conv(subject='apple pie', message='eggs, flour and raisins')
+    # as if search_index ran with a newer action after reindex built its entries
+    conn = _connect(settings, _shard(settings, user.id))
+    with conn:
+        conn.execute('update entries set action=100')
+    conn.close()
+
+    assert 0 == await reindex_range(conns, 0, conv.id + 1)
+    assert len(json.loads(await search(conns, user.id, 'apple'))['conversations']) == 1
+
+
+@pytest.mark.parametrize(
+    'snippet,expected',
+    [
+        ('short \x02x\x03', 'short <b>x</b>'),
+        ('a' * 290 + ' \x02bananas\x03 and more', 'a' * 290 + ' <b>ba</b>'),
+        ('a' * 293 + ' & x more text', 'a' * 293 + ' '),
+        ('a' * 289 + '\x02bb\x03 more text', 'a' * 289 + '<b>bb</b>'),
+    ],
+)
+def test_snippet_html(snippet, expected):
+    html = _snippet_html(snippet)
+    assert html == expected
+    assert len(html) <= snippet_max_length
@@ -1,12 +1,13 @@
 import json
-from asyncio import TimeoutError
+from asyncio import Event, TimeoutError, gather, sleep
 
 import pytest
 from aiohttp import WSMsgType
 from arq import Worker
 from pytest_toolbox.comparison import AnyInt, CloseToNow, RegexStr
 
-from em2.core import Action, ActionTypes, construct_conv
+from em2.background import flush_user_versions, get_presence_nodes, push_actions_cache
+from em2.core import Action, ActionTypes, construct_conv, conv_actions_cache, get_users_v
 
 from .conftest import Em2TestClient, Factory, UserTestClient
 
@@ -32,6 +33,8 @@ async def test_create_conv(cli: UserTestClient, factory: Factory, db_conn):
         'leader_node': None,
         'live': True,
         'details': RegexStr(r'\{.*\}'),
+        'msg_count': 1,
+        'prt_count': 1,
     }
     assert json.loads(conv['details']) == {
         'act': 'conv:create',
@@ -83,6 +86,8 @@ async def test_create_conv_participants(cli: UserTestClient, factory: Factory, d
         'leader_node': None,
         'live': True,
         'details': RegexStr(r'\{.*\}'),
+        'msg_count': 1,
+        'prt_count': 3,
     }
     assert json.loads(conv['details']) == {
         'act': 'conv:create',
@@ -126,6 +131,8 @@ async def test_create_conv_publish(cli: UserTestClient, factory: Factory, db_con
         'leader_node': None,
         'live': True,
         'details': RegexStr(r'\{.*\}'),
+        'msg_count': 1,
+        'prt_count': 1,
     }
     assert json.loads(conv['details']) == {
         'act': 'conv:publish',
@@ -213,6 +220,69 @@ async def test_conv_actions(cli: UserTestClient, factory: Factory, db_conn):
     ]
 
 
+async def test_conv_actions_paginate(cli: UserTestClient, factory: Factory):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+    for i in range(4):
+        await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body=f'msg {i}'))
+
+    url = factory.url('ui:get-actions', conv=conv.key)
+    obj = await cli.get_json(url, params={'limit': 3})
+    assert [a['id'] for a in obj] == [1, 2, 3]
+    obj = await cli.get_json(url, params={'since': 3, 'limit': 3})
+    assert [a['id'] for a in obj] == [4, 5, 6]
+    obj = await cli.get_json(url, params={'before': 6, 'limit': 2})
+    assert [a['id'] for a in obj] == [4, 5]
+    obj = await cli.get_json(url, params={'before': 3})
+    assert [a['id'] for a in obj] == [1, 2]
+    assert await cli.get_json(url, params={'since': 7, 'limit': 3}) == []
+
+
+async def test_conv_actions_stream(cli: UserTestClient, factory: Factory):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='another message'))
+
+    url = factory.url('ui:get-actions', conv=conv.key)
+    lines = await cli.get_ndjson(url, params={'stream': 'true'})
+    assert lines == await cli.get_json(url)
+    assert [a['id'] for a in lines] == [1, 2, 3, 4]
+
+    lines = await cli.get_ndjson(url, params={'stream': 'true', 'before': 4, 'limit': 2})
+    assert [a['id'] for a in lines] == [2, 3]
+    lines = await cli.get_ndjson(url, params={'stream': 'true', 'since': 2})
+    assert [a['id'] for a in lines] == [3, 4]
+
+    await cli.get_json(url, params={'stream': 'true', 'since': 123}, status=404)
+
+
+async def test_conv_actions_cache(cli: UserTestClient, factory: Factory):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+    conv_actions_cache.reset()
+    push_actions_cache.reset()
+
+    url = factory.url('ui:get-actions', conv=conv.key)
+    obj = await cli.get_json(url)
+    assert [a['id'] for a in obj] == [1, 2, 3]
+    assert conv_actions_cache.stats == {'hit': 0, 'miss': 3}
+    assert await cli.get_json(url) == obj
+    assert conv_actions_cache.stats == {'hit': 3, 'miss': 3}
+
+    await factory.act(conv.id, Action(actor_id=user.id, act=ActionTypes.msg_add, body='another message'))
+    assert push_actions_cache.stats == {'hit': 0, 'miss': 1}
+    obj2 = await cli.get_json(url)
+    assert obj2[:3] == obj
+    assert obj2[3]['body'] == 'another message'
+    assert conv_actions_cache.stats == {'hit': 6, 'miss': 4}
+    assert conv_actions_cache.hit_rate == 0.6
+
+    # publishing recreates actions, the cache must be cleared
+    r = await cli.post_json(factory.url('ui:publish', conv=conv.key), {'publish': True})
+    obj = await cli.get_json(factory.url('ui:get-actions', conv=(await r.json())['key']))
+    assert [a['act'] for a in obj] == ['participant:add', 'message:add', 'message:add', 'conv:publish']
+
+
 async def test_act(cli: UserTestClient, factory: Factory, db_conn):
     await factory.create_user()
     conv = await factory.create_conv()
@@ -290,6 +360,210 @@ async def test_seen(cli: UserTestClient, factory: Factory, db_conn):
             await ws.receive(timeout=0.1)
 
 
+async def test_ws_presence(cli: UserTestClient, factory: Factory, redis):
+    user = await factory.create_user()
+    user2 = await factory.create_user()
+    conv = await factory.create_conv(participants=[{'email': user2.email}], publish=True)
+    node_id = cli.server.app['ui_app']['background'].node_id
+    assert await get_presence_nodes(redis, [user.id, user2.id]) == set()
+
+    async with cli.session.ws_connect(cli.make_url(factory.url('ui:websocket'))) as ws:
+        msg = await ws.receive(timeout=0.1)
+        assert 'user_v' in json.loads(msg.data)
+        assert await get_presence_nodes(redis, [user.id]) == {node_id}
+        assert await get_presence_nodes(redis, [user2.id]) == set()
+
+        await cli.post_json(factory.url('ui:act', conv=conv.key), {'actions': [{'act': 'seen'}]})
+        msg = await ws.receive(timeout=0.1)
+        assert json.loads(msg.data)['actions'][0]['act'] == 'seen'
+
+    # give the server time to notice the websocket has closed
+    await sleep(0.1)
+    assert await get_presence_nodes(redis, [user.id, user2.id]) == set()
+
+
+async def test_ws_presence_reconnect(cli: UserTestClient, factory: Factory, redis):
+    user = await factory.create_user()
+    background = cli.server.app['ui_app']['background']
+    ws1, ws2 = SlowWebSocket(), SlowWebSocket()
+    await background.add_ws(user.id, ws1)
+    assert await get_presence_nodes(redis, [user.id]) == {background.node_id}
+
+    # the user reconnects while their last websocket is being removed
+    await gather(background.remove_ws(user.id, ws1), background.add_ws(user.id, ws2))
+    assert background.connections == {user.id: [ws2]}
+    assert await get_presence_nodes(redis, [user.id]) == {background.node_id}
+
+    await background.remove_ws(user.id, ws2)
+    assert await get_presence_nodes(redis, [user.id]) == set()
+
+
+async def test_ws_replay(cli: UserTestClient, factory: Factory):
+    await factory.create_user()
+    conv = await factory.create_conv()
+
+    async def add_msg(body):
+        await cli.post_json(factory.url('ui:act', conv=conv.key), {'actions': [{'act': 'message:add', 'body': body}]})
+
+    async with cli.session.ws_connect(cli.make_url(factory.url('ui:websocket'))) as ws:
+        assert 'user_v' in json.loads((await ws.receive(timeout=0.1)).data)
+        await add_msg('first')
+        msg = json.loads((await ws.receive(timeout=0.1)).data)
+        assert msg['actions'][0]['body'] == 'first'
+        last_event_id = msg['event_id']
+
+    await add_msg('second')
+    await add_msg('third')
+
+    url = factory.url('ui:websocket', query={'last_event_id': last_event_id})
+    async with cli.session.ws_connect(cli.make_url(url)) as ws:
+        assert 'user_v' in json.loads((await ws.receive(timeout=0.1)).data)
+        msgs = [json.loads((await ws.receive(timeout=0.1)).data) for _ in range(2)]
+        assert [m['actions'][0]['body'] for m in msgs] == ['second', 'third']
+        assert msgs[1]['conv_details']['prev'] == 'third'
+        assert msgs[1]['flags']['draft'] == 1
+
+        await add_msg('fourth')
+        msg = json.loads((await ws.receive(timeout=0.1)).data)
+        assert msg['actions'][0]['body'] == 'fourth'
+
+    url = factory.url('ui:websocket', query={'last_event_id': '1-1'})
+    async with cli.session.ws_connect(cli.make_url(url)) as ws:
+        assert 'user_v' in json.loads((await ws.receive(timeout=0.1)).data)
+        assert json.loads((await ws.receive(timeout=0.1)).data) == {'resync': True}
+
+
+async def test_ws_events_recent_users(cli: UserTestClient, factory: Factory, redis, settings):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+    events_key = f'ws-events-{user.id}'
+
+    async def add_msg(body):
+        await cli.post_json(factory.url('ui:act', conv=conv.key), {'actions': [{'act': 'message:add', 'body': body}]})
+
+    # the user has never had a websocket so their events aren't recorded
+    await add_msg('first')
+    assert await redis.exists(events_key) == 0
+
+    async with cli.session.ws_connect(cli.make_url(factory.url('ui:websocket'))) as ws:
+        assert 'user_v' in json.loads((await ws.receive(timeout=0.1)).data)
+        await add_msg('second')
+        assert 'event_id' in json.loads((await ws.receive(timeout=0.1)).data)
+
+    await sleep(0.1)
+    await add_msg('third')
+    assert await redis.xlen(events_key) == 2
+    assert 0 < await redis.ttl(events_key) <= settings.ws_replay_ttl
+
+    # the stream expires with the recent key, after that events aren't recorded
+    assert await redis.ttl(events_key) <= await redis.ttl(f'ws-recent-{user.id}')
+    await redis.delete(f'ws-recent-{user.id}')
+    await add_msg('fourth')
+    assert await redis.xlen(events_key) == 2
+
+
+class SlowWebSocket:
+    def __init__(self):
+        self.unblock = Event()
+        self.sent = []
+        self.close_code = None
+
+    async def send_str(self, msg):
+        await self.unblock.wait()
+        self.sent.append(json.loads(msg))
+
+    async def close(self, *, code):
+        self.close_code = code
+
+
+async def test_ws_queue_merge(cli: UserTestClient, factory: Factory, settings):
+    user = await factory.create_user()
+    background = cli.server.app['ui_app']['background']
+    background.settings = settings.copy(update={'ws_queue_size': 2})
+    ws = SlowWebSocket()
+    await background.add_ws(user.id, ws)
+
+    def send(conv, action_id):
+        chunk = json.dumps({'conversation': conv, 'actions': [{'id': action_id}]})[:-1]
+        background.send(conv, {'user_id': user.id, 'event_id': f'1-{action_id}'}, [ws], chunk)
+
+    send('a', 1)
+    await sleep(0.01)
+    # the first message is being sent, these are queued
+    send('a', 2)
+    send('b', 3)
+    assert background.metrics() == {'websockets': 1, 'queued': 2, 'max_queue_depth': 2}
+    send('a', 4)
+    assert background.metrics() == {'websockets': 1, 'queued': 2, 'max_queue_depth': 2, 'merged': 1}
+
+    ws.unblock.set()
+    await sleep(0.01)
+    assert [(m['conversation'], [a['id'] for a in m['actions']], m['event_id']) for m in ws.sent] == [
+        ('a', [1], '1-1'),
+        ('b', [3], '1-3'),
+        ('a', [2, 4], '1-4'),
+    ]
+    assert ws.close_code is None
+
+    ws.unblock.clear()
+    send('a', 5)
+    await sleep(0.01)
+    send('b', 6)
+    send('c', 7)
+    send('d', 8)
+    await sleep(0.01)
+    assert ws.close_code == 4429
+    assert user.id not in background.connections
+    assert background.metrics() == {'websockets': 0, 'queued': 0, 'max_queue_depth': 0, 'merged': 1, 'overflow': 1}
+
+
+async def test_ws_replay_queue(cli: UserTestClient, factory: Factory, settings):
+    user = await factory.create_user()
+    conv = await factory.create_conv()
+    background = cli.server.app['ui_app']['background']
+    background.settings = settings.copy(update={'ws_queue_size': 2})
+
+    async def add_msg(body):
+        await cli.post_json(factory.url('ui:act', conv=conv.key), {'actions': [{'act': 'message:add', 'body': body}]})
+
+    ws = SlowWebSocket()
+    ws.unblock.set()
+    await background.add_ws(user.id, ws)
+    await add_msg('first')
+    await sleep(0.1)
+    last_event_id = ws.sent[0]['event_id']
+    await background.remove_ws(user.id, ws)
+
+    await add_msg('second')
+    await add_msg('third')
+    await add_msg('fourth')
+
+    ws = SlowWebSocket()
+    await background.add_ws(user.id, ws, replay=True)
+    await background.replay(user.id, ws, last_event_id)
+    # replayed events are queued like live messages so they're merged once the queue is full
+    assert background.metrics() == {'websockets': 1, 'queued': 2, 'max_queue_depth': 2, 'merged': 1}
+
+    ws.unblock.set()
+    await sleep(0.01)
+    assert [[a['body'] for a in m['actions']] for m in ws.sent] == [['second'], ['third', 'fourth']]
+
+
+async def test_ws_send_timeout(cli: UserTestClient, factory: Factory, settings):
+    user = await factory.create_user()
+    background = cli.server.app['ui_app']['background']
+    background.settings = settings.copy(update={'ws_send_timeout': 0.05})
+    ws = SlowWebSocket()
+    await background.add_ws(user.id, ws)
+
+    chunk = json.dumps({'conversation': 'a', 'actions': [{'id': 1}]})[:-1]
+    background.send('a', {'user_id': user.id, 'event_id': '1-1'}, [ws], chunk)
+    await sleep(0.1)
+    assert ws.close_code == 4429
+    assert user.id not in background.connections
+    assert background.metrics() == {'websockets': 0, 'queued': 0, 'max_queue_depth': 0, 'timeout': 1}
+
+
 async def test_create_then_publish(cli: UserTestClient, factory: Factory, db_conn, conns):
     user = await factory.create_user()
     conv = await factory.create_conv()
@@ -343,11 +617,11 @@ async def test_create_then_publish(cli: UserTestClient, factory: Factory, db_con
     assert 3 == await db_conn.fetchval('select count(*) from actions where conv=$1', conv.id)
 
 
-async def test_ws_create(cli: UserTestClient, factory: Factory, db_conn):
+async def test_ws_create(cli: UserTestClient, factory: Factory, db_conn, conns):
     user = await factory.create_user()
-    assert 1 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 1 == (await get_users_v(conns, [user.id]))[user.id]
     await factory.create_conv()
-    assert 2 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 2 == (await get_users_v(conns, [user.id]))[user.id]
 
     async with cli.session.ws_connect(cli.make_url(factory.url('ui:websocket'))) as ws:
         msg = await ws.receive(timeout=0.1)
@@ -368,6 +642,7 @@ async def test_ws_create(cli: UserTestClient, factory: Factory, db_conn):
         'user_v': 3,
         'user_id': user.id,
         'user_email': user.email,
+        'event_id': RegexStr(r'\d+-\d+'),
         'conversation': conv.key,
         'actions': [
             {
@@ -408,10 +683,10 @@ async def test_ws_create(cli: UserTestClient, factory: Factory, db_conn):
     }
 
 
-async def test_ws_add_msg(cli: UserTestClient, factory: Factory, db_conn):
+async def test_ws_add_msg(cli: UserTestClient, factory: Factory, db_conn, conns):
     user = await factory.create_user()
     conv = await factory.create_conv()
-    assert 2 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 2 == (await get_users_v(conns, [user.id]))[user.id]
 
     async with cli.session.ws_connect(cli.make_url(factory.url('ui:websocket'))) as ws:
         msg = await ws.receive(timeout=0.1)
@@ -431,6 +706,7 @@ async def test_ws_add_msg(cli: UserTestClient, factory: Factory, db_conn):
         'user_v': 3,
         'user_id': user.id,
         'user_email': user.email,
+        'event_id': RegexStr(r'\d+-\d+'),
         'conversation': conv.key,
         'interaction': interaction,
         'actions': [
@@ -467,10 +743,10 @@ async def test_create_conv_many_participants(cli: UserTestClient, factory: Facto
     assert 'no more than 64 participants permitted' in await r.text()
 
 
-async def test_act_multiple(cli: UserTestClient, factory: Factory, db_conn):
+async def test_act_multiple(cli: UserTestClient, factory: Factory, db_conn, conns):
     user = await factory.create_user()
     conv = await factory.create_conv()
-    assert 2 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 2 == (await get_users_v(conns, [user.id]))[user.id]
 
     data = {
         'actions': [
@@ -482,7 +758,7 @@ async def test_act_multiple(cli: UserTestClient, factory: Factory, db_conn):
     r = await cli.post_json(factory.url('ui:act', conv=conv.key), data)
     obj = await r.json()
     assert obj == {'interaction': RegexStr(r'[a-f0-9]{32}')}
-    assert 3 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 3 == (await get_users_v(conns, [user.id]))[user.id]
     assert 4 == await db_conn.fetchval(
         'select a.id from actions a join users u on a.participant_user = u.id where email = $1', 'user-2@example.com'
     )
@@ -494,6 +770,25 @@ async def test_act_multiple(cli: UserTestClient, factory: Factory, db_conn):
     )
 
 
+async def test_flush_user_versions(factory: Factory, db_conn, redis, conns):
+    user = await factory.create_user()
+    await factory.create_conv()
+    await factory.create_conv()
+    assert 1 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 3 == (await get_users_v(conns, [user.id]))[user.id]
+
+    assert 1 == await flush_user_versions({'redis': redis, 'pg': db_conn})
+    assert 3 == await db_conn.fetchval('select v from users where id=$1', user.id)
+    assert 0 == await flush_user_versions({'redis': redis, 'pg': db_conn})
+
+    # as if redis lost the hash, v is seeded from users.v
+    await redis.delete('user-v')
+    assert 3 == (await get_users_v(conns, [user.id]))[user.id]
+    assert '3' == await redis.hget('user-v', user.id)
+    await factory.create_conv()
+    assert 4 == (await get_users_v(conns, [user.id]))[user.id]
+
+
 async def test_get_not_participant(factory: Factory, cli):
     await factory.create_user()
     conv = await factory.create_conv(publish=True)